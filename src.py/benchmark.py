@@ -0,0 +1,506 @@
+"""Benchmarks of processing synthetic EMR event data"""
+
+# Copyright (c) 2019 Aubrey Barnard.
+#
+# This is free software released under the MIT License
+# (https://choosealicense.com/licenses/mit/).
+
+
+# Run like: python3 benchmark.py run bench.json [n-patients] [events-per-patient]
+#
+# Then compare the results of two versions like: python3 benchmark.py
+# compare bench.old.json bench.new.json
+#
+# The synthetic events are generated from a seeded random number
+# generator, so the same parameters always produce the same events.
+# Times are wall clock times of single runs, so run on a quiet machine
+# and compare results from the same machine.
+
+
+import datetime
+import io
+import json
+import os
+import pathlib
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# "Install" related modules by updating import path
+this_dir = pathlib.Path(__file__).absolute().parent
+sys.path.append(str(this_dir))
+
+import event_data
+import survival_data
+
+
+# Synthetic data
+
+# Default relative frequencies of events by table
+default_table_mix = {
+    'dx': 30,
+    'mx': 25,
+    'ox': 5,
+    'px': 15,
+    'rx': 15,
+    'vx': 10,
+}
+
+# Number of distinct event types (concepts) per table
+default_n_types = 2000
+
+
+def _pick_type(rng, tbl, n_types):
+    # Concepts are used very unequally, so pick with a Zipf-like
+    # distribution.  Offset the concept IDs by table so they differ.
+    rank = int(n_types ** rng.random()) - 1
+    return (sorted(default_table_mix).index(tbl) + 1) * 1000000 + rank
+
+
+def generate_events(
+        file,
+        n_patients=1000,
+        events_per_patient=100,
+        table_mix=None,
+        n_types=default_n_types,
+        json_size=0,
+        json_fraction=0.2,
+        rx_refill_fraction=0.5,
+        death_fraction=0.1,
+        seed=0,
+):
+    """
+    Write synthetic event records for the given number of patients to
+    the given text file in the format read by `event_data.read_records`.
+
+    Each patient has demographic facts and, on average,
+    `events_per_patient` events drawn from the tables according to
+    `table_mix` (table -> relative frequency).  Drug events have JSON
+    with days supply, quantity, and (for `rx_refill_fraction` of them)
+    refills.  `json_fraction` of the other events have JSON padded to
+    about `json_size` characters.  Return the number of records written.
+    """
+    rng = random.Random(seed)
+    table_mix = table_mix if table_mix is not None else default_table_mix
+    tbls = list(table_mix)
+    weights = [table_mix[t] for t in tbls]
+    padding = 'x' * json_size
+    end_date = datetime.date(2019, 1, 1)
+    n_records = 0
+    for pid in range(1, n_patients + 1):
+        lines = []
+        dob = datetime.date(1930, 1, 1) + datetime.timedelta(
+            days=rng.randrange(60 * 365))
+        lines.append(f'{pid}|||bx|dob|{dob}|')
+        lines.append('{}|||bx|gndr|{}|'.format(pid, rng.choice('FM')))
+        lines.append('{}|||bx|race|{}|'.format(
+            pid, rng.choice((8515, 8516, 8527, 8552))))
+        # Events happen between adulthood and the end of the data
+        start = dob + datetime.timedelta(days=(20 * 365))
+        n_days = max((end_date - start).days, 1)
+        n_evs = max(int(rng.expovariate(1 / events_per_patient)), 1)
+        evs = []
+        for tbl in rng.choices(tbls, weights, k=n_evs):
+            lo = start + datetime.timedelta(days=rng.randrange(n_days))
+            typ = _pick_type(rng, tbl, n_types)
+            hi = lo
+            val = ''
+            jsn = ''
+            if tbl == 'mx':
+                val = round(rng.gauss(100, 20), 1)
+            elif tbl == 'rx':
+                hi = ''
+                attrs = dict(
+                    days_supply=rng.choice((None, 7, 30, 90)),
+                    quantity=rng.choice((None, 14, 30, 60, 90)),
+                    drug_type_concept_id=rng.choice(
+                        (38000177, 38000177, 38000178)),
+                )
+                if rng.random() < rx_refill_fraction:
+                    attrs['refills'] = rng.randrange(12)
+                jsn = json.dumps(
+                    {k: v for (k, v) in attrs.items() if v is not None},
+                    separators=(',', ':'))
+            elif tbl == 'dx' and rng.random() < 0.3:
+                hi = ''
+            if tbl != 'rx' and json_size and rng.random() < json_fraction:
+                jsn = json.dumps(dict(provider_id=rng.randrange(10 ** 9),
+                                      note=padding),
+                                 separators=(',', ':'))
+            evs.append((lo, tbl, typ, hi, val, jsn))
+        evs.sort(key=lambda e: e[0])
+        for lo, tbl, typ, hi, val, jsn in evs:
+            lines.append(f'{pid}|{lo}|{hi}|{tbl}|{typ}|{val}|{jsn}')
+        if rng.random() < death_fraction:
+            lines.append('{}|{}||xx|||'.format(pid, evs[-1][0]))
+        file.write('\n'.join(lines))
+        file.write('\n')
+        n_records += len(lines)
+    return n_records
+
+
+def generate_event_types(
+        n_types=default_n_types, n_exposures=20, n_outcomes=20, seed=0):
+    """
+    Return lists of exposure types (drugs) and outcome types
+    (conditions) for the synthetic events as text.
+    """
+    rng = random.Random(seed)
+    exposures = sorted(rng.sample(range(n_types), n_exposures))
+    outcomes = sorted(rng.sample(range(n_types), n_outcomes))
+    tbl_offset = {t: (sorted(default_table_mix).index(t) + 1) * 1000000
+                  for t in ('dx', 'rx')}
+    return (
+        ''.join('rx|{}\n'.format(tbl_offset['rx'] + r) for r in exposures),
+        ''.join('dx|{}\n'.format(tbl_offset['dx'] + r) for r in outcomes)
+        + 'xx|\n',
+    )
+
+
+# Measurement
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process over its whole
+    life in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB and macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+
+def rss_mb():
+    """
+    Return the current resident set size of this process in MB or
+    `None` if it is not available (it is read from `/proc`).
+    """
+    try:
+        with open('/proc/self/statm', 'rt') as file:
+            n_pages = int(file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return n_pages * resource.getpagesize() / 2 ** 20
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process every `interval`
+    seconds in a background thread to find its peak while running.
+    Unlike `peak_rss_mb`, the peak only covers the time while sampling.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.start_mb = rss_mb()
+        self.peak_mb = self.start_mb
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def measure(function, *args, **kwargs):
+    """
+    Call the given function and return a pair of its return value and
+    the measurements of the call.
+
+    The memory measurements are the peak resident set size during the
+    call and its increase over the size at the start of the call (both
+    `None` where the size is not available).
+    """
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    rss_increase_mb = (sampler.peak_mb - sampler.start_mb
+                       if sampler.start_mb is not None
+                       else None)
+    return value, dict(seconds=seconds, peak_rss_mb=sampler.peak_mb,
+                       rss_increase_mb=rss_increase_mb)
+
+
+def _rate(result, name, n_items):
+    result[name] = n_items
+    result[name + '_per_s'] = (
+        n_items / result['seconds'] if result['seconds'] > 0 else None)
+    return result
+
+
+def _version():
+    # Describe the version of the code being benchmarked
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=this_dir, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+        out_file,
+        n_patients=1000,
+        events_per_patient=100,
+        json_size=0,
+        jobs=1,
+        tmp_dir=None,
+        **generate_args,
+):
+    """
+    Generate synthetic events and time each stage of processing them
+    and whole runs.  Write the results as JSON to the given file (a
+    filename or stream) and return them.
+    """
+    results = dict(
+        version=_version(),
+        python=sys.version,
+        platform=platform.platform(),
+        parameters=dict(
+            n_patients=n_patients,
+            events_per_patient=events_per_patient,
+            json_size=json_size,
+            jobs=jobs,
+            **generate_args,
+        ),
+        benchmarks={},
+    )
+    benchmarks = results['benchmarks']
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        tmp = pathlib.Path(tmp)
+        # Generate data
+        events_path = tmp / 'events.csv'
+        with open(events_path, 'wt') as file:
+            n_records, result = measure(
+                generate_events, file, n_patients, events_per_patient,
+                json_size=json_size, **generate_args)
+        benchmarks['generate_events'] = _rate(result, 'records', n_records)
+        results['events_mb'] = events_path.stat().st_size / 1e6
+        exposures_text, outcomes_text = generate_event_types()
+        exposures_path = tmp / 'exposures.csv'
+        exposures_path.write_text(exposures_text)
+        outcomes_path = tmp / 'outcomes.csv'
+        outcomes_path.write_text(outcomes_text)
+        event_type_map = survival_data.build_exposure_outcome_event_type_map(
+            list(survival_data.read_event_types(str(exposures_path))),
+            list(survival_data.read_event_types(str(outcomes_path))),
+        )
+        # Reading records, with the default and fast settings
+        for name, args in (
+                ('read_records', {}),
+                ('read_records_fast', dict(
+                    record_parser=event_data.parse_record_fast,
+                    json_constructor=event_data.lazy_json)),
+        ):
+            records, result = measure(
+                lambda: list(event_data.read_records(
+                    str(events_path),
+                    include_record=survival_data.include_record,
+                    record_transformer=survival_data.transform_record,
+                    **args)))
+            benchmarks[name] = _rate(result, 'records', len(records))
+        # Assembling sequences
+        ev_seqs, result = measure(
+            lambda: list(event_data.event_sequences_from_records(records)))
+        del records
+        benchmarks['event_sequences_from_records'] = _rate(
+            result, 'sequences', len(ev_seqs))
+        # Survivalizing sequences
+        surv_seqs, result = measure(
+            lambda: [survival_data.survivalize(
+                         ev_seq, event_type_map,
+                         era_max_gap=datetime.timedelta(30))
+                     for ev_seq in ev_seqs])
+        del ev_seqs
+        benchmarks['survivalize'] = _rate(
+            result, 'sequences', len(surv_seqs))
+        # Generating examples
+        n_exs, result = measure(
+            lambda: sum(len(list(survival_data.examples_from_transitions(
+                                ev_seq)))
+                        for ev_seq in surv_seqs))
+        del surv_seqs
+        benchmarks['examples_from_transitions'] = _rate(
+            result, 'sequences', n_patients)
+        benchmarks['examples_from_transitions']['examples'] = n_exs
+        # Whole runs
+        with open(os.devnull, 'wt') as out:
+            _, result = measure(
+                survival_data.main_api,
+                str(exposures_path), str(outcomes_path),
+                in_file=str(events_path), out_file=out,
+                include_record=survival_data.include_record,
+                record_transformer=survival_data.transform_record,
+                record_parser=event_data.parse_record_fast,
+                json_constructor=event_data.lazy_json,
+                era_max_gap=datetime.timedelta(30),
+                jobs=jobs,
+            )
+        benchmarks['main_api'] = _rate(result, 'records', n_records)
+        benchmarks['main_api']['sequences_per_s'] = (
+            n_patients / result['seconds'])
+        # `main.py` requires `cdmdata`, which is optional here
+        try:
+            import main
+        except ImportError as exc:
+            benchmarks['gen_examples_at_intervals'] = dict(
+                skipped=str(exc))
+        else:
+            n_exs, result = measure(
+                lambda: sum(1 for _ in main.gen_examples_at_intervals(
+                    str(events_path), 'date')))
+            benchmarks['gen_examples_at_intervals'] = _rate(
+                result, 'records', n_records)
+            benchmarks['gen_examples_at_intervals']['examples'] = n_exs
+    results['peak_rss_mb'] = peak_rss_mb()
+    # Write results
+    if isinstance(out_file, io.IOBase):
+        json.dump(results, out_file, indent=2)
+    else:
+        with open(out_file, 'wt') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def compare_results(old_results, new_results):
+    """
+    Return a table (list of rows) comparing the times of the benchmarks
+    in the given results.  The ratio is new time / old time.
+    """
+    rows = [('benchmark', 'old_s', 'new_s', 'ratio')]
+    old = old_results['benchmarks']
+    new = new_results['benchmarks']
+    for name in new:
+        old_s = old.get(name, {}).get('seconds')
+        new_s = new[name].get('seconds')
+        ratio = (new_s / old_s
+                 if old_s and new_s is not None
+                 else None)
+        rows.append((name, old_s, new_s, ratio))
+    return rows
+
+
+# CLI entry points
+
+
+def run(out_filename, n_patients=1000, events_per_patient=100, jobs=1):
+    run_benchmarks(out_filename, int(n_patients), int(events_per_patient),
+                   jobs=int(jobs))
+
+
+def generate(n_patients=1000, events_per_patient=100, json_size=0):
+    generate_events(sys.stdout, int(n_patients), int(events_per_patient),
+                    json_size=int(json_size))
+
+
+def compare(old_filename, new_filename):
+    with open(old_filename) as file:
+        old_results = json.load(file)
+    with open(new_filename) as file:
+        new_results = json.load(file)
+    for row in compare_results(old_results, new_results):
+        print(*('{:.3f}'.format(x) if isinstance(x, float)
+                else ('' if x is None else x)
+                for x in row),
+              sep='|')
+
+
+# Tests
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_generate_events(self):
+        file = io.StringIO()
+        n_records = generate_events(file, 20, 10, json_size=50, seed=1)
+        text = file.getvalue()
+        self.assertEqual(n_records, len(text.splitlines()))
+        # The same parameters generate the same events
+        file2 = io.StringIO()
+        generate_events(file2, 20, 10, json_size=50, seed=1)
+        self.assertEqual(text, file2.getvalue())
+        # The events can be read and assembled into one sequence per
+        # patient
+        records = list(event_data.read_records(
+            io.StringIO(text),
+            record_transformer=survival_data.transform_record))
+        self.assertEqual(n_records, len(records))
+        ev_seqs = list(event_data.event_sequences_from_records(records))
+        self.assertEqual(20, len(ev_seqs))
+
+    def test_run_benchmarks(self):
+        out = io.StringIO()
+        results = run_benchmarks(out, 10, 20)
+        self.assertEqual(results, json.loads(out.getvalue()))
+        for name in ('read_records', 'event_sequences_from_records',
+                     'survivalize', 'examples_from_transitions',
+                     'main_api'):
+            self.assertGreater(results['benchmarks'][name]['seconds'], 0)
+        self.assertEqual(
+            10, results['benchmarks']['event_sequences_from_records'][
+                'sequences'])
+        rows = compare_results(results, results)
+        self.assertEqual(1.0, rows[1][3])
+
+    def test_measure__memory(self):
+        if rss_mb() is None:
+            self.skipTest('Resident set size is not available')
+        def allocate():
+            data = bytearray(64 * 2 ** 20)
+            # Touch the pages so they are resident
+            data[::4096] = b'x' * len(range(0, len(data), 4096))
+            time.sleep(0.05)
+            return len(data)
+        _, first = measure(allocate)
+        self.assertGreater(first['rss_increase_mb'], 50)
+        # A later stage reports its own peak rather than the earlier one
+        _, second = measure(time.sleep, 0.02)
+        self.assertLess(second['rss_increase_mb'], 10)
+        self.assertLess(second['peak_rss_mb'], first['peak_rss_mb'])
+
+
+# Main
+
+
+def cli(function_name, *args):
+    """
+    Call the given function from this module with the given string
+    arguments.
+    """
+    globals()[function_name](*args)
+
+
+if __name__ == '__main__':
+    cli(*sys.argv[1:])
@@ -0,0 +1,614 @@
+"""Compact, array-backed event sequences"""
+
+# Copyright (c) 2019 Aubrey Barnard.  This is free software released
+# under the MIT License (https://choosealicense.com/licenses/mit/).
+
+# An `esal.EventSequence` holds an `esal.Event` (with an `esal.Interval`
+# and a value) for every event, and every step of making survival data
+# (encoding exposures and outcomes, making eras, limiting to the study
+# period) copies the events into a new sequence.  For patients with many
+# events this takes lots of memory and allocation.
+#
+# A `CompactEventSequence` instead stores its events as parallel arrays:
+# the lo and hi dates as day numbers (proleptic Gregorian ordinals), the
+# types as indices into a table of types shared by all the sequences
+# derived from the same records, and references to the values.  The
+# steps of making survival data have versions that work directly on the
+# arrays (`map_event_types`, `truncate_at_first_outcome`, `make_eras`,
+# `limit_to_dates`, `transitions`), and `survival_data` uses them when
+# given a compact sequence.  Otherwise, a compact sequence behaves like
+# an `esal.EventSequence`, constructing events only when they are
+# accessed.
+#
+# Only events whose intervals have dates for bounds are supported.
+# Records with other events are made into `esal.EventSequence`s as
+# usual (see `from_records`).
+
+
+import array
+import bisect
+import datetime
+import functools
+import pathlib
+import sys
+import unittest
+
+import esal
+
+# "Install" related modules by updating import path
+this_dir = pathlib.Path(__file__).absolute().parent
+sys.path.append(str(this_dir))
+
+import event_data
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def _date(ordinal):
+    return datetime.date.fromordinal(ordinal)
+
+
+def _days(gap):
+    # Return the given gap (a `timedelta` or number) as whole days
+    if isinstance(gap, datetime.timedelta):
+        return gap.days
+    return gap if gap else 0
+
+
+# Shared value of events without a value or JSON
+_no_value = (None, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _point_hi_is_lo():
+    # Whether `esal.Interval(lo, None)` is the point `lo`.  If not,
+    # records without hi dates are not supported.
+    day = datetime.date(2000, 1, 1)
+    return esal.Interval(day, None).hi == day
+
+
+class TypeTable:
+    """Assigns codes to event types (in order of first appearance)."""
+
+    __slots__ = ('types', 'codes', '_tbl2typ2code')
+
+    def __init__(self):
+        self.types = []
+        self.codes = {}
+        self._tbl2typ2code = {}
+
+    def code(self, event_type):
+        code = self.codes.get(event_type)
+        if code is None:
+            code = len(self.types)
+            self.types.append(event_type)
+            self.codes[event_type] = code
+        return code
+
+    def record_code(self, tbl, typ):
+        # Look up the table and type separately to avoid making a pair
+        typ2code = self._tbl2typ2code.get(tbl)
+        if typ2code is None:
+            typ2code = {}
+            self._tbl2typ2code[tbl] = typ2code
+        code = typ2code.get(typ)
+        if code is None:
+            code = self.code((tbl, typ))
+            typ2code[typ] = code
+        return code
+
+
+class CompactEventSequence:
+
+    __slots__ = ('id', '_facts', '_table', '_los', '_his', '_typs',
+                 '_values', '_max_his')
+
+    def __init__(self, id, facts, table, los, his, typs, values):
+        # The events must already be sorted by their lo and hi dates
+        self.id = id
+        self._facts = facts
+        self._table = table
+        self._los = los
+        self._his = his
+        self._typs = typs
+        self._values = values
+        # Running maximum of the his (built when needed)
+        self._max_his = None
+
+    @classmethod
+    def _sorted(cls, id, facts, table, los, his, typs, values):
+        # Sort the events (stably) by their lo and hi dates if needed
+        n_events = len(los)
+        for idx in range(1, n_events):
+            if los[idx] < los[idx - 1] or (
+                    los[idx] == los[idx - 1] and his[idx] < his[idx - 1]):
+                break
+        else:
+            return cls(id, facts, table, los, his, typs, values)
+        order = sorted(range(n_events), key=lambda i: (los[i], his[i]))
+        return cls(id, facts, table,
+                   array.array('i', (los[i] for i in order)),
+                   array.array('i', (his[i] for i in order)),
+                   array.array('i', (typs[i] for i in order)),
+                   [values[i] for i in order])
+
+    @classmethod
+    def from_events(cls, events, facts=(), id=None, table=None):
+        """
+        Return a compact sequence of the given events or `None` if some
+        event does not have an interval with dates as bounds.
+        """
+        if table is None:
+            table = TypeTable()
+        los = array.array('i')
+        his = array.array('i')
+        typs = array.array('i')
+        values = []
+        for event in events:
+            when = event.when
+            if (not isinstance(when, esal.Interval) or
+                    when.is_lo_open or when.is_hi_open or
+                    type(when.lo) is not datetime.date or
+                    type(when.hi) is not datetime.date):
+                return None
+            los.append(when.lo.toordinal())
+            his.append(when.hi.toordinal())
+            typs.append(table.code(event.type))
+            values.append(event.value)
+        return cls._sorted(id, dict(facts), table, los, his, typs, values)
+
+    # Sequence of events
+
+    def __len__(self):
+        return len(self._los)
+
+    def _event(self, idx):
+        return esal.Event(
+            esal.Interval(_date(self._los[idx]), _date(self._his[idx])),
+            self._table.types[self._typs[idx]],
+            self._values[idx])
+
+    def __getitem__(self, idx):
+        return self._event(idx)
+
+    def __iter__(self):
+        return map(self._event, range(len(self._los)))
+
+    def events(self):
+        return iter(self)
+
+    # Facts
+
+    def fact(self, key, default=None):
+        return self._facts.get(key, default)
+
+    def facts(self):
+        return list(self._facts.items())
+
+    def __setitem__(self, key, value):
+        self._facts[key] = value
+
+    # Derived sequences.  These share the facts of this sequence.
+
+    def _derive(self, los, his, typs, values, facts=None):
+        return CompactEventSequence._sorted(
+            self.id, self._facts if facts is None else facts,
+            self._table, los, his, typs, values)
+
+    def copy(self, events=None, facts=None):
+        """
+        Return a copy of this sequence with the given events and facts
+        (if any).  If some of the events are not supported, return an
+        `esal.EventSequence` instead.
+        """
+        facts = dict(self._facts if facts is None else facts)
+        if events is None:
+            return CompactEventSequence(
+                self.id, facts, self._table, self._los, self._his,
+                self._typs, self._values)
+        events = list(events)
+        ev_seq = CompactEventSequence.from_events(
+            events, facts, self.id, self._table)
+        if ev_seq is None:
+            return esal.EventSequence(events, facts.items(), self.id)
+        return ev_seq
+
+    def subsequence(self, idxs):
+        """Return a sequence of the events with the given indices."""
+        idxs = list(idxs)
+        return CompactEventSequence(
+            self.id, self._facts, self._table,
+            array.array('i', (self._los[i] for i in idxs)),
+            array.array('i', (self._his[i] for i in idxs)),
+            array.array('i', (self._typs[i] for i in idxs)),
+            [self._values[i] for i in idxs])
+
+    # Queries
+
+    def has_type(self, event_type):
+        code = self._table.codes.get(event_type)
+        return code is not None and code in self._typs
+
+    def n_events_of_type(self, event_type):
+        code = self._table.codes.get(event_type)
+        return self._typs.count(code) if code is not None else 0
+
+    def date_bounds(self):
+        """
+        Return the first lo date and the last hi date of the events (or
+        `None` if there are no events).
+        """
+        if not self._los:
+            return None
+        return _date(self._los[0]), _date(max(self._his))
+
+    def events_overlapping(
+            self, lo, hi=None, is_lo_open=False, is_hi_open=False):
+        """
+        Return the indices of the events that overlap the given interval
+        like `esal.EventSequence.events_overlapping`.
+        """
+        if hi is None:
+            hi = lo
+        lo = lo.toordinal()
+        hi = hi.toordinal()
+        if self._max_his is None:
+            self._max_his = array.array('i')
+            max_hi = None
+            for ev_hi in self._his:
+                if max_hi is None or ev_hi > max_hi:
+                    max_hi = ev_hi
+                self._max_his.append(max_hi)
+        # Search the events that start before the end of the interval
+        # and that are preceded by events that end before its start
+        if is_lo_open:
+            idx_lo = bisect.bisect_right(self._max_his, lo)
+        else:
+            idx_lo = bisect.bisect_left(self._max_his, lo)
+        if is_hi_open:
+            idx_hi = bisect.bisect_left(self._los, hi)
+        else:
+            idx_hi = bisect.bisect_right(self._los, hi)
+        los = self._los
+        his = self._his
+        return [idx for idx in range(idx_lo, idx_hi)
+                if ((his[idx] > lo) if is_lo_open else (his[idx] >= lo)) and
+                ((los[idx] < hi) if is_hi_open else (los[idx] <= hi))]
+
+    def transitions(self, *event_types):
+        """
+        Yield `(date, starts, stops, points)` for each date on which
+        events of the given types start or stop like
+        `esal.EventSequence.transitions`.
+        """
+        codes = set(self._table.codes[t] for t in event_types
+                    if t in self._table.codes)
+        day2tx = {}
+        for idx, code in enumerate(self._typs):
+            if code not in codes:
+                continue
+            lo = self._los[idx]
+            hi = self._his[idx]
+            if lo == hi:
+                tx = day2tx.get(lo)
+                if tx is None:
+                    tx = ([], [], [])
+                    day2tx[lo] = tx
+                tx[2].append(self._event(idx))
+            else:
+                event = self._event(idx)
+                for (day, pos) in ((lo, 0), (hi, 1)):
+                    tx = day2tx.get(day)
+                    if tx is None:
+                        tx = ([], [], [])
+                        day2tx[day] = tx
+                    tx[pos].append(event)
+        for day in sorted(day2tx):
+            starts, stops, points = day2tx[day]
+            yield (_date(day), starts, stops, points)
+
+    # Steps of making survival data (see `survival_data`)
+
+    def map_event_types(self, type2type, replace=False):
+        """
+        Return a sequence where the events with types in the given map
+        are encoded with their mapped types like
+        `survival_data.map_event_types`.
+        """
+        table = self._table
+        code2code = {table.codes[t]: table.code(m)
+                     for (t, m) in type2type.items() if t in table.codes}
+        if not code2code:
+            return self
+        los = array.array('i')
+        his = array.array('i')
+        typs = array.array('i')
+        values = []
+        for idx, code in enumerate(self._typs):
+            mapped = code2code.get(code)
+            if mapped is not None:
+                los.append(self._los[idx])
+                his.append(self._his[idx])
+                typs.append(mapped)
+                values.append(self._values[idx])
+                if replace:
+                    continue
+            los.append(self._los[idx])
+            his.append(self._his[idx])
+            typs.append(code)
+            values.append(self._values[idx])
+        return CompactEventSequence(
+            self.id, self._facts, table, los, his, typs, values)
+
+    def truncate_at_first_outcome(
+            self,
+            outcome_event_type='out',
+            era_event_types=(),
+            era_max_gap=0,
+            study_start=None,
+    ):
+        """Like `survival_data.truncate_at_first_outcome`."""
+        table = self._table
+        out_code = table.codes.get(outcome_event_type)
+        if not self._los or out_code is None or out_code not in self._typs:
+            return self
+        # The events are sorted, so the first outcome is the first one
+        first = self._los[self._typs.index(out_code)]
+        start = (study_start.toordinal() if study_start is not None
+                 else self._los[0])
+        if first <= start:
+            return self
+        era_codes = set(table.codes[t] for t in era_event_types
+                        if t in table.codes)
+        era_limit = first + _days(era_max_gap)
+        idxs = [idx for (idx, lo) in enumerate(self._los)
+                if (lo <= first or
+                    (self._typs[idx] in era_codes and lo <= era_limit))]
+        return self.subsequence(idxs)
+
+    def make_eras(self, event_types, max_gap=0):
+        """Like `survival_data.make_eras`."""
+        table = self._table
+        era_codes = set(table.codes[t] for t in event_types
+                        if t in table.codes)
+        max_gap = _days(max_gap)
+        los = array.array('i')
+        his = array.array('i')
+        typs = array.array('i')
+        values = []
+        # Current era (lo, hi) by type code.  The events are sorted, so
+        # sweep once.
+        code2era = {}
+        eras = []
+        for idx, code in enumerate(self._typs):
+            lo = self._los[idx]
+            hi = self._his[idx]
+            if code in era_codes:
+                era = code2era.get(code)
+                if era is not None and lo - era[1] <= max_gap:
+                    if hi > era[1]:
+                        era[1] = hi
+                else:
+                    era = [lo, hi, code]
+                    code2era[code] = era
+                    eras.append(era)
+            else:
+                los.append(lo)
+                his.append(hi)
+                typs.append(code)
+                values.append(self._values[idx])
+        for (lo, hi, code) in eras:
+            los.append(lo)
+            his.append(hi)
+            typs.append(code)
+            values.append(None)
+        return self._derive(los, his, typs, values)
+
+    def limit_to_dates(self, min_date=None, max_date=None):
+        """
+        Return a sequence of the events clipped to the given dates with
+        events of types `('study', 'lo')` and `('study', 'hi')` marking
+        the given dates like `survival_data.limit_to_ages`.
+        """
+        min_day = (min_date.toordinal() if min_date is not None
+                   else datetime.date.min.toordinal())
+        max_day = (max_date.toordinal() if max_date is not None
+                   else datetime.date.max.toordinal())
+        los = array.array('i')
+        his = array.array('i')
+        typs = array.array('i')
+        values = []
+        if min_date is not None:
+            los.append(min_day)
+            his.append(min_day)
+            typs.append(self._table.code(('study', 'lo')))
+            values.append(())
+        for idx, code in enumerate(self._typs):
+            lo = self._los[idx]
+            hi = self._his[idx]
+            if hi < min_day or lo > max_day:
+                continue
+            los.append(max(lo, min_day))
+            his.append(min(hi, max_day))
+            typs.append(code)
+            values.append(self._values[idx])
+        if max_date is not None:
+            los.append(max_day)
+            his.append(max_day)
+            typs.append(self._table.code(('study', 'hi')))
+            values.append(())
+        return self._derive(los, his, typs, values)
+
+
+def from_records(
+        rec_id,
+        records,
+        fact_constructor=event_data.fact_from_record,
+        event_type_interner=None,
+        field_name2idx=event_data.field_name2idx,
+):
+    """
+    Return a compact sequence of the given records like
+    `event_data.event_sequence_from_records`.  If the event types are
+    interned, use the codes of the given interner as the types.
+
+    If some event record does not have dates as bounds, return an
+    `esal.EventSequence` instead (which requires iterating over the
+    records again).
+
+    The records are only iterated over once otherwise, so they can be
+    streamed (e.g. from `event_data.SpilledRecords`).
+    """
+    lo_idx = field_name2idx['lo']
+    hi_idx = field_name2idx['hi']
+    facts = []
+    table = TypeTable()
+    los = array.array('i')
+    his = array.array('i')
+    typs = array.array('i')
+    values = []
+    supported = True
+    for record in records:
+        lo = record[lo_idx]
+        hi = record[hi_idx]
+        if lo is None and hi is None:
+            facts.append(record)
+            continue
+        # Like `esal.Interval`, no hi means a point
+        if hi is None and _point_hi_is_lo():
+            hi = lo
+        if (type(lo) is not datetime.date or
+                type(hi) is not datetime.date):
+            supported = False
+            break
+        _, _, _, tbl, typ, val, jsn = record
+        los.append(lo.toordinal())
+        his.append(hi.toordinal())
+        if event_type_interner is not None:
+            typs.append(table.code(event_type_interner.code(tbl, typ)))
+        else:
+            typs.append(table.record_code(tbl, typ))
+        values.append(_no_value if val is None and jsn is None
+                      else (val, jsn))
+    if not supported:
+        facts, events = event_data.separate_fact_event_records(
+            records, field_name2idx)
+        event_constructor = (event_type_interner.event_from_record
+                             if event_type_interner is not None
+                             else event_data.event_from_record)
+        return esal.EventSequence(
+            (event_constructor(e) for e in events),
+            dict(fact_constructor(f) for f in facts).items(), rec_id)
+    facts = dict(fact_constructor(f) for f in facts)
+    return CompactEventSequence._sorted(
+        rec_id, facts, table, los, his, typs, values)
+
+
+# Tests
+
+
+class CompactEventSequenceTest(unittest.TestCase):
+
+    records = [
+        [1, None, None, 'bx', 'dob', '1950-01-01', None],
+        [1, datetime.date(2000, 3, 1), datetime.date(2000, 3, 31), 'rx',
+         10, None, {'days_supply': 30}],
+        [1, datetime.date(2000, 1, 1), None, 'dx', 5, None, None],
+        [1, datetime.date(2000, 4, 10), datetime.date(2000, 5, 9), 'rx',
+         10, None, None],
+        [1, datetime.date(2000, 2, 1), datetime.date(2000, 2, 1), 'mx', 7,
+         1.5, None],
+        [1, datetime.date(2000, 3, 1), datetime.date(2000, 3, 1), 'dx', 5,
+         None, None],
+        [1, datetime.date(2001, 1, 1), datetime.date(2001, 1, 1), 'dx', 6,
+         None, None],
+    ]
+
+    def setUp(self):
+        self.compact = from_records(1, self.records)
+        self.esal = event_data.event_sequence_from_records(1, self.records)
+
+    def assertSameEvents(self, expected, actual):
+        self.assertEqual(
+            sorted(((e.when.lo, e.when.hi), e.type, e.value)
+                   for e in expected),
+            sorted(((e.when.lo, e.when.hi), e.type, e.value)
+                   for e in actual))
+        self.assertEqual([(e.when.lo, e.when.hi) for e in actual],
+                         sorted((e.when.lo, e.when.hi) for e in actual))
+
+    def test_sequence(self):
+        self.assertIsInstance(self.compact, CompactEventSequence)
+        self.assertEqual(len(self.esal), len(self.compact))
+        self.assertSameEvents(self.esal, self.compact)
+        self.assertEqual(self.esal.facts(), self.compact.facts())
+        self.assertEqual(datetime.date(2000, 1, 1), self.compact[0].when.lo)
+        self.assertTrue(self.compact.has_type(('dx', 5)))
+        self.assertFalse(self.compact.has_type(('dx', 9)))
+        self.assertEqual(2, self.compact.n_events_of_type(('rx', 10)))
+        self.assertEqual((datetime.date(2000, 1, 1),
+                          datetime.date(2001, 1, 1)),
+                         self.compact.date_bounds())
+
+    def test_events_overlapping(self):
+        days = [datetime.date(2000, 1, 1) + datetime.timedelta(d)
+                for d in range(0, 400, 7)]
+        for lo, hi in zip(days, days[3:]):
+            for is_lo_open in (False, True):
+                for is_hi_open in (False, True):
+                    expected = [
+                        idx for (idx, e) in enumerate(self.compact)
+                        if ((e.when.hi > lo) if is_lo_open
+                            else (e.when.hi >= lo)) and
+                        ((e.when.lo < hi) if is_hi_open
+                         else (e.when.lo <= hi))]
+                    self.assertEqual(
+                        expected, self.compact.events_overlapping(
+                            lo, hi, is_lo_open, is_hi_open))
+
+    def test_steps(self):
+        type2type = {('rx', 10): 'exp', ('dx', 5): 'out'}
+        seq = self.compact.map_event_types(type2type)
+        self.assertEqual(len(self.compact) + 4, len(seq))
+        self.assertEqual(
+            2, self.compact.map_event_types(type2type, True)
+            .n_events_of_type('out'))
+        eras = seq.make_eras(('exp', 'out'), datetime.timedelta(10))
+        self.assertEqual(
+            [(datetime.date(2000, 3, 1), datetime.date(2000, 5, 9))],
+            [(e.when.lo, e.when.hi) for e in eras if e.type == 'exp'])
+        self.assertEqual(2, eras.n_events_of_type('out'))
+        # Transitions
+        txs = list(eras.transitions('exp', 'out'))
+        self.assertEqual(
+            [datetime.date(2000, 1, 1), datetime.date(2000, 3, 1),
+             datetime.date(2000, 5, 9)],
+            [tx[0] for tx in txs])
+        self.assertEqual(([], [], ['out']),
+                         tuple([e.type for e in l] for l in txs[0][1:]))
+        self.assertEqual((['exp'], [], ['out']),
+                         tuple([e.type for e in l] for l in txs[1][1:]))
+        # Limit to dates
+        limited = eras.limit_to_dates(
+            datetime.date(2000, 4, 1), datetime.date(2000, 12, 31))
+        self.assertEqual(
+            [((2000, 4, 1), (2000, 4, 1), ('study', 'lo')),
+             ((2000, 4, 1), (2000, 5, 9), 'exp'),
+             ((2000, 4, 10), (2000, 5, 9), ('rx', 10)),
+             ((2000, 12, 31), (2000, 12, 31), ('study', 'hi'))],
+            [(e.when.lo.timetuple()[:3], e.when.hi.timetuple()[:3], e.type)
+             for e in limited])
+        # Truncate at the first outcome (which is at the start)
+        self.assertIs(seq, seq.truncate_at_first_outcome('out'))
+        seq = seq.subsequence(range(2, len(seq)))
+        trunc = seq.truncate_at_first_outcome(
+            'out', ('exp', 'out'), datetime.timedelta(20))
+        self.assertEqual(
+            datetime.date(2000, 3, 1), max(e.when.lo for e in trunc))
+
+    def test_copy(self):
+        copy = self.compact.copy(events=list(self.esal)[:2])
+        self.assertIsInstance(copy, CompactEventSequence)
+        self.assertSameEvents(list(self.esal)[:2], copy)
+        # Unsupported events make an `esal.EventSequence`
+        copy = self.compact.copy(events=[esal.Event(esal.Interval(1, 2), 'a')])
+        self.assertNotIsInstance(copy, CompactEventSequence)
@@ -0,0 +1,332 @@
+"""Expand concepts into their descendants using a precomputed closure"""
+
+# Copyright (c) 2019 Aubrey Barnard.  This is free software released
+# under the MIT License (https://choosealicense.com/licenses/mit/).
+
+# Exposures and outcomes are often "ingredient X and everything that
+# contains it" or "condition Y and all its subtypes", which means all
+# the descendants of some seed concepts in the `concept_ancestor` table
+# of the CDM vocabulary.  Querying that table for every cohort is slow,
+# so this module reads it once into a closure cache, a directory of
+# binary arrays in compressed sparse row (CSR) form:
+#
+# * `ancestors.bin`: sorted IDs of the concepts that have descendants
+#   (int64)
+# * `offsets.bin`: offsets into `descendants.bin` (uint64, one more than
+#   the number of ancestors).  The descendants of `ancestors[i]` are
+#   `descendants[offsets[i]:offsets[i + 1]]`.
+# * `descendants.bin`: sorted IDs of descendants (int64)
+# * `concepts.bin`: sorted IDs of all concepts (int64)
+# * `domains.bin`: index into the interned domains of each concept in
+#   `concepts.bin` (uint8)
+#
+# The interned domains are stored in `meta.json` (along with the byte
+# order).  The arrays are memory mapped, so loading a cache is
+# immediate and an expansion only reads the relevant parts.
+#
+# Expanding writes `(tbl, id)` pairs (like `concept2id.sh`) that can be
+# used directly as exposure or outcome types.  Usage:
+#
+#     python3 concept_closure.py build_cache <vocab-db> <cache-dir>
+#     python3 concept_closure.py expand <cache-dir> <seeds-file> > ids.x.csv
+#
+# where the seeds file has one `tbl|id` pair or ID per line (such as
+# the output of `concept2id.sh`).
+
+
+import array
+import bisect
+import io
+import json
+import mmap
+import pathlib
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from barnapy import logging
+
+# "Install" related modules by updating import path
+this_dir = pathlib.Path(__file__).absolute().parent
+sys.path.append(str(this_dir))
+
+import concept_search
+
+
+format_version = 1
+
+meta_filename = 'meta.json'
+
+# Array name -> array type code
+arrays = {
+    'ancestors': 'q',
+    'offsets': 'Q',
+    'descendants': 'q',
+    'concepts': 'q',
+    'domains': 'B',
+}
+
+
+def build_cache(vocab_db, cache_dir, chunk_size=1000000):
+    """
+    Build a closure cache in the given directory from the
+    `concept_ancestor` and `concept` tables of the given vocabulary
+    database.  Return the number of ancestor-descendant pairs.
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Remove any existing metadata so that an incomplete cache is not
+    # recognized as a cache
+    (cache_dir / meta_filename).unlink(missing_ok=True)
+    logger = logging.getLogger(__name__)
+    logger.info('Building closure cache: {}', cache_dir)
+    files = {name: open(cache_dir / (name + '.bin'), 'wb')
+             for name in arrays}
+    chunks = {name: array.array(code) for (name, code) in arrays.items()}
+    def flush():
+        for name, arr in chunks.items():
+            arr.tofile(files[name])
+            del arr[:]
+    db = sqlite3.connect(concept_search._read_only_uri(vocab_db), uri=True)
+    domains = []
+    domain2idx = {}
+    n_pairs = 0
+    try:
+        # Offsets start with zero
+        chunks['offsets'].append(0)
+        prev_anc = None
+        for (anc_id, dsc_id) in db.execute(
+                'select ancestor_concept_id, descendant_concept_id '
+                'from concept_ancestor '
+                'order by ancestor_concept_id, descendant_concept_id'):
+            if anc_id != prev_anc:
+                if prev_anc is not None:
+                    chunks['offsets'].append(n_pairs)
+                chunks['ancestors'].append(anc_id)
+                prev_anc = anc_id
+            chunks['descendants'].append(dsc_id)
+            n_pairs += 1
+            if n_pairs % chunk_size == 0:
+                flush()
+        if prev_anc is not None:
+            chunks['offsets'].append(n_pairs)
+        for (n_concepts, (cpt_id, domain)) in enumerate(db.execute(
+                'select concept_id, domain_id from concept '
+                'order by concept_id'), start=1):
+            idx = domain2idx.get(domain)
+            if idx is None:
+                idx = len(domains)
+                domains.append(domain)
+                domain2idx[domain] = idx
+            chunks['concepts'].append(cpt_id)
+            chunks['domains'].append(idx)
+            if n_concepts % chunk_size == 0:
+                flush()
+        flush()
+    finally:
+        db.close()
+        for file in files.values():
+            file.close()
+    # Write the metadata last
+    meta = dict(
+        version=format_version,
+        byteorder=sys.byteorder,
+        n_pairs=n_pairs,
+        arrays=arrays,
+        domains=domains,
+    )
+    with open(cache_dir / meta_filename, 'wt') as file:
+        json.dump(meta, file)
+    logger.info('Built closure cache of {} pairs: {}', n_pairs, cache_dir)
+    return n_pairs
+
+
+class ClosureCache:
+    """Read-only access to a closure cache."""
+
+    def __init__(self, cache_dir):
+        self.path = pathlib.Path(cache_dir)
+        with open(self.path / meta_filename, 'rt') as file:
+            meta = json.load(file)
+        if meta['version'] != format_version:
+            raise ValueError(
+                'Unsupported closure cache version: {}'.format(
+                    meta['version']))
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(
+                'Closure cache has byte order {!r} but this machine has '
+                '{!r}'.format(meta['byteorder'], sys.byteorder))
+        self.domains = meta['domains']
+        self._mmaps = []
+        self.arrays = {name: self._map(name + '.bin', code)
+                       for (name, code) in arrays.items()}
+
+    def _map(self, filename, type_code):
+        with open(self.path / filename, 'rb') as file:
+            # Empty files cannot be memory mapped
+            if file.seek(0, 2) == 0:
+                return memoryview(array.array(type_code))
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(mm)
+        return memoryview(mm).cast(type_code)
+
+    def close(self):
+        for arr in self.arrays.values():
+            arr.release()
+        for mm in self._mmaps:
+            mm.close()
+        self._mmaps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def descendants(self, concept_id):
+        """
+        Return the descendants of the given concept (which include the
+        concept itself if the vocabulary says so).
+        """
+        ancestors = self.arrays['ancestors']
+        idx = bisect.bisect_left(ancestors, concept_id)
+        if idx == len(ancestors) or ancestors[idx] != concept_id:
+            return []
+        offsets = self.arrays['offsets']
+        return self.arrays['descendants'][
+            offsets[idx]:offsets[idx + 1]].tolist()
+
+    def domain(self, concept_id):
+        """Return the domain of the given concept or `None` if unknown."""
+        concepts = self.arrays['concepts']
+        idx = bisect.bisect_left(concepts, concept_id)
+        if idx == len(concepts) or concepts[idx] != concept_id:
+            return None
+        return self.domains[self.arrays['domains'][idx]]
+
+    def expand(self, seeds, include_seeds=True):
+        """
+        Return the sorted, unique `(tbl, id)` pairs of the descendants of
+        the given seeds.  Seeds are `(tbl, id)` pairs or IDs.  The table
+        of a descendant is determined by its domain (like
+        `concept2id.sh`) or else is the table of its seed.
+        """
+        pairs = set()
+        for seed in seeds:
+            if isinstance(seed, tuple):
+                seed_tbl, seed_id = seed
+            else:
+                seed_tbl, seed_id = None, seed
+            cpt_ids = list(self.descendants(seed_id))
+            if include_seeds:
+                cpt_ids.append(seed_id)
+            for cpt_id in cpt_ids:
+                domain = self.domain(cpt_id)
+                tbl = (concept_search.domain2table.get(domain, domain)
+                       if domain is not None
+                       else seed_tbl)
+                pairs.add((tbl, cpt_id))
+        return sorted(pairs, key=lambda p: ('' if p[0] is None else p[0],
+                                            p[1]))
+
+
+def read_seeds(file, comment_char='#', delimiter='|'):
+    """
+    Read seeds from the given file of `tbl|id` pairs or IDs (one per
+    line) and return them as a list.
+    """
+    if not isinstance(file, io.IOBase):
+        file = open(file, 'rt')
+    seeds = []
+    with file as lines:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(comment_char):
+                continue
+            if delimiter in line:
+                tbl, cpt_id = line.split(delimiter, 1)
+                seeds.append((tbl or None, int(cpt_id)))
+            else:
+                seeds.append(int(line))
+    return seeds
+
+
+# Command line
+
+
+def expand(cache_dir, seeds_file, include_seeds='true'):
+    """Write the `(tbl, id)` pairs of the descendants of the given seeds."""
+    include_seeds = include_seeds.lower() in ('true', 'yes', '1')
+    with ClosureCache(cache_dir) as cache:
+        pairs = cache.expand(read_seeds(seeds_file), include_seeds)
+    concept_search.write_rows(
+        (('' if tbl is None else tbl, cpt_id) for (tbl, cpt_id) in pairs))
+
+
+def cli(function_name, *args):
+    """
+    Call the given function from this module with the given string
+    arguments.
+    """
+    globals()[function_name](*args)
+
+
+# Tests
+
+
+class ClosureCacheTest(unittest.TestCase):
+
+    # Ingredient 1 is in drugs 10 and 11.  Drug 11 has packs 20 and 21.
+    # Condition 5 has subtype 6 which has subtype 7.
+    concepts = [(1, 'Drug'), (10, 'Drug'), (11, 'Drug'), (20, 'Drug'),
+                (21, 'Drug'), (5, 'Condition'), (6, 'Condition'),
+                (7, 'Condition'), (8, 'Observation')]
+    pairs = [(1, 1), (1, 10), (1, 11), (1, 20), (1, 21), (10, 10),
+             (11, 11), (11, 20), (11, 21), (20, 20), (21, 21), (5, 5),
+             (5, 6), (5, 7), (6, 6), (6, 7), (7, 7)]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = pathlib.Path(self.tmp_dir.name)
+        self.vocab_db = tmp_path / 'vocab.sqlite'
+        db = sqlite3.connect(str(self.vocab_db))
+        db.execute('create table concept '
+                   '(concept_id int primary key, domain_id text)')
+        db.execute('create table concept_ancestor '
+                   '(ancestor_concept_id int, descendant_concept_id int)')
+        db.executemany('insert into concept values (?, ?)', self.concepts)
+        db.executemany('insert into concept_ancestor values (?, ?)',
+                       self.pairs)
+        db.commit()
+        db.close()
+        self.cache_dir = tmp_path / 'closure'
+        build_cache(self.vocab_db, self.cache_dir, chunk_size=4)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_descendants(self):
+        with ClosureCache(self.cache_dir) as cache:
+            for anc_id in range(25):
+                expected = sorted(d for (a, d) in self.pairs if a == anc_id)
+                self.assertEqual(expected, list(cache.descendants(anc_id)))
+            self.assertEqual('Condition', cache.domain(6))
+            self.assertIsNone(cache.domain(9))
+
+    def test_expand(self):
+        seeds = read_seeds(io.StringIO('# Seeds\nrx|11\n6\ndx|99\n'))
+        self.assertEqual([('rx', 11), 6, ('dx', 99)], seeds)
+        with ClosureCache(self.cache_dir) as cache:
+            self.assertEqual(
+                [('dx', 6), ('dx', 7), ('dx', 99), ('rx', 11), ('rx', 20),
+                 ('rx', 21)],
+                cache.expand(seeds))
+            # The vocabulary includes concepts in their own descendants
+            self.assertEqual([('dx', 6), ('dx', 7)],
+                             cache.expand([6, 99], include_seeds=False))
+
+
+if __name__ == '__main__':
+    logging.default_config()
+    cli(*sys.argv[1:])
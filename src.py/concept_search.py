@@ -0,0 +1,437 @@
+"""Search the CDM vocabulary for concepts by name using an index"""
+
+# Copyright (c) 2019 Aubrey Barnard.  This is free software released
+# under the MIT License (https://choosealicense.com/licenses/mit/).
+
+# The `src.bash/concept.*.raw.csv.sh` scripts select concepts with many
+# `concept_name like '%...%'` predicates, each of which scans the whole
+# `concept` table.  Instead, this module builds (once) a full text index
+# of concept names using the FTS5 trigram tokenizer of SQLite and keeps
+# it in its own database next to the vocabulary database.  A trigram
+# index answers `like` patterns that contain at least three consecutive
+# literal characters without scanning, so finding the candidates for
+# every synonym is fast.  The candidates are then checked against the
+# original predicates in the `concept` table, so the results are exactly
+# those of the scan.  (If the trigram tokenizer is not available, or
+# `use_index` is false, the `concept` table is scanned as before.)
+#
+# A search is specified by a file of lines of the form `<keyword>
+# <argument>` where the keywords are:
+#
+# * `include`: pattern of concept names to include
+# * `exclude`: pattern of concept names to exclude (false positives)
+# * `domain`: domain ID to include (all domains if none)
+# * `exclude_class`: concept class ID to exclude
+#
+# Patterns are SQL `like` patterns (and so are case insensitive).
+# Patterns without `%` match anywhere in the name.  Blank lines and
+# comments (lines starting with `#`) are ignored.  For example, the
+# metformin search is:
+#
+#     domain Drug
+#     exclude_class Drug Interaction
+#     include metformin
+#     include glucophage
+#     ...
+#     exclude cobimetinib
+#
+# Usage:
+#
+#     python3 concept_search.py build_index <vocab-db> [<index-db>]
+#     python3 concept_search.py search <vocab-db> <search-spec> > concept.x.raw.csv
+#     python3 concept_search.py search_ids <vocab-db> <search-spec>
+#     python3 concept_search.py csv_ids concept.x.selected.csv
+#
+# `search` writes concepts in the same format as the scripts (the
+# `sqlite3` list format) and `csv_ids` writes `(tbl, id)` pairs in the
+# same format as `concept2id.sh`.  The index is built automatically if
+# it does not exist or if the vocabulary database has changed.
+
+
+import io
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from barnapy import logging
+
+
+index_format_version = 1
+
+# Domain ID -> EMR table (as in `concept2id.sh`)
+domain2table = {
+    'Condition': 'dx',
+    'Drug': 'rx',
+    'Meas Value': 'mx',
+    'Measurement': 'mx',
+    'Observation': 'ox',
+    'Procedure': 'px',
+}
+
+spec_keywords = ('include', 'exclude', 'domain', 'exclude_class')
+
+
+# Indexing
+
+
+def index_path(vocab_db, index_file=None):
+    """Return the path of the index of the given vocabulary database."""
+    if index_file is not None:
+        return pathlib.Path(index_file)
+    vocab_db = pathlib.Path(vocab_db)
+    return vocab_db.with_name(vocab_db.name + '.concept_index.sqlite')
+
+
+def _read_only_uri(path):
+    return pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+
+
+def _vocab_signature(vocab_db):
+    stat = os.stat(vocab_db)
+    return dict(version=index_format_version, size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns)
+
+
+def has_trigram_tokenizer():
+    """Return whether this SQLite supports the FTS5 trigram tokenizer."""
+    db = sqlite3.connect(':memory:')
+    try:
+        db.execute('create virtual table t using fts5(x, tokenize=trigram)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        db.close()
+
+
+def is_index_current(vocab_db, index_file=None):
+    """
+    Return whether the index of the given vocabulary database exists and
+    was built from its current contents.
+    """
+    path = index_path(vocab_db, index_file)
+    if not path.exists():
+        return False
+    db = sqlite3.connect(_read_only_uri(path), uri=True)
+    try:
+        meta = dict(db.execute('select key, value from meta'))
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        db.close()
+    return meta == _vocab_signature(vocab_db)
+
+
+def build_index(vocab_db, index_file=None):
+    """
+    Build a trigram index of the concept names in the given vocabulary
+    database.  Return the path of the index.
+    """
+    logger = logging.getLogger(__name__)
+    path = index_path(vocab_db, index_file)
+    logger.info('Building concept index: {}', path)
+    # Build in a temporary file and then replace the index so that an
+    # interrupted build does not leave a partial index
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+    signature = _vocab_signature(vocab_db)
+    db = sqlite3.connect(tmp_path.absolute().as_uri(), uri=True)
+    try:
+        db.execute('attach database ? as vocab', (_read_only_uri(vocab_db),))
+        db.execute('create virtual table concept_names '
+                   'using fts5(concept_name, tokenize=trigram)')
+        db.execute('insert into concept_names (rowid, concept_name) '
+                   'select concept_id, concept_name from vocab.concept')
+        db.execute('create table meta (key text primary key, value)')
+        db.executemany('insert into meta values (?, ?)', signature.items())
+        db.commit()
+        n_concepts = db.execute(
+            'select count(*) from concept_names').fetchone()[0]
+    finally:
+        db.close()
+    os.replace(tmp_path, path)
+    logger.info('Indexed {} concepts', n_concepts)
+    return path
+
+
+# Searching
+
+
+def read_search_spec(file):
+    """
+    Read a search specification (see above) from the given file and
+    return it as a dictionary of lists keyed by keyword.
+    """
+    if isinstance(file, (str, pathlib.Path)):
+        with open(file, 'rt') as text_file:
+            return read_search_spec(text_file)
+    spec = {keyword: [] for keyword in spec_keywords}
+    for (line_num, line) in enumerate(file, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        keyword, _, argument = line.partition(' ')
+        argument = argument.strip()
+        if keyword not in spec or not argument:
+            raise ValueError(
+                'Bad search specification line {}: {!r}.  Expected '
+                '`<keyword> <argument>` where the keyword is one of: {}'
+                .format(line_num, line, ', '.join(spec_keywords)))
+        spec[keyword].append(argument)
+    return spec
+
+
+def _like_pattern(pattern):
+    return pattern if '%' in pattern else '%' + pattern + '%'
+
+
+def _search_query(include, exclude, domains, exclude_classes, candidates):
+    # Build the query and its parameters.  This is the query of the
+    # scripts (plus the candidates, if any).
+    conditions = []
+    params = []
+    if candidates is not None:
+        conditions.append('concept_id in (select value from json_each(?))')
+        params.append(json.dumps(candidates))
+    if domains:
+        conditions.append('domain_id in ({})'.format(
+            ', '.join('?' * len(domains))))
+        params.extend(domains)
+    if exclude_classes:
+        conditions.append('concept_class_id not in ({})'.format(
+            ', '.join('?' * len(exclude_classes))))
+        params.extend(exclude_classes)
+    conditions.append('({})'.format(
+        ' or '.join(['concept_name like ?'] * len(include))))
+    params.extend(include)
+    for pattern in exclude:
+        conditions.append('concept_name not like ?')
+        params.append(pattern)
+    query = ('select * from concept where {} '
+             'order by domain_id, vocabulary_id, concept_id'.format(
+                 ' and '.join(conditions)))
+    return query, params
+
+
+def search_concepts(
+        vocab_db,
+        include_patterns,
+        exclude_patterns=(),
+        domain_ids=(),
+        exclude_concept_class_ids=(),
+        index_file=None,
+        use_index=True,
+):
+    """
+    Return the header and rows of the concepts whose names match any of
+    the include patterns and none of the exclude patterns (and that are
+    in the given domains and not in the given concept classes).
+
+    Uses (and builds if needed) the index of concept names unless
+    `use_index` is false or the trigram tokenizer is not available.
+    """
+    include = [_like_pattern(p) for p in include_patterns]
+    exclude = [_like_pattern(p) for p in exclude_patterns]
+    if not include:
+        raise ValueError('No patterns of concept names to include')
+    use_index = use_index and has_trigram_tokenizer()
+    if use_index and not is_index_current(vocab_db, index_file):
+        build_index(vocab_db, index_file)
+    db = sqlite3.connect(_read_only_uri(vocab_db), uri=True)
+    try:
+        candidates = None
+        if use_index:
+            db.execute('attach database ? as idx', (
+                _read_only_uri(index_path(vocab_db, index_file)),))
+            # Gather the candidates for each pattern using the index
+            candidates = set()
+            for pattern in include:
+                candidates.update(row[0] for row in db.execute(
+                    'select rowid from idx.concept_names '
+                    'where concept_name like ?', (pattern,)))
+            candidates = sorted(candidates)
+        query, params = _search_query(
+            include, exclude, list(domain_ids),
+            list(exclude_concept_class_ids), candidates)
+        cursor = db.execute(query, params)
+        header = [col[0] for col in cursor.description]
+        rows = cursor.fetchall()
+    finally:
+        db.close()
+    return header, rows
+
+
+def search_concepts_by_spec(vocab_db, spec, index_file=None, use_index=True):
+    """Search for concepts according to the given search specification."""
+    return search_concepts(
+        vocab_db,
+        spec['include'],
+        spec['exclude'],
+        spec['domain'],
+        spec['exclude_class'],
+        index_file=index_file,
+        use_index=use_index,
+    )
+
+
+def concept_ids(header, rows):
+    """
+    Return the sorted, unique `(tbl, id)` pairs of the given concepts,
+    mapping domains to EMR tables like `concept2id.sh`.
+    """
+    id_idx = header.index('concept_id')
+    dmn_idx = header.index('domain_id')
+    pairs = set()
+    for row in rows:
+        domain = row[dmn_idx]
+        pairs.add((domain2table.get(domain, domain), int(row[id_idx])))
+    return sorted(pairs)
+
+
+def write_rows(rows, output=sys.stdout, delimiter='|'):
+    """Write the given rows in the `sqlite3` list format."""
+    for row in rows:
+        output.write(delimiter.join(
+            '' if value is None else str(value) for value in row))
+        output.write('\n')
+
+
+# Command line
+
+
+def search(vocab_db, spec_file, index_file=None):
+    """Write the concepts found by the given search specification."""
+    header, rows = search_concepts_by_spec(
+        vocab_db, read_search_spec(spec_file), index_file)
+    write_rows(rows)
+
+
+def search_ids(vocab_db, spec_file, index_file=None):
+    """Write the `(tbl, id)` pairs found by the given search specification."""
+    header, rows = search_concepts_by_spec(
+        vocab_db, read_search_spec(spec_file), index_file)
+    write_rows(concept_ids(header, rows))
+
+
+def csv_ids(concepts_csv):
+    """
+    Write the `(tbl, id)` pairs of the concepts in the given file of
+    concepts (e.g. as edited by hand).  Same as `concept2id.sh`.
+    """
+    rows = []
+    with open(concepts_csv, 'rt') as file:
+        for line in file:
+            line = line.rstrip('\n')
+            if line:
+                fields = line.split('|')
+                rows.append((fields[0], fields[2]))
+    write_rows(concept_ids(['concept_id', 'domain_id'], rows))
+
+
+def cli(function_name, *args):
+    """
+    Call the given function from this module with the given string
+    arguments.
+    """
+    globals()[function_name](*args)
+
+
+# Tests
+
+
+class ConceptSearchTest(unittest.TestCase):
+
+    concepts = [
+        (1503297, 'metformin', 'Drug', 'RxNorm', 'Ingredient'),
+        (1503298, 'Metformin 500 MG Oral Tablet', 'Drug', 'RxNorm',
+         'Clinical Drug'),
+        (40163924, 'Glucophage XR', 'Drug', 'RxNorm', 'Branded Drug'),
+        (43526465, 'cobimetinib', 'Drug', 'RxNorm', 'Ingredient'),
+        (45775136, 'metformin / sitagliptin', 'Drug', 'RxNorm',
+         'Drug Interaction'),
+        (4329847, 'Myocardial infarction', 'Condition', 'SNOMED',
+         'Clinical Finding'),
+        (312327, 'Acute myocardial infarction', 'Condition', 'SNOMED',
+         'Clinical Finding'),
+        (3000330, 'Metformin level', 'Measurement', 'LOINC',
+         'Lab Test'),
+        (2, None, 'Drug', 'RxNorm', None),
+        (3, 'MI', 'Condition', 'SNOMED', 'Clinical Finding'),
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.vocab_db = pathlib.Path(self.tmp_dir.name) / 'vocab.sqlite'
+        db = sqlite3.connect(str(self.vocab_db))
+        db.execute('create table concept (concept_id int primary key, '
+                   'concept_name text, domain_id text, vocabulary_id text, '
+                   'concept_class_id text)')
+        db.executemany('insert into concept values (?, ?, ?, ?, ?)',
+                       self.concepts)
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_search__same_as_scan(self):
+        searches = [
+            dict(include_patterns=['metformin', 'glucophage'],
+                 exclude_patterns=['cobimetinib'],
+                 domain_ids=['Drug'],
+                 exclude_concept_class_ids=['Drug Interaction']),
+            dict(include_patterns=['met']),
+            dict(include_patterns=['%myocardial%infarction%', 'mi']),
+            dict(include_patterns=['%']),
+            dict(include_patterns=['xyz']),
+        ]
+        for kwargs in searches:
+            expected = search_concepts(self.vocab_db, use_index=False,
+                                       **kwargs)
+            actual = search_concepts(self.vocab_db, **kwargs)
+            self.assertEqual(expected, actual, kwargs)
+        self.assertEqual(
+            [1503297, 1503298, 40163924],
+            [row[0] for row in search_concepts(
+                self.vocab_db, **searches[0])[1]])
+
+    def test_index_reused_and_rebuilt(self):
+        if not has_trigram_tokenizer():
+            self.skipTest('No FTS5 trigram tokenizer')
+        self.assertFalse(is_index_current(self.vocab_db))
+        search_concepts(self.vocab_db, ['metformin'])
+        self.assertTrue(is_index_current(self.vocab_db))
+        # Changing the vocabulary invalidates the index
+        db = sqlite3.connect(str(self.vocab_db))
+        db.execute("insert into concept values "
+                   "(4, 'riomet', 'Drug', 'RxNorm', 'Branded Drug')")
+        db.commit()
+        db.close()
+        self.assertFalse(is_index_current(self.vocab_db))
+        header, rows = search_concepts(self.vocab_db, ['riomet'])
+        self.assertEqual([4], [row[0] for row in rows])
+
+    def test_spec_and_ids(self):
+        spec = read_search_spec(io.StringIO('''
+# Metformin
+domain Drug
+domain Measurement
+exclude_class Drug Interaction
+include metformin
+exclude cobimetinib
+'''))
+        header, rows = search_concepts_by_spec(self.vocab_db, spec)
+        self.assertEqual([('mx', 3000330), ('rx', 1503297), ('rx', 1503298)],
+                         concept_ids(header, rows))
+        with self.assertRaises(ValueError):
+            read_search_spec(io.StringIO('includes metformin\n'))
+
+
+if __name__ == '__main__':
+    logging.default_config()
+    cli(*sys.argv[1:])
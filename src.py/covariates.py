@@ -0,0 +1,303 @@
+"""
+Time-varying covariates computed incrementally over a sequence of
+intervals
+"""
+
+# Copyright (c) 2019 Aubrey Barnard.
+#
+# This is free software released under the MIT License
+# (https://choosealicense.com/licenses/mit/).
+
+
+# Covariates are specified declaratively as `(kind, key)` pairs where
+# `kind` is one of the following and `key` is an event type (or a fact
+# key for facts).  The value of each covariate is computed from the
+# events that overlap the interval of an example.
+#
+# * `count`: number of events of the type
+# * `has`: whether there are any events of the type (1 or 0)
+# * `first_value`: value of the first event of the type (or `None`)
+# * `last_value`: value of the last event of the type (or `None`)
+# * `fact`: value of the fact (constant over all intervals)
+#
+# First and last are in sequence order.  The value of an event or fact
+# is the first element of a `(val, jsn)` pair (as constructed by
+# `event_data`) and otherwise the whole value.
+#
+# Rather than searching for the events in each interval,
+# `CovariateSweep` sweeps over the events once, adding events as the
+# intervals reach their starts and removing events as the intervals
+# pass their ends, and updating the running covariate values as it
+# goes.  Thus the cost is proportional to the number of events plus
+# the number of intervals times the number of covariates.
+
+
+import datetime
+import heapq
+import unittest
+
+import esal
+
+
+kinds = ('count', 'has', 'first_value', 'last_value', 'fact')
+
+_event_kinds = ('count', 'has', 'first_value', 'last_value')
+
+
+def check_specs(specs):
+    """Check the given covariate specifications and return them as a list."""
+    specs = list(specs)
+    for spec in specs:
+        if len(spec) != 2 or spec[0] not in kinds:
+            raise ValueError(
+                'Bad covariate specification: {!r}.  Kind must be one '
+                'of: {}'.format(spec, ', '.join(kinds)))
+    return specs
+
+
+def value_of(value):
+    """Return the `val` of a `(val, jsn)` pair or else the whole value."""
+    if isinstance(value, tuple) and len(value) == 2:
+        return value[0]
+    return value
+
+
+def covariates_of_sequence(event_sequence, specs):
+    """
+    Return the values of the given covariates for all the events in the
+    given event sequence.
+
+    This computes the covariates directly (non-incrementally) and so
+    defines their meaning.
+    """
+    values = []
+    for kind, key in specs:
+        if kind == 'fact':
+            values.append(value_of(event_sequence.fact(key)))
+            continue
+        evs = [ev for ev in event_sequence if ev.type == key]
+        if kind == 'count':
+            values.append(len(evs))
+        elif kind == 'has':
+            values.append(int(len(evs) > 0))
+        elif kind == 'first_value':
+            values.append(value_of(evs[0].value) if evs else None)
+        elif kind == 'last_value':
+            values.append(value_of(evs[-1].value) if evs else None)
+    return values
+
+
+class CovariateSweep:
+    """
+    Computes covariates for a sequence of intervals from the events of
+    an event sequence that overlap each interval.
+
+    The intervals must be given in order such that neither their lows
+    nor their highs decrease, as is the case for the examples generated
+    by `survival_data.examples_from_transitions`.
+    """
+
+    def __init__(self, event_sequence, specs):
+        self.event_sequence = event_sequence
+        self.specs = check_specs(specs)
+        self._keys = set(key for (kind, key) in self.specs
+                         if kind in _event_kinds)
+        # Facts are constant
+        self._facts = {key: value_of(event_sequence.fact(key))
+                       for (kind, key) in self.specs if kind == 'fact'}
+        # Indices and bounds of the relevant events in order of their
+        # starts
+        self._idxs = []
+        self._los = []
+        self._his = []
+        self._supported = True
+        for idx, event in enumerate(event_sequence):
+            when = event.when
+            if not isinstance(when, esal.Interval):
+                self._supported = False
+                break
+            if self._los and when.lo < self._los[-1]:
+                self._supported = False
+                break
+            if event.type in self._keys:
+                self._idxs.append(idx)
+                self._los.append(when.lo)
+                self._his.append(when.hi)
+        # Running state
+        self._next = 0 # Next event to add (index into `_idxs`)
+        self._ends = [] # Heap of (hi, idx) of active events
+        self._active = set() # Indices of active events
+        self._counts = {key: 0 for key in self._keys}
+        self._firsts = {key: [] for key in self._keys} # Heaps of idx
+        self._lasts = {key: [] for key in self._keys} # Heaps of -idx
+        self._prev_lo = None
+        self._prev_hi = None
+
+    def _advance(self, lo, hi):
+        # Check the order of intervals
+        if self._prev_lo is not None and (
+                lo < self._prev_lo or hi < self._prev_hi):
+            raise ValueError(
+                'Intervals out of order: ({}, {}) after ({}, {})'.format(
+                    lo, hi, self._prev_lo, self._prev_hi))
+        self._prev_lo = lo
+        self._prev_hi = hi
+        evs = self.event_sequence
+        # Add events that start no later than the end of the interval
+        while (self._next < len(self._idxs) and
+               self._los[self._next] <= hi):
+            idx = self._idxs[self._next]
+            key = evs[idx].type
+            heapq.heappush(self._ends, (self._his[self._next], idx))
+            self._active.add(idx)
+            self._counts[key] += 1
+            heapq.heappush(self._firsts[key], idx)
+            heapq.heappush(self._lasts[key], -idx)
+            self._next += 1
+        # Remove events that end before the start of the interval
+        while self._ends and self._ends[0][0] < lo:
+            _, idx = heapq.heappop(self._ends)
+            self._active.remove(idx)
+            self._counts[evs[idx].type] -= 1
+
+    def _excluded(self, itvl):
+        # Return the indices of the active events that touch the bounds
+        # of the interval but do not overlap it (depending on whether
+        # the bounds are open).  Events strictly inside the bounds
+        # always overlap.
+        evs = self.event_sequence
+        excluded = set()
+        # The events that end at the start of the interval are at the
+        # top of the heap of ends, so search only the top of the heap
+        ends = self._ends
+        stack = [0] if ends else []
+        while stack:
+            pos = stack.pop()
+            hi, idx = ends[pos]
+            if hi == itvl.lo:
+                if not evs[idx].when.intersects(itvl):
+                    excluded.add(idx)
+                stack.extend(child for child in (2 * pos + 1, 2 * pos + 2)
+                             if child < len(ends))
+        pos = self._next - 1
+        while pos >= 0 and self._los[pos] == itvl.hi:
+            idx = self._idxs[pos]
+            if idx in self._active and not evs[idx].when.intersects(itvl):
+                excluded.add(idx)
+            pos -= 1
+        return excluded
+
+    def _extreme(self, heap, sign, excluded):
+        # Return the smallest (`sign == 1`) or largest (`sign == -1`)
+        # active index in the given heap that is not excluded, or `None`
+        # if there is none.  Discard inactive indices lazily.
+        while heap and (sign * heap[0]) not in self._active:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        idx = sign * heap[0]
+        if idx not in excluded:
+            return idx
+        # Rare case.  Search for the next one.
+        idxs = [sign * i for i in heap
+                if sign * i in self._active and sign * i not in excluded]
+        return sign * min(sign * i for i in idxs) if idxs else None
+
+    def covariates(self, itvl):
+        """
+        Return the values of the covariates for the events that overlap
+        the given interval.
+        """
+        # Compute directly if the sequence is not supported
+        if not self._supported:
+            evs = self.event_sequence
+            subseq = evs.subsequence(evs.events_overlapping(
+                itvl.lo, itvl.hi, itvl.is_lo_open, itvl.is_hi_open))
+            return covariates_of_sequence(subseq, self.specs)
+        self._advance(itvl.lo, itvl.hi)
+        excluded = self._excluded(itvl)
+        evs = self.event_sequence
+        values = []
+        for kind, key in self.specs:
+            if kind == 'fact':
+                values.append(self._facts[key])
+            elif kind in ('count', 'has'):
+                count = self._counts[key]
+                if excluded:
+                    count -= sum(evs[idx].type == key for idx in excluded)
+                values.append(count if kind == 'count' else int(count > 0))
+            else:
+                if kind == 'first_value':
+                    idx = self._extreme(self._firsts[key], 1, excluded)
+                else:
+                    idx = self._extreme(self._lasts[key], -1, excluded)
+                values.append(
+                    value_of(evs[idx].value) if idx is not None else None)
+        return values
+
+
+# Tests
+
+
+class CovariateSweepTest(unittest.TestCase):
+
+    def mk_ev(date1, date2, ev_type, value=None):
+        d1 = datetime.datetime.strptime(date1, '%Y-%m-%d').date()
+        d2 = datetime.datetime.strptime(date2, '%Y-%m-%d').date()
+        return esal.Event(esal.Interval(d1, d2), ev_type, value)
+
+    evs = (
+        mk_ev('2012-06-17', '2013-04-14', 'a', (1, None)),
+        mk_ev('2013-01-12', '2013-01-12', 'b', (2, None)),
+        mk_ev('2013-01-12', '2013-10-07', 'a', (3, None)),
+        mk_ev('2013-02-11', '2013-03-11', 'c', 'x'),
+        mk_ev('2013-03-11', '2013-03-11', 'b', (4, None)),
+        mk_ev('2013-04-14', '2014-05-02', 'a', (5, None)),
+        mk_ev('2013-10-07', '2013-10-07', 'b', (6, None)),
+        mk_ev('2014-05-02', '2015-02-26', 'c', 'y'),
+    )
+
+    specs = (
+        ('count', 'a'),
+        ('has', 'b'),
+        ('first_value', 'a'),
+        ('last_value', 'a'),
+        ('first_value', 'c'),
+        ('last_value', 'b'),
+        ('count', 'z'),
+        ('fact', ('bx', 'gndr')),
+    )
+
+    def test_covariates(self):
+        es = esal.EventSequence(self.evs)
+        es['bx', 'gndr'] = ('F', None)
+        dates = sorted(set(d for e in self.evs
+                           for d in (e.when.lo, e.when.hi)))
+        dates = ([dates[0] - datetime.timedelta(1)] + dates +
+                 [dates[-1] + datetime.timedelta(1)])
+        # Intervals like those of examples: between consecutive dates
+        # and at each date
+        itvls = []
+        for lo, hi in zip(dates, dates[1:]):
+            itvls.append(esal.Interval(lo, lo))
+            itvls.append(esal.Interval(lo, hi))
+        sweep = CovariateSweep(es, self.specs)
+        for itvl in itvls:
+            subseq = es.subsequence(es.events_overlapping(
+                itvl.lo, itvl.hi, itvl.is_lo_open, itvl.is_hi_open))
+            expected = covariates_of_sequence(subseq, self.specs)
+            actual = sweep.covariates(itvl)
+            self.assertEqual(expected, actual, itvl)
+
+    def test_covariates__out_of_order(self):
+        es = esal.EventSequence(self.evs)
+        sweep = CovariateSweep(es, self.specs)
+        sweep.covariates(esal.Interval(
+            datetime.date(2013, 1, 1), datetime.date(2013, 2, 1)))
+        with self.assertRaises(ValueError):
+            sweep.covariates(esal.Interval(
+                datetime.date(2012, 1, 1), datetime.date(2013, 2, 1)))
+
+    def test_check_specs(self):
+        with self.assertRaises(ValueError):
+            check_specs([('count', 'a'), ('median', 'a')])
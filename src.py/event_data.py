@@ -4,12 +4,23 @@
 # under the MIT License (https://choosealicense.com/licenses/mit/).
 
 
+import bz2
+import collections.abc
 import csv
 import datetime
+import gzip
+import heapq
 import io
 import itertools as itools
 import json
+import lzma
 import pathlib
+import pickle
+import queue
+import re
+import tempfile
+import threading
+import time
 import unittest
 
 from barnapy import general
@@ -17,6 +28,11 @@ from barnapy import logging
 from barnapy import parse
 import esal
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # Record format
 fields = (
@@ -54,11 +70,298 @@ csv_format = dict(
 )
 
 
-def records(lines, csv_format=csv_format, comment_char='#'):
+# Compressed input.  Event files are usually compressed, so open them
+# directly according to their magic numbers rather than their
+# extensions.  Zstandard requires the optional `zstandard` package.
+
+# Magic numbers of compression formats
+magic2format = {
+    b'\x1f\x8b': 'gz',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'\x28\xb5\x2f\xfd': 'zst',
+}
+
+
+def _open_zstd(file):
+    if zstandard is None:
+        raise ValueError('Reading Zstandard-compressed input requires '
+                         'the `zstandard` package')
+    return zstandard.ZstdDecompressor().stream_reader(
+        file, read_across_frames=True, closefd=True)
+
+
+format2opener = {
+    'gz': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+    'zst': _open_zstd,
+}
+
+
+def open_binary(file):
+    """
+    Open the given filename or binary stream for reading, decompressing
+    it if it is compressed.
+    """
+    # Open the file if it is a filename
+    if isinstance(file, (str, pathlib.Path)):
+        file = open(file, 'rb')
+    elif not isinstance(file, io.BufferedReader):
+        file = io.BufferedReader(file)
+    # Detect the compression format from the magic number
+    magic = file.peek(max(len(m) for m in magic2format))
+    for (mgc, fmt) in magic2format.items():
+        if magic.startswith(mgc):
+            return format2opener[fmt](file)
+    return file
+
+
+class _CountingReader(io.RawIOBase):
+    # Binary stream that counts the bytes read from the given stream
+
+    def __init__(self, file):
+        self.file = file
+        self.n_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        readinto = getattr(self.file, 'readinto', None)
+        if readinto is not None:
+            n_bytes = readinto(buffer)
+        else:
+            data = self.file.read(len(buffer))
+            n_bytes = len(data)
+            buffer[:n_bytes] = data
+        self.n_bytes += n_bytes or 0
+        return n_bytes
+
+
+class ThreadedLineReader:
+    """
+    Iterator over the lines of a binary file that reads, decompresses,
+    and decodes the file in a background thread.
+
+    The thread reads batches of lines (about `buffer_size` characters
+    each) into a queue of at most `n_buffers` batches while the caller
+    processes previous batches.  `n_chars` and `n_bytes` are the numbers
+    of characters and (decompressed) bytes read so far.
+    """
+
+    def __init__(
+            self, file, encoding='utf-8', buffer_size=2 ** 22,
+            n_buffers=4):
+        self.file = open_binary(file)
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.n_chars = 0
+        self.n_bytes = 0
+        self._queue = queue.Queue(n_buffers)
+        self._stop = threading.Event()
+        self._lines = iter(())
+        self._done = False
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # Put the item in the queue unless stopped
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        try:
+            counter = _CountingReader(self.file)
+            text = io.TextIOWrapper(
+                io.BufferedReader(counter), encoding=self.encoding)
+            while True:
+                lines = text.readlines(self.buffer_size)
+                # Include the bytes read so far with each batch
+                if not lines or not self._put((lines, counter.n_bytes)):
+                    break
+        except Exception as exc:
+            self._put(exc)
+        finally:
+            self._put(None)
+            self.file.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for line in self._lines:
+            return line
+        if self._done:
+            raise StopIteration
+        lines = self._queue.get()
+        if lines is None:
+            self._done = True
+            raise StopIteration
+        if isinstance(lines, Exception):
+            self._done = True
+            raise lines
+        lines, self.n_bytes = lines
+        self.n_chars += sum(map(len, lines))
+        self._lines = iter(lines)
+        return next(self._lines)
+
+    def close(self):
+        """Stop reading and wait for the background thread to finish."""
+        self._stop.set()
+        self._done = True
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def content_lines(lines, comment_char='#'):
     # Ignore comments and whitespace
-    lines = filter(lambda s: s and not s.startswith(comment_char),
-                   (line.strip() for line in lines))
-    return csv.reader(lines, **csv_format)
+    return filter(lambda s: s and not s.startswith(comment_char),
+                  (line.strip() for line in lines))
+
+
+def records(lines, csv_format=csv_format, comment_char='#'):
+    return csv.reader(content_lines(lines, comment_char), **csv_format)
+
+
+def can_prefilter_lines(csv_format=csv_format):
+    """
+    Return whether fields can be found by splitting lines on the
+    delimiter, which is the case if there is no quoting or escaping.
+    """
+    return (csv_format.get('quoting') == csv.QUOTE_NONE and
+            csv_format.get('escapechar') is None)
+
+
+def prefilter_lines(
+        lines,
+        include_tables=None,
+        include_ids=None,
+        delimiter='|',
+        field_name2idx=field_name2idx,
+):
+    """
+    Yield only the lines of records whose table is in `include_tables`
+    and whose ID is in `include_ids` (either of which may be `None` to
+    include everything).
+
+    This looks at only the first few fields of each line, so it is much
+    faster than tokenizing the whole line as CSV.  It is only correct
+    if fields cannot contain the delimiter (see `can_prefilter_lines`).
+    IDs are compared as text.
+    """
+    id_idx = field_name2idx['id']
+    tbl_idx = field_name2idx['tbl']
+    if include_tables is None and include_ids is None:
+        yield from lines
+        return
+    if include_ids is not None:
+        include_ids = set(str(i) for i in include_ids)
+    max_split = max(tbl_idx if include_tables is not None else 0,
+                    id_idx if include_ids is not None else 0) + 1
+    for line in lines:
+        fields = line.split(delimiter, max_split)
+        # Skip lines without enough fields
+        if len(fields) < max_split:
+            continue
+        if not (include_tables is None or
+                fields[tbl_idx] in include_tables):
+            continue
+        if not (include_ids is None or fields[id_idx] in include_ids):
+            continue
+        yield line
+
+
+# External sorting of lines by ID.  Records must be grouped by ID to be
+# assembled into sequences, so sort unsorted input in sorted runs that
+# fit in memory, spill the runs to temporary files, and merge them.
+
+
+def mk_id_key(delimiter='|', field_name2idx=field_name2idx):
+    """
+    Return a function that returns the sort key of the ID of the given
+    line.  Integer IDs sort numerically before other IDs.
+    """
+    id_idx = field_name2idx['id']
+    def id_key(line):
+        text = line.split(delimiter, id_idx + 1)[id_idx]
+        try:
+            return (0, int(text), '')
+        except ValueError:
+            return (1, 0, text)
+    return id_key
+
+
+def _write_run(lines, tmp_dir):
+    # Write the lines to a temporary file and return the file rewound.
+    # Only '\n' ends a line so that other line breaks in fields (like a
+    # bare '\r') are read back unchanged.
+    run = tempfile.TemporaryFile(
+        'w+t', encoding='utf-8', newline='\n', dir=tmp_dir)
+    for line in lines:
+        run.write(line)
+        run.write('\n')
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    with run:
+        for line in run:
+            yield line[:-1]
+
+
+def sort_lines(
+        lines,
+        key,
+        memory_budget=2 ** 30,
+        tmp_dir=None,
+):
+    """
+    Sort the given lines (without newlines) by the given key using at
+    most about `memory_budget` bytes of memory.
+
+    Lines are sorted in runs that fit in the budget.  If there is more
+    than one run, the runs are spilled to temporary files (in `tmp_dir`)
+    and merged.  The sort is stable.
+    """
+    logger = logging.getLogger(__name__)
+    runs = []
+    run = []
+    run_size = 0
+    for line in lines:
+        run.append(line)
+        # Approximate the memory of the line, its key, and the list
+        # entry
+        run_size += len(line) + 200
+        if run_size >= memory_budget:
+            run.sort(key=key)
+            runs.append(_write_run(run, tmp_dir))
+            logger.info('Sorted and spilled run {} of {} lines',
+                        len(runs), len(run))
+            run = []
+            run_size = 0
+    run.sort(key=key)
+    # Avoid temporary files if everything fits in memory
+    if not runs:
+        yield from run
+        return
+    runs.append(_write_run(run, tmp_dir))
+    del run
+    logger.info('Merging {} sorted runs', len(runs))
+    # `heapq.merge` takes items from earlier runs first when keys are
+    # equal, so the merge is stable
+    yield from heapq.merge(*(_read_run(r) for r in runs), key=key)
 
 
 def reconstruct_json(
@@ -98,6 +401,273 @@ def parse_record(record, json_constructor=json.loads):
     ]
 
 
+# Fast parsing of records.  Instead of guessing the type of every field
+# like `parse_record` does, use a schema of the types of the `typ` and
+# `val` fields by table, and parse dates with a fixed format and a memo.
+
+
+def parse_date_fast(text, _memo={'': None}):
+    """
+    Parse a date in `YYYY-MM-DD` format, falling back to `parse_date`
+    for other formats.  Return `None` for empty text.
+    """
+    date = _memo.get(text)
+    if date is None and text not in _memo:
+        if len(text) == 10 and text[4] == '-' and text[7] == '-':
+            date = datetime.date(
+                int(text[:4]), int(text[5:7]), int(text[8:]))
+        else:
+            date = parse_date(text)
+        _memo[text] = date
+    return date
+
+
+def parse_atom_fast(text):
+    """Parse the given text as an int, a float, or else as text."""
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_int_fast(text):
+    """Parse the given text as an int, falling back to `parse_atom_fast`."""
+    try:
+        return int(text)
+    except ValueError:
+        return parse_atom_fast(text)
+
+
+# Parsers for `typ` by table.  Types are concept IDs except for facts.
+table2type_parser = {
+    'bx': str,
+}
+
+# Parsers for `val` by table.  Values are concept IDs (if present)
+# except for facts and measurements.  Facts have a mixture of dates (as
+# text), codes, and concept IDs and measurements are numbers, so these
+# are parsed generically.
+table2value_parser = {
+    'bx': parse_atom_fast,
+    'mx': parse_atom_fast,
+}
+
+
+def mk_record_parser(
+        table2type_parser=table2type_parser,
+        table2value_parser=table2value_parser,
+        default_type_parser=parse_int_fast,
+        default_value_parser=parse_int_fast,
+        date_parser=parse_date_fast,
+):
+    """
+    Return a record parser like `parse_record` that parses `typ` and
+    `val` according to the given parsers for each table.
+    """
+    get_type_parser = table2type_parser.get
+    get_value_parser = table2value_parser.get
+    def parse_record_fast(record, json_constructor=json.loads):
+        id, lo, hi, tbl, typ, val, jsn = record
+        # Parse JSON if there is anything to parse and there is a
+        # constructor
+        if jsn:
+            if json_constructor is not None:
+                jsn = json_constructor(jsn)
+        # Parse empty JSON as `None`
+        else:
+            jsn = None
+        return [
+            int(id),
+            date_parser(lo),
+            date_parser(hi),
+            tbl if tbl else None,
+            (get_type_parser(tbl, default_type_parser)(typ)
+             if typ else None),
+            (get_value_parser(tbl, default_value_parser)(val)
+             if val else None),
+            jsn,
+        ]
+    return parse_record_fast
+
+
+parse_record_fast = mk_record_parser()
+
+
+# Lazy decoding of JSON.  Most of the JSON attributes of records are
+# never looked at, so keep the text and only decode it when needed.
+
+
+_json_ws = re.compile(r'[ \t\n\r]*')
+_json_string = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_json_scalar = re.compile(r'[^,:\[\]{}"\s]+')
+_json_nested_token = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+_json_decoder = json.JSONDecoder()
+
+# Sentinel for missing values
+_missing = object()
+
+
+def _json_skip_value(text, pos):
+    # Return the position just after the JSON value at the given
+    # position without constructing it
+    char = text[pos]
+    if char == '"':
+        return _json_string.match(text, pos).end()
+    elif char in '[{':
+        depth = 0
+        for match in _json_nested_token.finditer(text, pos):
+            token = match.group()
+            if token in '[{':
+                depth += 1
+            elif token in ']}':
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError('Unterminated JSON array or object at: {}'
+                         .format(pos))
+    else:
+        match = _json_scalar.match(text, pos)
+        if match is None:
+            raise ValueError('Bad JSON value at: {}'.format(pos))
+        return match.end()
+
+
+def json_object_get(text, keys):
+    """
+    Return a dictionary of the values of the given top-level keys of
+    the JSON object in the given text.
+
+    Only the values of the requested keys are decoded; all other values
+    are skipped over.  Keys that are not present are omitted from the
+    returned dictionary.  If a key occurs more than once, the last
+    occurrence is used (like `json.loads`), so the whole object is
+    always scanned.
+    """
+    keys = set(keys)
+    found = {}
+    # Exit early if none of the keys can be present (keys with escapes
+    # could be present in other forms)
+    if ('\\' not in text and
+            not any('"{}"'.format(key) in text for key in keys)):
+        return found
+    pos = _json_ws.match(text, 0).end()
+    if text[pos:pos + 1] != '{':
+        raise ValueError('Not a JSON object: {!r}'.format(text[:50]))
+    pos = _json_ws.match(text, pos + 1).end()
+    if text[pos:pos + 1] == '}':
+        return found
+    while True:
+        # Key
+        match = _json_string.match(text, pos)
+        if match is None:
+            raise ValueError('Bad JSON object key at: {}'.format(pos))
+        key = match.group()
+        key = json.loads(key) if '\\' in key else key[1:-1]
+        pos = _json_ws.match(text, match.end()).end()
+        if text[pos:pos + 1] != ':':
+            raise ValueError('Expected ":" in JSON object at: {}'
+                             .format(pos))
+        pos = _json_ws.match(text, pos + 1).end()
+        # Value
+        if key in keys:
+            found[key], pos = _json_decoder.raw_decode(text, pos)
+        else:
+            pos = _json_skip_value(text, pos)
+        # Separator or end
+        pos = _json_ws.match(text, pos).end()
+        char = text[pos:pos + 1]
+        if char == ',':
+            pos = _json_ws.match(text, pos + 1).end()
+        elif char == '}':
+            return found
+        else:
+            raise ValueError('Expected "," or "}}" in JSON object at: {}'
+                             .format(pos))
+
+
+class LazyJsonObject(collections.abc.Mapping):
+    """
+    Read-only mapping for the text of a JSON object that only decodes
+    the text when needed.
+
+    Looking up a key with `get` or `fetch` only decodes the values of
+    the requested keys (see `json_object_get`).  Everything else
+    decodes the whole object.
+    """
+
+    __slots__ = ('text', '_dict', '_values')
+
+    def __init__(self, text):
+        self.text = text
+        self._dict = None
+        self._values = None
+
+    def decode(self):
+        """Decode and return the whole object as a `dict`."""
+        if self._dict is None:
+            self._dict = json.loads(self.text)
+            self._values = None
+        return self._dict
+
+    def fetch(self, *keys):
+        """Decode the values of the given keys in a single pass."""
+        if self._dict is not None:
+            return
+        if self._values is None:
+            self._values = {}
+        keys = [k for k in keys if k not in self._values]
+        if keys:
+            values = json_object_get(self.text, keys)
+            for key in keys:
+                self._values[key] = values.get(key, _missing)
+
+    def get(self, key, default=None):
+        if self._dict is not None:
+            return self._dict.get(key, default)
+        self.fetch(key)
+        value = self._values[key]
+        return default if value is _missing else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.text)
+
+    def __reduce__(self):
+        # Pickle only the text because the decoded values refer to the
+        # `_missing` sentinel of this process
+        return (type(self), (self.text,))
+
+
+def lazy_json(text):
+    """
+    Construct a `LazyJsonObject` from the text of a JSON object and
+    decode any other JSON immediately.
+
+    Use this as the `json_constructor` of `read_records`.
+    """
+    if text.lstrip().startswith('{'):
+        return LazyJsonObject(text)
+    return json.loads(text)
+
+
 def fact_from_record(record):
     _, _, _, tbl, typ, val, jsn = record
     return ((tbl, typ), (val, jsn))
@@ -108,6 +678,87 @@ def event_from_record(record):
     return esal.Event(esal.Interval(lo, hi), (tbl, typ), (val, jsn))
 
 
+# Interning of event types.  Event types are `(tbl, typ)` pairs, which
+# are allocated for every record and then hashed and compared for every
+# event as sequences are encoded into exposures and outcomes.  An
+# `EventTypeInterner` instead gives each distinct event type a small
+# integer code (in order of first appearance) so that events have
+# integer types.  Anything that refers to event types (like the map of
+# exposures and outcomes or covariate specifications) must then use the
+# codes as well, which is what `encode` is for.
+
+
+class EventTypeInterner:
+
+    def __init__(self):
+        # Code -> event type
+        self.event_types = []
+        # tbl -> typ -> code.  Looking up the table and type separately
+        # avoids making a pair for every record.
+        self._tbl2typ2code = {}
+
+    def __len__(self):
+        return len(self.event_types)
+
+    def code(self, tbl, typ):
+        """Return the code of the given event type, assigning it if new."""
+        typ2code = self._tbl2typ2code.get(tbl)
+        if typ2code is None:
+            typ2code = {}
+            self._tbl2typ2code[tbl] = typ2code
+        code = typ2code.get(typ)
+        if code is None:
+            code = len(self.event_types)
+            self.event_types.append((tbl, typ))
+            typ2code[typ] = code
+        return code
+
+    def encode(self, event_type):
+        """
+        Return the code of the given event type if it is a `(tbl, typ)`
+        pair and otherwise return it unchanged (e.g. `'exp'`).
+        """
+        if isinstance(event_type, tuple) and len(event_type) == 2:
+            return self.code(*event_type)
+        return event_type
+
+    def decode(self, code):
+        """Return the event type with the given code."""
+        return self.event_types[code]
+
+    def event_from_record(self, record):
+        """Like `event_from_record` but with an integer event type."""
+        _, lo, hi, tbl, typ, val, jsn = record
+        return esal.Event(
+            esal.Interval(lo, hi), self.code(tbl, typ), (val, jsn))
+
+
+def skip_through_id(items, rec_id, get_id):
+    """
+    Skip the items up to and including the first run of items with the
+    given ID and yield the rest.  IDs are compared like `mk_id_key` does
+    so that IDs that are still text match parsed IDs.  Raise a
+    `ValueError` if there are no items with the given ID.
+
+    This is for resuming after the given ID without parsing the items
+    before it.
+    """
+    key = _id_sort_key(rec_id)
+    items = iter(items)
+    for item in items:
+        if _id_sort_key(get_id(item)) == key:
+            break
+    else:
+        raise ValueError(
+            'Input does not match checkpoint: No records with ID '
+            '{!r}'.format(rec_id))
+    for item in items:
+        if _id_sort_key(get_id(item)) != key:
+            yield item
+            break
+    yield from items
+
+
 def read_records(
         file,
         csv_format=csv_format,
@@ -118,39 +769,95 @@ def read_records(
         include_record=None,
         record_transformer=None,
         field_name2idx=field_name2idx,
+        include_ids=None,
+        sort_by_id=False,
+        sort_memory_budget=2 ** 30,
+        collector=None,
+        resume_after_id=None,
 ):
-    # Open the file if it is a filename
-    if isinstance(file, (str, pathlib.Path)):
-        lines = open(file, 'rt')
+    # Open the file if it is a filename or binary stream.  Read,
+    # decompress, and decode it in the background.
+    reader = None
+    if isinstance(file, (str, pathlib.Path, io.BufferedIOBase,
+                         io.RawIOBase)):
+        reader = ThreadedLineReader(file)
+        lines = reader
     else:
         lines = file
     id_idx = field_name2idx['id']
     tbl_idx = field_name2idx['tbl']
-    # Logger for tracking reading records
+    # Logger for tracking reading records.  Report throughput too.
     logger = logging.getLogger(__name__)
+    start_time = time.perf_counter()
     def tracker(count):
-        logger.info('CSV records: {}', count)
-    # Read the records
-    for record in general.track_iterator(
-            records(lines, csv_format, comment_char),
-            tracker, track_every=100000,
-            track_init=True, track_end=True):
-        # Skip events from some tables
-        if record[tbl_idx] not in include_tables:
-            continue
-        # Reconstruct JSON if needed
-        if len(record) > len(field_name2idx):
-            record = reconstruct_json(record, csv_format['delimiter'])
-        # Parse record
-        if record_parser is not None:
-            record = record_parser(record, json_constructor)
-        # Filter records if requested
-        if not (include_record is None or include_record(record)):
-            continue
-        # Transform record
-        if record_transformer is not None:
-            record = record_transformer(record)
-        yield record
+        secs = max(time.perf_counter() - start_time, 1e-9)
+        if reader is not None:
+            logger.info('CSV records: {} ({:.0f} records/s, {:.1f} MB/s)',
+                        count, count / secs, reader.n_bytes / secs / 1e6)
+        else:
+            logger.info('CSV records: {} ({:.0f} records/s)',
+                        count, count / secs)
+    lines = general.track_iterator(
+        content_lines(lines, comment_char),
+        tracker, track_every=100000,
+        track_init=True, track_end=True)
+    # Skip records from some tables (and for some IDs) before splitting
+    # lines if possible, and otherwise after
+    prefilter = can_prefilter_lines(csv_format)
+    if prefilter:
+        lines = prefilter_lines(
+            lines, include_tables, include_ids,
+            csv_format['delimiter'], field_name2idx)
+    elif include_ids is not None:
+        include_ids = set(str(i) for i in include_ids)
+    # Sort by ID if requested (so that records can be grouped by ID)
+    if sort_by_id:
+        lines = sort_lines(
+            lines, mk_id_key(csv_format['delimiter'], field_name2idx),
+            sort_memory_budget)
+    # Skip the records through the given ID if resuming.  Do this on the
+    # lines if the ID can be found by splitting and otherwise on the
+    # split records, but in either case before parsing.
+    if resume_after_id is not None and prefilter:
+        delimiter = csv_format['delimiter']
+        lines = skip_through_id(
+            lines, resume_after_id,
+            lambda line: line.split(delimiter, id_idx + 1)[id_idx])
+    records = csv.reader(lines, **csv_format)
+    if resume_after_id is not None and not prefilter:
+        records = skip_through_id(
+            records, resume_after_id, lambda record: record[id_idx])
+    try:
+        # Read the records
+        for record in records:
+            if not prefilter:
+                # Skip events from some tables
+                if record[tbl_idx] not in include_tables:
+                    continue
+                # Skip records for some IDs
+                if not (include_ids is None or
+                        record[id_idx] in include_ids):
+                    continue
+            # Reconstruct JSON if needed
+            if len(record) > len(field_name2idx):
+                record = reconstruct_json(record, csv_format['delimiter'])
+            # Parse record
+            if record_parser is not None:
+                record = record_parser(record, json_constructor)
+            # Filter records if requested
+            if not (include_record is None or include_record(record)):
+                # Count dropped records if collecting metrics
+                if collector is not None:
+                    collector.count('records_dropped_by_include_record')
+                continue
+            # Transform record
+            if record_transformer is not None:
+                record = record_transformer(record)
+            yield record
+    finally:
+        # Stop reading in the background if not done
+        if reader is not None:
+            reader.close()
 
 
 def separate_fact_event_records(
@@ -169,13 +876,130 @@ def separate_fact_event_records(
     return facts, events
 
 
-def event_sequences_from_records(
+# Patients with huge numbers of records (e.g. synthetic or test
+# patients) can use up all the memory.  Groups of records can be limited
+# to a maximum number of records.  Groups with more records are handled
+# according to one of the following policies:
+#
+# * `skip`: drop the group
+# * `truncate`: keep the facts and the earliest events (up to the
+#   maximum number of records)
+# * `spill`: write the records to a temporary file and read them back
+#   when the group is iterated over (see `SpilledRecords`), so they are
+#   never all in memory at once
+oversize_policies = ('skip', 'truncate', 'spill')
+
+
+class SpilledRecords:
+    """
+    Records spilled to a temporary file.  Iterating reads them back in
+    the same order.  The file is deleted when closed.
+    """
+
+    def __init__(self, records, tmp_dir=None, chunk_size=10000):
+        self._file = tempfile.TemporaryFile(dir=tmp_dir)
+        self.n_records = 0
+        records = iter(records)
+        while True:
+            chunk = list(itools.islice(records, chunk_size))
+            if not chunk:
+                break
+            pickle.dump(chunk, self._file, pickle.HIGHEST_PROTOCOL)
+            self.n_records += len(chunk)
+
+    def __len__(self):
+        return self.n_records
+
+    def __iter__(self):
+        self._file.seek(0)
+        while True:
+            try:
+                chunk = pickle.load(self._file)
+            except EOFError:
+                return
+            yield from chunk
+
+    def close(self):
+        self._file.close()
+
+
+def _earliest_records(records, max_records, field_name2idx=field_name2idx):
+    # Return the facts plus the earliest events (in their original
+    # order) such that there are at most the given number of records,
+    # and the total number of records
+    lo_idx = field_name2idx['lo']
+    hi_idx = field_name2idx['hi']
+    facts = []
+    n_records = 0
+    def keyed_events():
+        nonlocal n_records
+        for record in records:
+            n_records += 1
+            lo = record[lo_idx]
+            hi = record[hi_idx]
+            if lo is None and hi is None:
+                facts.append(record)
+                continue
+            # Order by start, end, and then original order
+            lo = lo if lo is not None else hi
+            hi = hi if hi is not None else lo
+            yield (lo, hi, n_records), record
+    # `nsmallest` only keeps the given number of items in memory
+    earliest = heapq.nsmallest(
+        max_records, keyed_events(), key=lambda item: item[0])
+    # Drop the latest events to make room for the facts
+    del earliest[max(max_records - len(facts), 0):]
+    events = [item[1] for item in sorted(earliest, key=lambda i: i[0][2])]
+    return facts + events, n_records
+
+
+def _id_sort_key(rec_id):
+    # Like `mk_id_key` but for parsed IDs
+    if isinstance(rec_id, int):
+        return (0, rec_id, '')
+    try:
+        return (0, int(rec_id), '')
+    except (TypeError, ValueError):
+        return (1, 0, str(rec_id))
+
+
+def record_groups(
         records,
-        fact_constructor=fact_from_record,
-        event_constructor=event_from_record,
         field_name2idx=field_name2idx,
+        max_records=None,
+        oversize_policy='skip',
+        tmp_dir=None,
+        collector=None,
+        check_sorted=True,
 ):
+    """
+    Gather consecutive records with the same ID into groups.
+
+    Yield `(id, records)` pairs where `records` is a list.  The records
+    must already be grouped by ID (e.g. sorted).  If `check_sorted` (the
+    default), raise a `ValueError` unless the IDs are sorted
+    (numerically, as by `sort_lines`, or as text), which also detects an
+    ID that appears again after other IDs (which would otherwise
+    silently split a patient into several groups).  This only compares
+    each ID with the previous one, so it takes constant memory.  Pass
+    `check_sorted=False` for records that are grouped but not sorted.
+
+    If a group has more than `max_records` records, handle it according
+    to `oversize_policy` (see above), log its ID, and count it in the
+    given metrics collector (if any).  Spilled groups are
+    `SpilledRecords` instead of lists and are only valid until the next
+    group is generated.  They keep memory bounded only if they are
+    streamed (e.g. by `compact_events.from_records`), so `survival_data`
+    requires `compact_sequences=True` to spill.
+    """
+    if oversize_policy not in oversize_policies:
+        raise ValueError(
+            'Unknown oversize policy: {!r}.  Must be one of: {}'.format(
+                oversize_policy, ', '.join(oversize_policies)))
     id_idx = field_name2idx['id']
+    # Whether the IDs so far are sorted numerically and as text
+    prev_id = None
+    numeric_sorted = text_sorted = True
     # Logger for tracking reading records
     logger = logging.getLogger(__name__)
     def tracker(count):
@@ -186,18 +1010,127 @@ def event_sequences_from_records(
                 tracker, track_every=10000,
                 track_init=True, track_end=True),
             key=lambda r: r[id_idx]):
-        # Separate facts and events
-        facts, events = separate_fact_event_records(recs)
-        # Construct facts
-        facts = (fact_constructor(f) for f in facts)
-        # Construct events
-        events = (event_constructor(e) for e in events)
-        # Construct event sequence
-        yield esal.EventSequence(events, facts, rec_id)
+        # Check that the records are sorted by ID
+        if check_sorted and prev_id is not None:
+            numeric_sorted = (numeric_sorted and
+                              _id_sort_key(prev_id) < _id_sort_key(rec_id))
+            text_sorted = text_sorted and str(prev_id) < str(rec_id)
+            if not (numeric_sorted or text_sorted):
+                raise ValueError(
+                    'Records are not sorted by ID: Records for ID {!r} '
+                    'appear after records for ID {!r}.  Sort the records '
+                    'by ID (e.g. with `sort_by_id=True`).'.format(
+                        rec_id, prev_id))
+        prev_id = rec_id
+        if max_records is None:
+            yield rec_id, list(recs)
+            continue
+        group = list(itools.islice(recs, max_records + 1))
+        if len(group) <= max_records:
+            yield rec_id, group
+            continue
+        # Handle a group with too many records
+        if collector is not None:
+            collector.count('oversize_patients')
+        recs = itools.chain(group, recs)
+        del group
+        if oversize_policy == 'skip':
+            n_records = sum(1 for _ in recs)
+            logger.warning('Skipping ID {!r}: {} records is more than '
+                           'the maximum of {}', rec_id, n_records,
+                           max_records)
+        elif oversize_policy == 'truncate':
+            group, n_records = _earliest_records(
+                recs, max_records, field_name2idx)
+            logger.warning('Truncating ID {!r} to its earliest records: '
+                           '{} records is more than the maximum of {}',
+                           rec_id, n_records, max_records)
+            yield rec_id, group
+        else:
+            spilled = SpilledRecords(recs, tmp_dir)
+            logger.warning('Spilling ID {!r} to disk: {} records is more '
+                           'than the maximum of {}', rec_id,
+                           spilled.n_records, max_records)
+            try:
+                yield rec_id, spilled
+            finally:
+                spilled.close()
+
+
+def event_sequence_from_records(
+        rec_id,
+        records,
+        fact_constructor=fact_from_record,
+        event_constructor=event_from_record,
+):
+    # Separate facts and events
+    facts, events = separate_fact_event_records(records)
+    # Construct facts
+    facts = (fact_constructor(f) for f in facts)
+    # Construct events
+    events = (event_constructor(e) for e in events)
+    # Construct event sequence
+    return esal.EventSequence(events, facts, rec_id)
+
+
+def event_sequences_from_records(
+        records,
+        fact_constructor=fact_from_record,
+        event_constructor=event_from_record,
+        field_name2idx=field_name2idx,
+        check_sorted=True,
+):
+    for rec_id, recs in record_groups(
+            records, field_name2idx, check_sorted=check_sorted):
+        yield event_sequence_from_records(
+            rec_id, recs, fact_constructor, event_constructor)
 
 
 class EventDataTest(unittest.TestCase):
 
+    def test_record_groups__oversize(self):
+        d = datetime.date
+        records = [
+            [1, d(2000, 1, 1), None, 'dx', 1, None, None],
+            [2, d(2001, 1, 1), None, 'dx', 1, None, None],
+            [2, None, None, 'bx', 'dob', '1950-01-01', None],
+            [2, d(2000, 1, 1), d(2000, 2, 1), 'rx', 2, None,
+             LazyJsonObject('{"refills": 2}')],
+            [2, d(2002, 1, 1), None, 'dx', 2, None, None],
+            [2, d(2000, 1, 1), d(2000, 1, 1), 'px', 3, None, None],
+            [3, d(2000, 1, 1), None, 'dx', 1, None, None],
+        ]
+        def groups(policy):
+            return [(rec_id, list(recs)) for (rec_id, recs) in record_groups(
+                iter(records), max_records=3, oversize_policy=policy)]
+        self.assertEqual([(1, records[:1]), (3, records[6:])],
+                         groups('skip'))
+        self.assertEqual(
+            [(1, records[:1]), (2, [records[2], records[3], records[5]]),
+             (3, records[6:])],
+            groups('truncate'))
+        spilled = groups('spill')
+        self.assertEqual([(1, records[:1]), (2, records[1:6]),
+                          (3, records[6:])], spilled)
+        self.assertEqual(2, spilled[1][1][2][6]['refills'])
+        with self.assertRaises(ValueError):
+            groups('drop')
+
+    def test_event_type_interner(self):
+        interner = EventTypeInterner()
+        self.assertEqual(0, interner.code('rx', 19078559))
+        self.assertEqual(1, interner.encode(('dx', 80180)))
+        self.assertEqual(0, interner.encode(('rx', 19078559)))
+        self.assertEqual('exp', interner.encode('exp'))
+        self.assertEqual(('exp',), interner.encode(('exp',)))
+        self.assertEqual(('dx', 80180), interner.decode(1))
+        self.assertEqual(2, len(interner))
+        record = [1, datetime.date(2000, 1, 1), None, 'dx', 80180, 2.5, None]
+        event = interner.event_from_record(record)
+        self.assertEqual(1, event.type)
+        self.assertEqual(event_from_record(record).when, event.when)
+        self.assertEqual((2.5, None), event.value)
+
     def test_records(self):
         lines = [
             '   # various comments  \n',
@@ -294,3 +1227,252 @@ id|lo|hi|tbl|typ|val|jsn
         ))
         self.maxDiff = None
         self.assertEqual(expected, actual)
+
+    events_csv_text = '''
+id|lo|hi|tbl|typ|val|jsn
+1|||bx|dob|1932-11-29|
+1|||bx|gndr|M|
+1|||bx|race|8552|
+1|||bx|record||
+1|1991-11-15|1991-11-15|mx|3000330|4069590|
+1|1991-11-15|1991-11-15|px|2108115||
+1|1991-11-15|1991-11-15|vx|9202||
+1|1996-06-01||dx|80180||
+1|1997-07-01||dlux|486||
+1|2009-07-04|2009-07-04|ox|4222303||{"a":1,"b":2,"3":"c"}
+1|2009-07-30|2009-08-29|rx|19078559||
+1|2009-08-12||xx|||"|||||"
+'''
+
+    def test_parse_record_fast(self):
+        records = [
+            ['1', '1996-10-01', '1997-11-13', 'mx', '12345',
+             '100.0', '[1, 2, 3, 4, 5]'],
+            ['1', '', '', 'bx', 'dob', '1932-11-29', ''],
+            ['1', '', '', 'bx', 'gndr', 'M', ''],
+            ['1', '', '', 'bx', 'race', '8552', ''],
+            ['1', '1991-11-15', '1991-11-15', 'mx', '3000330',
+             '4069590', ''],
+            ['1', '1996-06-01', '', 'dx', '80180', '', ''],
+            ['1', '2009-07-04', '2009-07-04', 'ox', '4222303', '',
+             '{"a":1,"b":2,"3":"c"}'],
+            ['1', '2009-8-12', '', 'xx', '', '', '"|||||"'],
+            ['0', '', '', '', '', '', ''],
+        ]
+        for record in records:
+            expected = parse_record(record)
+            actual = parse_record_fast(record)
+            self.assertEqual(expected, actual)
+            # Make sure types agree because `1 == 1.0` in Python
+            self.assertEqual([type(x) for x in expected],
+                             [type(x) for x in actual])
+
+    def test_read_records__fast(self):
+        file = io.StringIO(self.events_csv_text)
+        expected = list(read_records(file))
+        file = io.StringIO(self.events_csv_text)
+        actual = list(read_records(file, record_parser=parse_record_fast))
+        self.assertEqual(expected, actual)
+
+    def test_read_records__compressed(self):
+        file = io.StringIO(self.events_csv_text)
+        expected = list(read_records(file))
+        data = self.events_csv_text.encode()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for (ext, opener) in (('', open), ('.gz', gzip.open),
+                                  ('.bz2', bz2.open), ('.xz', lzma.open)):
+                path = pathlib.Path(tmp_dir) / ('ev.csv' + ext)
+                with opener(path, 'wb') as file:
+                    file.write(data)
+                self.assertEqual(expected, list(read_records(path)), ext)
+                # Binary streams are decompressed too
+                with open(path, 'rb') as file:
+                    self.assertEqual(expected, list(read_records(file)))
+
+    def test_threaded_line_reader(self):
+        lines = ['{}|line é\n'.format(i) for i in range(1000)]
+        data = gzip.compress(''.join(lines).encode())
+        # Small buffers so there are many batches
+        with ThreadedLineReader(
+                io.BytesIO(data), buffer_size=100, n_buffers=2) as reader:
+            self.assertEqual(lines, list(reader))
+            self.assertEqual(sum(map(len, lines)), reader.n_chars)
+            # Bytes are counted after decompression
+            self.assertEqual(len(''.join(lines).encode()), reader.n_bytes)
+        # Stopping early does not hang
+        with ThreadedLineReader(
+                io.BytesIO(data), buffer_size=100, n_buffers=2) as reader:
+            self.assertEqual(lines[:3], [next(reader) for _ in range(3)])
+
+    def test_json_object_get(self):
+        text = (' { "a" : [1, {"b": 2}, "]}"], "b":"x\\"y", '
+                '"c": {"d": [3, 4]}, "d":null ,"e": -1.5e3,"f":true}')
+        self.assertEqual({}, json_object_get(text, ['z']))
+        self.assertEqual({'b': 'x"y', 'e': -1500.0, 'd': None},
+                         json_object_get(text, ['b', 'd', 'e', 'z']))
+        self.assertEqual(json.loads(text),
+                         json_object_get(text, 'abcdef'))
+        self.assertEqual({}, json_object_get('{}', ['a']))
+        self.assertEqual({'ab': 1},
+                         json_object_get('{"a\\u0062": 1}', ['ab']))
+        with self.assertRaises(ValueError):
+            json_object_get('["a", 1]', ['a'])
+
+    def test_json_object_get__duplicate_keys(self):
+        text = '{"a": 1, "b": [2], "a": {"c": 3}, "b": null, "a": "x"}'
+        expected = json.loads(text)
+        self.assertEqual(expected, json_object_get(text, 'ab'))
+        self.assertEqual({'a': 'x'}, json_object_get(text, ['a']))
+        # Lazy lookups agree with the full decode
+        jsn = lazy_json(text)
+        self.assertEqual(expected['a'], jsn.get('a'))
+        self.assertEqual(expected['b'], jsn['b'])
+        self.assertIsNone(jsn._dict)
+        self.assertEqual(expected, jsn.decode())
+
+    def test_lazy_json(self):
+        text = '{"days_supply": 30, "sig": {"refills": 1}, "refills": 2}'
+        jsn = lazy_json(text)
+        self.assertIsInstance(jsn, LazyJsonObject)
+        self.assertEqual(30, jsn.get('days_supply'))
+        self.assertEqual(2, jsn['refills'])
+        self.assertIsNone(jsn.get('quantity'))
+        self.assertNotIn('quantity', jsn)
+        with self.assertRaises(KeyError):
+            jsn['quantity']
+        # Only requested values have been decoded so far
+        self.assertIsNone(jsn._dict)
+        self.assertEqual(json.loads(text), jsn)
+        self.assertEqual(['days_supply', 'sig', 'refills'], list(jsn))
+        # Other JSON is decoded immediately
+        self.assertEqual([1, 2], lazy_json('[1, 2]'))
+        self.assertEqual('|||', lazy_json('"|||"'))
+
+    def test_read_records__lazy_json(self):
+        file = io.StringIO(self.events_csv_text)
+        expected = list(read_records(file))
+        file = io.StringIO(self.events_csv_text)
+        actual = list(read_records(file, json_constructor=lazy_json))
+        self.assertEqual(expected, actual)
+
+    def test_prefilter_lines(self):
+        lines = [
+            '1|||bx|dob|1932-11-29|',
+            '1|1991-11-15|1991-11-15|mx|3000330|4069590|',
+            '2|2009-07-04|2009-07-04|ox|4222303||{"a":"|mx|"}',
+            '2|2009-07-30|2009-08-29|rx|19078559||',
+            '3|2009-08-12||xx|||',
+            '3|short',
+        ]
+        self.assertEqual(lines, list(prefilter_lines(lines)))
+        self.assertEqual(
+            [lines[0], lines[3], lines[4]],
+            list(prefilter_lines(lines, include_tables={'bx', 'rx', 'xx'})))
+        self.assertEqual(
+            [lines[2], lines[3], lines[4], lines[5]],
+            list(prefilter_lines(lines, include_ids={2, 3})))
+        self.assertEqual(
+            [lines[1]],
+            list(prefilter_lines(lines, {'mx', 'ox'}, {'1'})))
+
+    def test_read_records__include_ids(self):
+        text = self.events_csv_text + '2|2009-08-12||xx|||\n'
+        # With and without prefiltering
+        for quoting in (csv.QUOTE_NONE, csv.QUOTE_MINIMAL):
+            file = io.StringIO(text)
+            actual = list(read_records(
+                file,
+                csv_format=dict(csv_format, quoting=quoting),
+                include_tables={'xx'},
+                include_ids={2},
+            ))
+            expected = [
+                [2, datetime.date(2009, 8, 12), None, 'xx', None, None,
+                 None]]
+            self.assertEqual(expected, actual)
+
+    def test_read_records__resume_after_id(self):
+        # Without the record whose JSON would be quoted
+        text = ''.join(
+            line.replace('1|', f'{id}|', 1) for id in ('01', '2', '3')
+            for line in self.events_csv_text.splitlines(keepends=True)
+            if line.startswith('1|') and '"' not in line)
+        records = list(read_records(io.StringIO(text)))
+        expected = [r for r in records if r[0] == 3]
+        self.assertGreater(len(expected), 3)
+        # With and without splitting lines, and with or without sorting
+        for quoting in (csv.QUOTE_NONE, csv.QUOTE_MINIMAL):
+            for sort_by_id in (False, True):
+                parsed = []
+                def record_parser(record, json_constructor):
+                    parsed.append(record[0])
+                    return parse_record(record, json_constructor)
+                actual = list(read_records(
+                    io.StringIO(text),
+                    csv_format=dict(csv_format, quoting=quoting),
+                    record_parser=record_parser,
+                    sort_by_id=sort_by_id,
+                    resume_after_id=2,
+                ))
+                self.assertEqual(expected, actual)
+                # The skipped records are not parsed
+                self.assertEqual({'3'}, set(parsed))
+        # Parsed IDs match IDs as text
+        self.assertEqual(
+            [r for r in records if r[0] != 1] + records,
+            list(read_records(io.StringIO(text + text), resume_after_id=1)))
+        # The ID must be in the input
+        with self.assertRaises(ValueError):
+            list(read_records(io.StringIO(text), resume_after_id=4))
+
+    def test_sort_lines(self):
+        lines = ['{}|{}'.format(i % 7, i) for i in range(100)]
+        lines.append('x|100')
+        lines.append('10|101')
+        key = mk_id_key()
+        expected = sorted(lines, key=key)
+        self.assertEqual('10|101', expected[-2])
+        self.assertEqual('x|100', expected[-1])
+        # In memory and with many spilled runs
+        for memory_budget in (2 ** 20, 1000):
+            actual = list(sort_lines(lines, key, memory_budget))
+            self.assertEqual(expected, actual)
+
+    def test_read_records__sort_by_id(self):
+        text = self.events_csv_text + '0|2009-08-12||xx|||\n'
+        expected = list(read_records(io.StringIO(text)))
+        expected = expected[-1:] + expected[:-1]
+        actual = list(read_records(io.StringIO(text), sort_by_id=True))
+        self.assertEqual(expected, actual)
+
+    def test_record_groups__out_of_order(self):
+        records = [[1, 'a'], [1, 'b'], [2, 'c'], [1, 'd']]
+        groups = record_groups(records)
+        self.assertEqual((1, [[1, 'a'], [1, 'b']]), next(groups))
+        self.assertEqual((2, [[2, 'c']]), next(groups))
+        with self.assertRaises(ValueError):
+            next(groups)
+        # IDs sorted numerically or as text are accepted
+        for ids in ([2, 9, 10, 'x'], [10, 2, 9]):
+            records = [[i, 'a'] for i in ids]
+            self.assertEqual(
+                ids, [i for (i, _) in record_groups(records)])
+        # Grouped but unsorted IDs are only accepted without the check
+        records = [[9, 'a'], [10, 'b'], [2, 'c']]
+        with self.assertRaises(ValueError):
+            list(record_groups(records))
+        self.assertEqual([9, 10, 2], [i for (i, _) in record_groups(
+            records, check_sorted=False)])
+        # Sequences are checked the same way
+        records = [[i, None, None, 'dx', 1, None, None] for i in (1, 2, 1)]
+        with self.assertRaises(ValueError):
+            list(event_sequences_from_records(records))
+
+    def test_sort_lines__line_breaks(self):
+        # A bare carriage return within a field survives spilled runs
+        lines = ['{}|dx|a\rb {}'.format(i % 5, i) for i in range(50)]
+        key = mk_id_key()
+        expected = sorted(lines, key=key)
+        for memory_budget in (2 ** 20, 500):
+            self.assertEqual(
+                expected, list(sort_lines(lines, key, memory_budget)))
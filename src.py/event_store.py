@@ -0,0 +1,474 @@
+# Compact, columnar, on-disk storage of EMR event records
+
+# Copyright (c) 2019 Aubrey Barnard.  This is free software released
+# under the MIT License (https://choosealicense.com/licenses/mit/).
+
+# An event store is a directory that contains one binary file per
+# column plus a JSON file of metadata.  Compiling an events CSV into a
+# store parses every record once.  Reading from the store skips CSV
+# splitting, JSON reconstruction, and date and atom parsing, so
+# repeatedly processing the same events is much faster.
+#
+# Columns (all in native byte order, which is recorded in the
+# metadata):
+#
+# * `id.bin`: patient ID (int64)
+# * `lo.bin`, `hi.bin`: proleptic Gregorian ordinal of the date (int32),
+#   0 for no date
+# * `tbl.bin`: index into the interned tables (uint8)
+# * `typ.bin`: index into the interned types (int32)
+# * `val_kind.bin`: kind of value (int8): 0 for none, 1 for an integer
+#   in `val_int.bin`, 2 for a float in `val_flt.bin`, 3 for an interned
+#   value whose index is in `val_int.bin`
+# * `val_int.bin`: integer value or index into the interned values
+#   (int64)
+# * `val_flt.bin`: float value (float64)
+# * `jsn_off.bin`: offsets into `jsn.bin` (uint64, one more than the
+#   number of records).  The JSON of record `i` is the UTF-8 text in
+#   `jsn.bin[jsn_off[i]:jsn_off[i + 1]]`, and empty text means no JSON.
+# * `jsn.bin`: concatenated raw JSON text
+#
+# The interned tables, types, and values are lists stored in
+# `meta.json`.
+
+
+import array
+import datetime
+import io
+import json
+import mmap
+import pathlib
+import sys
+import tempfile
+import unittest
+
+from barnapy import general
+from barnapy import logging
+
+# "Install" related modules by updating import path
+this_dir = pathlib.Path(__file__).absolute().parent
+sys.path.append(str(this_dir))
+
+import event_data
+
+
+format_version = 1
+
+meta_filename = 'meta.json'
+
+# Column name -> array type code
+columns = {
+    'id': 'q',
+    'lo': 'i',
+    'hi': 'i',
+    'tbl': 'B',
+    'typ': 'i',
+    'val_kind': 'b',
+    'val_int': 'q',
+    'val_flt': 'd',
+    'jsn_off': 'Q',
+}
+
+# Kinds of values
+val_none = 0
+val_int = 1
+val_flt = 2
+val_interned = 3
+
+_int64_min = -(2 ** 63)
+_int64_max = 2 ** 63 - 1
+
+
+def is_event_store(path):
+    """Return whether the given path is the directory of an event store."""
+    return (isinstance(path, (str, pathlib.Path)) and
+            (pathlib.Path(path) / meta_filename).is_file())
+
+
+class _Interner:
+
+    def __init__(self):
+        self.objects = []
+        self._obj2idx = {}
+
+    def __call__(self, obj):
+        # Distinguish objects that compare equal but have different
+        # types (e.g. `1`, `1.0`, and `True`)
+        key = (type(obj), obj)
+        idx = self._obj2idx.get(key)
+        if idx is None:
+            idx = len(self.objects)
+            self.objects.append(obj)
+            self._obj2idx[key] = idx
+        return idx
+
+
+def compile_store(
+        in_file,
+        store_dir,
+        csv_format=event_data.csv_format,
+        comment_char='#',
+        include_tables=event_data.tables,
+        record_parser=event_data.parse_record,
+        chunk_size=1000000,
+        sort_by_id=False,
+        sort_memory_budget=2 ** 30,
+):
+    """
+    Parse the event records in the given CSV file and store them in an
+    event store in the given directory.
+
+    The records are parsed with the given record parser except that JSON
+    is left as text.  If `sort_by_id`, the records are sorted by ID (see
+    `event_data.read_records`).  Return the number of records stored.
+    """
+    store_dir = pathlib.Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    # Remove any existing metadata so that an incomplete store is not
+    # recognized as a store
+    (store_dir / meta_filename).unlink(missing_ok=True)
+    logger = logging.getLogger(__name__)
+    logger.info('Compiling event store: {}', store_dir)
+    # Interned tables, types, and values
+    intern_tbl = _Interner()
+    intern_typ = _Interner()
+    intern_val = _Interner()
+    # Open column files
+    files = {name: open(store_dir / (name + '.bin'), 'wb')
+             for name in columns}
+    jsn_file = open(store_dir / 'jsn.bin', 'wb')
+    jsn_off = 0
+    n_records = 0
+    try:
+        # Offsets start with zero
+        array.array(columns['jsn_off'], [0]).tofile(files['jsn_off'])
+        chunk = {name: array.array(code)
+                 for (name, code) in columns.items()}
+        jsn_chunk = []
+        def flush():
+            for name, arr in chunk.items():
+                arr.tofile(files[name])
+                del arr[:]
+            jsn_file.write(b''.join(jsn_chunk))
+            del jsn_chunk[:]
+        for record in event_data.read_records(
+                in_file,
+                csv_format=csv_format,
+                comment_char=comment_char,
+                include_tables=set(include_tables),
+                json_constructor=None,
+                record_parser=record_parser,
+                sort_by_id=sort_by_id,
+                sort_memory_budget=sort_memory_budget,
+        ):
+            id, lo, hi, tbl, typ, val, jsn = record
+            chunk['id'].append(id)
+            chunk['lo'].append(lo.toordinal() if lo is not None else 0)
+            chunk['hi'].append(hi.toordinal() if hi is not None else 0)
+            chunk['tbl'].append(intern_tbl(tbl))
+            chunk['typ'].append(intern_typ(typ))
+            # Store integers and floats directly and intern everything
+            # else
+            if val is None:
+                chunk['val_kind'].append(val_none)
+                chunk['val_int'].append(0)
+                chunk['val_flt'].append(0.0)
+            elif (type(val) is int and
+                  _int64_min <= val <= _int64_max):
+                chunk['val_kind'].append(val_int)
+                chunk['val_int'].append(val)
+                chunk['val_flt'].append(0.0)
+            elif type(val) is float:
+                chunk['val_kind'].append(val_flt)
+                chunk['val_int'].append(0)
+                chunk['val_flt'].append(val)
+            else:
+                chunk['val_kind'].append(val_interned)
+                chunk['val_int'].append(intern_val(val))
+                chunk['val_flt'].append(0.0)
+            # Keep JSON as raw text
+            if jsn:
+                jsn = jsn.encode()
+                jsn_chunk.append(jsn)
+                jsn_off += len(jsn)
+            chunk['jsn_off'].append(jsn_off)
+            n_records += 1
+            if n_records % chunk_size == 0:
+                flush()
+        flush()
+    finally:
+        for file in files.values():
+            file.close()
+        jsn_file.close()
+    # Write the metadata last
+    meta = dict(
+        version=format_version,
+        byteorder=sys.byteorder,
+        n_records=n_records,
+        columns=columns,
+        tables=intern_tbl.objects,
+        types=intern_typ.objects,
+        values=intern_val.objects,
+    )
+    with open(store_dir / meta_filename, 'wt') as file:
+        json.dump(meta, file)
+    logger.info('Compiled {} records into event store: {}',
+                n_records, store_dir)
+    return n_records
+
+
+class EventStore:
+    """
+    Read-only access to the columns of an event store.
+
+    The columns are memory mapped, so opening a store is fast and only
+    the parts that are read are loaded into memory.
+    """
+
+    def __init__(self, store_dir):
+        self.path = pathlib.Path(store_dir)
+        with open(self.path / meta_filename, 'rt') as file:
+            meta = json.load(file)
+        if meta['version'] != format_version:
+            raise ValueError(
+                'Unsupported event store version: {}'.format(
+                    meta['version']))
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(
+                'Event store has byte order {!r} but this machine has '
+                '{!r}'.format(meta['byteorder'], sys.byteorder))
+        self.n_records = meta['n_records']
+        self.tables = meta['tables']
+        self.types = meta['types']
+        self.values = meta['values']
+        self._mmaps = []
+        self.columns = {name: self._map(name + '.bin', code)
+                        for (name, code) in columns.items()}
+        self.jsn = self._map('jsn.bin', 'B')
+
+    def _map(self, filename, type_code):
+        with open(self.path / filename, 'rb') as file:
+            # Empty files cannot be memory mapped
+            if file.seek(0, 2) == 0:
+                return memoryview(array.array(type_code))
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(mm)
+        return memoryview(mm).cast(type_code)
+
+    def close(self):
+        for col in self.columns.values():
+            col.release()
+        self.jsn.release()
+        for mm in self._mmaps:
+            mm.close()
+        self._mmaps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.n_records
+
+
+def read_records(
+        store_dir,
+        include_tables=set(event_data.tables),
+        json_constructor=json.loads,
+        include_record=None,
+        record_transformer=None,
+        include_ids=None,
+        collector=None,
+        resume_after_id=None,
+):
+    """
+    Read event records from an event store.
+
+    This is the counterpart of `event_data.read_records` and yields the
+    same records in the same order as reading the original CSV would.
+    Dropped records are counted in the given metrics collector (if any)
+    and records are skipped through `resume_after_id` (if given) like
+    `event_data.read_records` does.
+    """
+    logger = logging.getLogger(__name__)
+    def tracker(count):
+        logger.info('Store records: {}', count)
+    with EventStore(store_dir) as store:
+        cols = store.columns
+        ids = cols['id']
+        los = cols['lo']
+        his = cols['hi']
+        tbls = cols['tbl']
+        typs = cols['typ']
+        val_kinds = cols['val_kind']
+        val_ints = cols['val_int']
+        val_flts = cols['val_flt']
+        jsn_offs = cols['jsn_off']
+        jsn = store.jsn
+        tables = store.tables
+        types = store.types
+        values = store.values
+        if include_ids is not None:
+            include_ids = set(int(i) for i in include_ids)
+        # Only look at the tables to include
+        include_tbls = bytes(
+            idx < len(tables) and tables[idx] in include_tables
+            for idx in range(256))
+        # Convert dates from ordinals.  There are not many distinct
+        # dates, so remember them.
+        ord2date = {0: None}
+        def to_date(ordinal):
+            date = ord2date.get(ordinal, False)
+            if date is False:
+                date = datetime.date.fromordinal(ordinal)
+                ord2date[ordinal] = date
+            return date
+        # Find where to resume by looking only at the IDs
+        start = 0
+        if resume_after_id is not None:
+            start = next((idx for idx in range(len(store))
+                          if ids[idx] == resume_after_id), None)
+            if start is None:
+                raise ValueError(
+                    'Input does not match checkpoint: No records with ID '
+                    '{!r}'.format(resume_after_id))
+            while start < len(store) and ids[start] == resume_after_id:
+                start += 1
+        for idx in general.track_iterator(
+                range(start, len(store)),
+                tracker, track_every=100000,
+                track_init=True, track_end=True):
+            tbl = tbls[idx]
+            if not include_tbls[tbl]:
+                continue
+            if not (include_ids is None or ids[idx] in include_ids):
+                continue
+            val_kind = val_kinds[idx]
+            if val_kind == val_none:
+                val = None
+            elif val_kind == val_int:
+                val = val_ints[idx]
+            elif val_kind == val_flt:
+                val = val_flts[idx]
+            else:
+                val = values[val_ints[idx]]
+            jsn_lo = jsn_offs[idx]
+            jsn_hi = jsn_offs[idx + 1]
+            if jsn_hi > jsn_lo:
+                jsn_txt = str(jsn[jsn_lo:jsn_hi], 'utf-8')
+                if json_constructor is not None:
+                    jsn_txt = json_constructor(jsn_txt)
+            else:
+                jsn_txt = None
+            record = [
+                ids[idx],
+                to_date(los[idx]),
+                to_date(his[idx]),
+                tables[tbl],
+                types[typs[idx]],
+                val,
+                jsn_txt,
+            ]
+            # Filter records if requested
+            if not (include_record is None or include_record(record)):
+                # Count dropped records if collecting metrics
+                if collector is not None:
+                    collector.count('records_dropped_by_include_record')
+                continue
+            # Transform record
+            if record_transformer is not None:
+                record = record_transformer(record)
+            yield record
+
+
+# Tests
+
+
+class EventStoreTest(unittest.TestCase):
+
+    events_csv_text = '''
+id|lo|hi|tbl|typ|val|jsn
+1|||bx|dob|1932-11-29|
+1|||bx|gndr|M|
+1|||bx|race|8552|
+1|1991-11-15|1991-11-15|mx|3000330|4069590|
+1|1991-11-15|1991-11-15|mx|3000331|100.0|
+1|1991-11-15|1991-11-15|px|2108115||
+1|1996-06-01||dx|80180||
+1|1997-07-01||dlux|486||
+2|2009-07-04|2009-07-04|ox|4222303||{"a":1,"b":2,"3":"c"}
+2|2009-07-30|2009-08-29|rx|19078559||{"days_supply":30}
+2|2009-08-12||xx|||"|||||"
+'''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = pathlib.Path(self.tmp_dir.name) / 'evs'
+        compile_store(io.StringIO(self.events_csv_text), self.store_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_is_event_store(self):
+        self.assertTrue(is_event_store(self.store_dir))
+        self.assertTrue(is_event_store(str(self.store_dir)))
+        self.assertFalse(is_event_store(self.store_dir.parent))
+
+    def test_read_records(self):
+        expected = list(event_data.read_records(
+            io.StringIO(self.events_csv_text)))
+        actual = list(read_records(self.store_dir))
+        self.maxDiff = None
+        self.assertEqual(expected, actual)
+        # Make sure types agree because `1 == 1.0` in Python
+        self.assertEqual([[type(f) for f in r] for r in expected],
+                         [[type(f) for f in r] for r in actual])
+
+    def test_read_records__include_tables(self):
+        actual = list(read_records(
+            self.store_dir, include_tables={'rx', 'xx'},
+            json_constructor=None))
+        expected = [
+            [2, datetime.date(2009, 7, 30), datetime.date(2009, 8, 29),
+             'rx', 19078559, None, '{"days_supply":30}'],
+            [2, datetime.date(2009, 8, 12), None,
+             'xx', None, None, '"|||||"'],
+        ]
+        self.assertEqual(expected, actual)
+
+    def test_read_records__include_ids(self):
+        actual = [r[:4] for r in read_records(
+            self.store_dir, include_tables={'bx', 'rx'},
+            include_ids={'2'})]
+        expected = [
+            [2, datetime.date(2009, 7, 30), datetime.date(2009, 8, 29),
+             'rx'],
+        ]
+        self.assertEqual(expected, actual)
+
+    def test_read_records__resume_after_id(self):
+        expected = [r for r in read_records(self.store_dir) if r[0] == 2]
+        self.assertEqual(
+            expected, list(read_records(self.store_dir, resume_after_id=1)))
+        self.assertEqual(
+            [], list(read_records(self.store_dir, resume_after_id=2)))
+        with self.assertRaises(ValueError):
+            list(read_records(self.store_dir, resume_after_id=3))
+
+
+# Main
+
+
+def cli(function_name, *args):
+    """
+    Call the given function from this module with the given string
+    arguments.
+    """
+    globals()[function_name](*args)
+
+
+if __name__ == '__main__':
+    logging.default_config()
+    cli(*sys.argv[1:])
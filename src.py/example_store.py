@@ -0,0 +1,505 @@
+# Compact, columnar, on-disk storage of survival examples
+
+# Copyright (c) 2019 Aubrey Barnard.  This is free software released
+# under the MIT License (https://choosealicense.com/licenses/mit/).
+
+# An example store is a directory that contains one binary file per
+# column plus metadata.  It is an alternative to writing survival
+# examples as text so that analysis programs can load the examples
+# without parsing text.  Each column file is a plain array that NumPy
+# can `memmap` and R can `readBin`.
+#
+# Columns (all in native byte order, which is recorded in the
+# metadata):
+#
+# * `id.bin`: patient ID (int64)
+# * `date_lo.bin`, `date_hi.bin`: date as days since 1970-01-01 (int32)
+# * `lo.bin`, `hi.bin`, `len.bin`: survival times in days (int32)
+# * `exp.bin`, `out.bin`: exposure and outcome indicators (int8)
+# * `<covariate>.bin`: one file per covariate, of one of the following
+#   kinds depending on the values of the covariate:
+#   * `float`: numbers (float64), NaN for missing
+#   * `factor`: strings as codes (int32) that are zero-based indices
+#     into the levels in `<covariate>.levels.txt` (one level per line)
+#   * `date`: dates like the dates above
+#
+# A covariate whose values are of different kinds (e.g. numeric codes
+# and also "Unknown") is a factor whose levels are the values as text.
+# Its column is rewritten as a factor when a value of another kind
+# first appears.
+#
+# Missing integers (codes and dates) are -2147483648, which is how R
+# represents `NA` integers.
+#
+# The metadata is in `meta.json` (format version, byte order, number of
+# examples, and the name, kind, and type of each column in order) and
+# also in `columns.csv` (name, kind, and type of each column) for
+# programs that do not read JSON.  For example, in NumPy:
+#
+#     np.memmap('store/hi.bin', dtype=np.int32, mode='r')
+#
+# and in R, see `src.R/read_example_store.R`.
+
+
+import array
+import datetime
+import json
+import math
+import pathlib
+import sys
+import tempfile
+import unittest
+
+from barnapy import logging
+
+
+format_version = 1
+
+meta_filename = 'meta.json'
+columns_filename = 'columns.csv'
+
+# Column type -> array type code
+type2code = {
+    'int8': 'b',
+    'int32': 'i',
+    'int64': 'q',
+    'float64': 'd',
+}
+
+# Fixed columns: (name, kind, type)
+fixed_columns = (
+    ('id', 'int', 'int64'),
+    ('date_lo', 'date', 'int32'),
+    ('date_hi', 'date', 'int32'),
+    ('lo', 'int', 'int32'),
+    ('hi', 'int', 'int32'),
+    ('len', 'int', 'int32'),
+    ('exp', 'int', 'int8'),
+    ('out', 'int', 'int8'),
+)
+
+# Covariate kind -> column type
+kind2type = {
+    'float': 'float64',
+    'factor': 'int32',
+    'date': 'int32',
+}
+
+na_int = -(2 ** 31)
+
+_epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+
+def _kind_of(value):
+    # Return the covariate kind for the given (non-`None`) value
+    if isinstance(value, (bool, int, float)):
+        return 'float'
+    elif isinstance(value, str):
+        return 'factor'
+    elif isinstance(value, datetime.date):
+        return 'date'
+    raise ValueError(
+        'Unsupported covariate value: {!r}'.format(value))
+
+
+def _level_of(value):
+    # Return the factor level for the given (non-`None`) value.  Whole
+    # numbers are written without decimals so that numbers read back
+    # from a float column have the same levels as the original integers.
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _check_name(name):
+    if (not isinstance(name, str) or not name or
+            any(c in name for c in '/\\|\n\r\t') or
+            name.startswith('.')):
+        raise ValueError('Bad column name: {!r}'.format(name))
+    return name
+
+
+class ExampleStoreWriter:
+    """
+    Writes flattened survival examples (see
+    `survival_data.flatten_survival_example`) to an example store in the
+    given directory.
+
+    Examples are buffered and written in chunks of `chunk_size` rows.
+    The kind of each covariate is determined by its first non-missing
+    value, and a covariate becomes a factor if it has values of another
+    kind.  The store is complete only after `close`.  Use `abort` to
+    stop writing after an error (using the writer as a context manager
+    does this).
+    """
+
+    def __init__(self, store_dir, covariate_names=(), chunk_size=65536):
+        self.path = pathlib.Path(store_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Remove any existing metadata so that an incomplete store is
+        # not recognized as a store
+        (self.path / meta_filename).unlink(missing_ok=True)
+        self.chunk_size = chunk_size
+        self.names = [name for (name, _, _) in fixed_columns]
+        self.kinds = [kind for (_, kind, _) in fixed_columns]
+        for name in covariate_names:
+            self._add_column(name)
+        self.n_examples = 0
+        self._n_fixed = len(fixed_columns)
+        self._chunks = None
+        self._files = {}
+        self._levels = {}
+        self._n_leading_missing = {}
+
+    def _add_column(self, name):
+        name = _check_name(name)
+        if name in self.names:
+            raise ValueError('Duplicate column name: {!r}'.format(name))
+        self.names.append(name)
+        self.kinds.append(None)
+
+    def write(self, rows):
+        """Write the given flattened survival examples."""
+        for row in rows:
+            # Fix the number of columns with the first row, naming any
+            # unnamed covariates
+            if self._chunks is None:
+                for idx in range(len(self.names), len(row)):
+                    self._add_column('x{}'.format(idx - self._n_fixed + 1))
+                self._chunks = [[] for _ in self.names]
+            if len(row) != len(self.names):
+                raise ValueError(
+                    'Example has {} fields but store has {} columns: '
+                    '{!r}'.format(len(row), len(self.names), row))
+            for chunk, value in zip(self._chunks, row):
+                chunk.append(value)
+            self.n_examples += 1
+            if len(self._chunks[0]) >= self.chunk_size:
+                self.flush()
+
+    def _file(self, name):
+        file = self._files.get(name)
+        if file is None:
+            file = open(self.path / (name + '.bin'), 'wb')
+            self._files[name] = file
+        return file
+
+    def _encode(self, idx, values):
+        # Encode the given values of the given column as an array
+        name = self.names[idx]
+        kind = self.kinds[idx]
+        if idx < self._n_fixed:
+            type_ = fixed_columns[idx][2]
+        else:
+            type_ = kind2type[kind]
+        if kind == 'date':
+            values = [(value.toordinal() - _epoch_ordinal
+                       if value is not None
+                       else na_int)
+                      for value in values]
+        elif kind == 'float':
+            floats = []
+            for value in values:
+                if value is None:
+                    floats.append(math.nan)
+                elif isinstance(value, (bool, int, float)):
+                    floats.append(float(value))
+                else:
+                    raise ValueError(
+                        'Non-numeric value in numeric column {!r}: '
+                        '{!r}'.format(name, value))
+            values = floats
+        elif kind == 'factor':
+            level2code = self._levels.setdefault(name, {})
+            codes = []
+            for value in values:
+                if value is None:
+                    codes.append(na_int)
+                    continue
+                if not isinstance(value, str):
+                    value = _level_of(value)
+                code = level2code.get(value)
+                if code is None:
+                    code = len(level2code)
+                    level2code[value] = code
+                codes.append(code)
+            values = codes
+        return array.array(type2code[type_], values)
+
+    def flush(self):
+        """Write the buffered examples to the column files."""
+        if self._chunks is None:
+            return
+        for idx, values in enumerate(self._chunks):
+            name = self.names[idx]
+            # Determine the kind of a covariate from its first value.
+            # Remember how many values are missing until then.
+            if self.kinds[idx] is None:
+                first = next((v for v in values if v is not None), None)
+                if first is None:
+                    self._n_leading_missing[name] = (
+                        self._n_leading_missing.get(name, 0) + len(values))
+                    del values[:]
+                    continue
+                self.kinds[idx] = _kind_of(first)
+                n_missing = self._n_leading_missing.pop(name, 0)
+                values[:0] = [None] * n_missing
+            # Make a covariate with values of different kinds a factor
+            kind = self.kinds[idx]
+            if (idx >= self._n_fixed and kind != 'factor' and
+                    any(v is not None and _kind_of(v) != kind
+                        for v in values)):
+                self._make_factor(idx)
+            self._encode(idx, values).tofile(self._file(name))
+            del values[:]
+
+    def _make_factor(self, idx):
+        # Change the kind of the given covariate to factor, rewriting the
+        # values written so far (if any) as levels
+        name = self.names[idx]
+        kind = self.kinds[idx]
+        logging.getLogger(__name__).warning(
+            'Covariate {!r} has values of different kinds.  Storing it as '
+            'a factor instead of {}.', name, kind)
+        self.kinds[idx] = 'factor'
+        file = self._files.pop(name, None)
+        if file is None:
+            return
+        file.close()
+        path = self.path / (name + '.bin')
+        values = array.array(type2code[kind2type[kind]])
+        with open(path, 'rb') as file:
+            values.frombytes(file.read())
+        if kind == 'date':
+            values = [(datetime.date.fromordinal(v + _epoch_ordinal)
+                       if v != na_int
+                       else None)
+                      for v in values]
+        else:
+            values = [v if not math.isnan(v) else None for v in values]
+        self._encode(idx, values).tofile(self._file(name))
+
+    def close(self):
+        """Write any buffered examples and the metadata."""
+        self.flush()
+        # Covariates that are always missing are numbers
+        for idx, name in enumerate(self.names):
+            if self.kinds[idx] is None:
+                self.kinds[idx] = 'float'
+                self._encode(
+                    idx, [None] * self._n_leading_missing.pop(name, 0),
+                ).tofile(self._file(name))
+            # Make sure every column has a file
+            self._file(name)
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+        # Write the levels of factors
+        columns = []
+        for idx, (name, kind) in enumerate(zip(self.names, self.kinds)):
+            type_ = (fixed_columns[idx][2]
+                     if idx < self._n_fixed
+                     else kind2type[kind])
+            column = dict(name=name, kind=kind, type=type_)
+            if kind == 'factor':
+                levels = list(self._levels.get(name, {}))
+                with open(self.path / (name + '.levels.txt'), 'wt',
+                          encoding='utf-8') as file:
+                    for level in levels:
+                        print(level, file=file)
+                column['levels'] = levels
+            columns.append(column)
+        with open(self.path / columns_filename, 'wt') as file:
+            print('name', 'kind', 'type', sep='|', file=file)
+            for column in columns:
+                print(column['name'], column['kind'], column['type'],
+                      sep='|', file=file)
+        # Write the metadata last
+        meta = dict(
+            version=format_version,
+            byteorder=sys.byteorder,
+            n_examples=self.n_examples,
+            columns=columns,
+        )
+        with open(self.path / meta_filename, 'wt') as file:
+            json.dump(meta, file)
+
+    def abort(self):
+        """
+        Close the column files and delete them without completing the
+        store.
+        """
+        for (name, file) in self._files.items():
+            file.close()
+            (self.path / (name + '.bin')).unlink(missing_ok=True)
+        self._files = {}
+        self._chunks = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def is_example_store(path):
+    """Return whether the given path is the directory of an example store."""
+    return (isinstance(path, (str, pathlib.Path)) and
+            (pathlib.Path(path) / meta_filename).is_file())
+
+
+def read_columns(store_dir):
+    """
+    Read the columns of the example store in the given directory.
+
+    Return a pair of the metadata and a dictionary of column name to
+    array of values (encoded as described above).
+    """
+    store_dir = pathlib.Path(store_dir)
+    with open(store_dir / meta_filename, 'rt') as file:
+        meta = json.load(file)
+    if meta['version'] != format_version:
+        raise ValueError(
+            'Unsupported example store version: {}'.format(
+                meta['version']))
+    if meta['byteorder'] != sys.byteorder:
+        raise ValueError(
+            'Example store has byte order {!r} but this machine has '
+            '{!r}'.format(meta['byteorder'], sys.byteorder))
+    columns = {}
+    for column in meta['columns']:
+        arr = array.array(type2code[column['type']])
+        with open(store_dir / (column['name'] + '.bin'), 'rb') as file:
+            arr.fromfile(file, meta['n_examples'])
+        columns[column['name']] = arr
+    return meta, columns
+
+
+def read_examples(store_dir):
+    """
+    Read the examples in the given example store as flattened survival
+    examples, decoding dates, factors, and missing values.
+    """
+    meta, columns = read_columns(store_dir)
+    decoded = []
+    for column in meta['columns']:
+        values = columns[column['name']]
+        kind = column['kind']
+        if kind == 'date':
+            values = [(datetime.date.fromordinal(v + _epoch_ordinal)
+                       if v != na_int
+                       else None)
+                      for v in values]
+        elif kind == 'factor':
+            levels = column['levels']
+            values = [levels[v] if v != na_int else None for v in values]
+        elif kind == 'float':
+            values = [v if not math.isnan(v) else None for v in values]
+        else:
+            values = list(values)
+        decoded.append(values)
+    return [list(row) for row in zip(*decoded)]
+
+
+# Tests
+
+
+class ExampleStoreTest(unittest.TestCase):
+
+    d = datetime.date
+
+    examples = [
+        [1, d(2000, 1, 1), d(2000, 3, 1), 0, 60, 60, 1, 0,
+         None, None, None, None],
+        [1, d(2000, 3, 1), d(2001, 1, 1), 60, 366, 306, 0, 1,
+         None, 'M', None, None],
+        [2, d(1999, 6, 1), d(1999, 6, 1), 0, 0, 0, 0, 1,
+         61.5, 'F', d(1930, 2, 3), None],
+        [3, d(1999, 6, 1), d(2010, 6, 1), 0, 4018, 4018, 0, 0,
+         40, None, None, None],
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_dir = pathlib.Path(self.tmp_dir.name) / 'exs'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_read(self):
+        # Small chunks so that kinds are determined in later chunks
+        with ExampleStoreWriter(
+                self.store_dir, ('age', 'sex'), chunk_size=1) as writer:
+            writer.write(self.examples[:3])
+            writer.write(self.examples[3:])
+        self.assertTrue(is_example_store(self.store_dir))
+        meta, columns = read_columns(self.store_dir)
+        self.assertEqual(4, meta['n_examples'])
+        self.assertEqual(
+            ['id', 'date_lo', 'date_hi', 'lo', 'hi', 'len', 'exp', 'out',
+             'age', 'sex', 'x3', 'x4'],
+            [c['name'] for c in meta['columns']])
+        self.assertEqual(
+            ['float', 'factor', 'date', 'float'],
+            [c['kind'] for c in meta['columns'][8:]])
+        self.assertEqual([60, 366, 0, 4018], list(columns['hi']))
+        self.assertEqual(
+            [na_int, 0, 1, na_int], list(columns['sex']))
+        self.assertEqual(
+            'M\nF\n', (self.store_dir / 'sex.levels.txt').read_text())
+        self.assertEqual(self.examples, read_examples(self.store_dir))
+
+    def test_write__mixed_kinds(self):
+        d = datetime.date
+        race = [None, 8552, 8527, 'Unknown', 8552, None, d(2000, 1, 2)]
+        rows = [[i, *self.examples[0][1:8], value, 61.5]
+                for (i, value) in enumerate(race)]
+        # Whether or not the values of the first kind were already written
+        for chunk_size in (1, 2, 100):
+            with ExampleStoreWriter(
+                    self.store_dir, ('race', 'age'),
+                    chunk_size=chunk_size) as writer:
+                writer.write(rows)
+            meta, columns = read_columns(self.store_dir)
+            self.assertEqual(
+                ['factor', 'float'], [c['kind'] for c in meta['columns'][8:]])
+            self.assertEqual(['8552', '8527', 'Unknown', '2000-01-02'],
+                             meta['columns'][8]['levels'])
+            self.assertEqual([na_int, 0, 1, 2, 0, na_int, 3],
+                             list(columns['race']))
+            self.assertEqual(
+                [[*row[:8], (str(row[8]) if row[8] is not None else None),
+                  61.5] for row in rows],
+                read_examples(self.store_dir))
+
+    def test_write__abort(self):
+        with self.assertRaises(KeyError):
+            with ExampleStoreWriter(
+                    self.store_dir, ('age',), chunk_size=1) as writer:
+                writer.write([self.examples[2][:9]])
+                self.assertTrue((self.store_dir / 'age.bin').exists())
+                raise KeyError('oops')
+        self.assertEqual({}, writer._files)
+        self.assertFalse(is_example_store(self.store_dir))
+        self.assertEqual([], list(self.store_dir.glob('*.bin')))
+
+    def test_write__bad_values(self):
+        writer = ExampleStoreWriter(self.store_dir, ('age',))
+        writer.write([[*self.examples[3][:8], [40]]])
+        with self.assertRaises(ValueError):
+            writer.close()
+        writer.abort()
+        with self.assertRaises(ValueError):
+            ExampleStoreWriter(self.store_dir, ('age', 'age'))
+        writer = ExampleStoreWriter(self.store_dir)
+        writer.write([self.examples[2][:9]])
+        with self.assertRaises(ValueError):
+            writer.write([self.examples[2][:10]])
+
+    def test_write__empty(self):
+        with ExampleStoreWriter(self.store_dir, ('age',)):
+            pass
+        self.assertEqual([], read_examples(self.store_dir))
@@ -6,18 +6,35 @@
 # (https://choosealicense.com/licenses/mit/).
 
 
+import bisect
 import csv
 import datetime
 import json
 import math
+import pathlib
+import random
 import re
 import sys
+import tempfile
+import unittest
 
 from cdmdata import events
 from cdmdata import examples
 from cdmdata import features
 from cdmdata import records
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# "Install" related modules by updating import path
+this_dir = pathlib.Path(__file__).absolute().parent
+sys.path.append(str(this_dir))
+
+import event_data
+import event_store
+
 
 # Utilities
 
@@ -63,22 +80,164 @@ name2time_parser = {
 }
 
 
+# Handling event types
+
+
+def _fact_value_from_record(record):
+    # Facts are `(tbl, typ)` -> value like those of `cdmdata`
+    _, _, _, tbl, typ, val, _ = record
+    return ((tbl, typ), val)
+
+
+def read_event_types(file, comment_char='#', delimiter='|'):
+    """
+    Read `tbl|typ` event types (one per line) from the given file and
+    return them as a list of `(tbl, typ)` pairs.  An empty type (as in
+    `xx|`) means all the events in the table.
+    """
+    event_types = []
+    with open(file, 'rt') as lines:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(comment_char):
+                continue
+            tbl, typ = (line.split(delimiter, 1) + [''])[:2]
+            event_types.append((tbl, typ or None))
+    return event_types
+
+
+def mk_event_type_predicate(event_types):
+    """
+    Return a function that tells whether an event type `(tbl, typ)` is
+    one of the given event types.  Types are compared as text, and a
+    type of `None` matches all the events in its table.
+    """
+    tbls = {tbl for (tbl, typ) in event_types if typ is None}
+    pairs = {(tbl, str(typ)) for (tbl, typ) in event_types
+             if typ is not None}
+    def is_event_type(event_type):
+        tbl, typ = event_type
+        return tbl in tbls or (tbl, str(typ)) in pairs
+    return is_event_type
+
+
+# Counting and labeling events in intervals
+
+
+def _event_bounds(ev_seq, to_number, is_outcome):
+    # Return the sorted starts and the sorted ends of the events in the
+    # given sequence as numbers (or `None` for both if some event is not
+    # a closed interval) and the sorted starts of the outcome events
+    starts = []
+    ends = []
+    outcome_starts = []
+    for event in ev_seq:
+        when = event.when
+        lo = getattr(when, 'lo', when)
+        hi = getattr(when, 'hi', when)
+        if lo is not None and is_outcome(event.type):
+            outcome_starts.append(to_number(lo))
+        if starts is None:
+            continue
+        if (lo is None or hi is None or
+                getattr(when, 'is_lo_open', False) or
+                getattr(when, 'is_hi_open', False)):
+            starts = ends = None
+            continue
+        starts.append(to_number(lo))
+        ends.append(to_number(hi))
+    if starts is not None:
+        starts.sort()
+        ends.sort()
+    outcome_starts.sort()
+    return starts, ends, outcome_starts
+
+
+def count_overlapping(starts, ends, los, his):
+    """
+    Return the number of events that overlap each of the given closed
+    intervals, where the events are given by their sorted starts and
+    sorted ends.
+
+    An event overlaps `[lo, hi]` if it starts no later than `hi` and
+    ends no earlier than `lo`.  The events that end before `lo` are a
+    subset of those that start no later than `hi`, so the count is the
+    difference of two binary searches (done for all the intervals at
+    once with NumPy if it is installed).  Every interval must have `lo
+    <= hi`.
+    """
+    if np is not None and los:
+        counts = (np.searchsorted(starts, his, side='right') -
+                  np.searchsorted(ends, los, side='left'))
+        return counts.tolist()
+    return [bisect.bisect_right(starts, hi) - bisect.bisect_left(ends, lo)
+            for (lo, hi) in zip(los, his)]
+
+
+def _count_events(ev_seq, starts, ends, los, his, lo_nums, hi_nums):
+    # Return the number of events that overlap each of the given
+    # intervals.  Count from the sorted bounds of the events (see
+    # `_event_bounds`) if the events and intervals are supported, and
+    # fall back to searching the sequence for each interval otherwise.
+    if starts is not None and all(
+            lo <= hi for (lo, hi) in zip(lo_nums, hi_nums)):
+        return count_overlapping(starts, ends, lo_nums, hi_nums)
+    return [len(ev_seq.events_overlapping(lo, hi))
+            for (lo, hi) in zip(los, his)]
+
+
+def label_intervals(outcome_starts, los, his, horizon=0):
+    """
+    Return whether an outcome starts in each of the given closed
+    intervals or within `horizon` after it (i.e. in `[lo, hi +
+    horizon]`), where the outcomes are given by their sorted starts.
+
+    The intervals must be sorted by their starts, so the outcomes that
+    start before each interval are a growing prefix and all the labels
+    are found in a single scan of the outcomes.
+    """
+    labels = []
+    n_outcomes = len(outcome_starts)
+    idx = 0
+    for (lo, hi) in zip(los, his):
+        # Skip the outcomes that start before this interval
+        while idx < n_outcomes and outcome_starts[idx] < lo:
+            idx += 1
+        labels.append(idx < n_outcomes and
+                      outcome_starts[idx] <= hi + horizon)
+    return labels
+
+
 # API entry points
 
 
-# TODO how label / classify examples?
 def gen_examples_at_intervals(
         events_csv_filename,
         time_type_name,
         start_age_years=30,
         interval_length_days=365.25,
+        outcome_types=(('xx', None),),
+        horizon_days=0,
 ):
+    """
+    Yield an example for each interval of each patient's life starting
+    at the given age.
+
+    An example is labeled 1 if one of the given outcome types (by
+    default death) starts in its interval or within `horizon_days`
+    after it and 0 otherwise.  (Thus `mk_fvs` can be run on the examples
+    with the positive label `1`.)  If the time type is "date",
+    `horizon_days` is truncated to whole days (e.g. 1.9 is 1).
+    """
+    is_outcome = mk_event_type_predicate(outcome_types)
     # Set up math with times that are either floats or dates.  Use typed
     # constants à la Julia.
     time_zero = 0.0
     time_one = 1.0
     mk_days_flt = float
     mk_years_flt = float
+    to_number = float
+    horizon = horizon_days
     if time_type_name == 'date':
         start_age_years = datetime.timedelta(
             days=start_age_years * 365.25)
@@ -88,11 +247,39 @@ def gen_examples_at_intervals(
         time_one = datetime.timedelta(1)
         mk_days_flt = td_to_days
         mk_years_flt = td_to_years
+        to_number = datetime.date.toordinal
+        # Dates and day counts are added by whole days
+        horizon = datetime.timedelta(days=horizon_days).days
+    # The ages at the bounds of the intervals are the same for every
+    # patient, so compute them once (as they are needed).  In date mode,
+    # adding an age to a date only uses its days, so the bounds of the
+    # intervals are computed as ordinals without any date arithmetic.
+    bound_ages = []
+    bound_days = []
+    bound_years = []
+    def extend_bounds(n_bounds):
+        for k in range(len(bound_ages), n_bounds):
+            age = start_age_years + k * interval_length_days
+            bound_ages.append(age)
+            bound_years.append(mk_years_flt(age))
+            if time_type_name == 'date':
+                bound_days.append(age.days)
     # Derive needed values
     events_header = events.header(name2time_parser[time_type_name])
     # Read event records and construct an event sequence for each
-    # patient.  Then yield an example for each interval
-    for ev_seq in events.read_sequences(
+    # patient.  Build the sequences directly from the already parsed
+    # records of an event store if given one (which skips splitting and
+    # parsing CSV) and from CSV otherwise.
+    if event_store.is_event_store(events_csv_filename):
+        if time_type_name != 'date':
+            raise ValueError(
+                'Event stores only support the time type "date", not: '
+                '{!r}'.format(time_type_name))
+        ev_seqs = event_data.event_sequences_from_records(
+            event_store.read_records(events_csv_filename),
+            fact_constructor=_fact_value_from_record)
+    else:
+        ev_seqs = events.read_sequences(
             records.read_csv(
                 events_csv_filename,
                 events.csv_format,
@@ -102,7 +289,9 @@ def gen_examples_at_intervals(
             ),
             header=events_header,
             parse_record=records.mk_parser(events_header),
-    ):
+        )
+    # Yield an example for each interval
+    for ev_seq in ev_seqs:
         # Get the patient's date of birth
         dob = ev_seq.fact(('bx', 'dob'))
         # Skip this patient if they don't have a DOB
@@ -116,21 +305,40 @@ def gen_examples_at_intervals(
         # Skip this patient if they are too young
         if span_len < time_zero:
             continue
-        # Loop to produce each interval and its example
-        curr_age = start_age_years
+        # Compute the bounds of all the intervals.  Interval `i` starts
+        # at age `bound_ages[i]` and ends the day before age
+        # `bound_ages[i + 1]`.
         n_itvls = math.ceil(span_len / interval_length_days)
+        extend_bounds(n_itvls + 1)
+        if time_type_name == 'date':
+            dob_day = dob.toordinal()
+            lo_nums = [dob_day + days for days in bound_days[:n_itvls]]
+            hi_nums = [dob_day + days - 1
+                       for days in bound_days[1:n_itvls + 1]]
+            los = [datetime.date.fromordinal(n) for n in lo_nums]
+            his = [datetime.date.fromordinal(n) for n in hi_nums]
+            itvl_lens = [float(hi - lo)
+                         for (lo, hi) in zip(lo_nums, hi_nums)]
+        else:
+            los = [dob + age for age in bound_ages[:n_itvls]]
+            his = [dob + age - time_one
+                   for age in bound_ages[1:n_itvls + 1]]
+            lo_nums = los
+            hi_nums = his
+            itvl_lens = [mk_days_flt(hi - lo) for (lo, hi) in zip(los, his)]
+        # Count the events in all the intervals at once from the sorted
+        # bounds of the events
+        starts, ends, outcome_starts = _event_bounds(
+            ev_seq, to_number, is_outcome)
+        n_evss = _count_events(
+            ev_seq, starts, ends, los, his, lo_nums, hi_nums)
+        # Label all the intervals in the same pass
+        lbls = label_intervals(outcome_starts, lo_nums, hi_nums, horizon)
+        # Yield the example for each interval
         for i in range(n_itvls):
-            next_age = start_age_years + (i + 1) * interval_length_days
-            lo = dob + curr_age
-            hi = dob + next_age - time_one # Back off by one
-            itvl_len = mk_days_flt(hi - lo)
-            n_evs = len(ev_seq.events_overlapping(lo, hi))
-            age_flt = mk_years_flt(curr_age)
-            lbl = f'{i + 1}/{n_itvls}' # TODO remove this placeholder
-            yield [ev_seq.id, lo, hi, lbl, None, None,
-                   itvl_len, n_evs, age_flt]
-            # Increment
-            curr_age = next_age
+            lbl = int(lbls[i])
+            yield [ev_seq.id, los[i], his[i], lbl, None, None,
+                   itvl_lens[i], n_evss[i], bound_years[i]]
 
 
 # CLI entry points
@@ -141,7 +349,13 @@ def gen_ex_itvls(
         time_type_name,
         start_age_years=30,
         interval_length_days=365,
+        outcome_types_filename='',
+        horizon_days=0,
 ):
+    # Label by death unless given a file of outcome types
+    outcome_types = (read_event_types(outcome_types_filename)
+                     if outcome_types_filename
+                     else (('xx', None),))
     print_records(
         examples.csv_format,
         examples.header(name2time_parser[time_type_name]),
@@ -150,6 +364,8 @@ def gen_ex_itvls(
             time_type_name,
             float(start_age_years),
             float(interval_length_days),
+            outcome_types,
+            float(horizon_days),
         ),
     )
 
@@ -182,6 +398,171 @@ def mk_fvs(
         features.write_vector(cls, fv, sys.stdout)
 
 
+# Tests
+
+
+class _Interval:
+    # Minimal interval like those of events in sequences
+    def __init__(self, lo, hi, is_lo_open=False, is_hi_open=False):
+        self.lo = lo
+        self.hi = hi
+        self.is_lo_open = is_lo_open
+        self.is_hi_open = is_hi_open
+
+
+class _Event:
+    def __init__(self, when, type):
+        self.when = when
+        self.type = type
+
+
+class _Sequence(list):
+    # Minimal event sequence that counts overlapping events by a linear
+    # scan and remembers the intervals it was asked about
+    def __init__(self, events):
+        super().__init__(events)
+        self.queries = []
+
+    def events_overlapping(self, lo, hi):
+        self.queries.append((lo, hi))
+        def overlaps(event):
+            when = event.when
+            ev_lo = getattr(when, 'lo', when)
+            ev_hi = getattr(when, 'hi', when)
+            return ((ev_lo is None or ev_lo <= hi) and
+                    (ev_hi is None or ev_hi >= lo))
+        return [event for event in self if overlaps(event)]
+
+
+class CountingTest(unittest.TestCase):
+
+    def count(self, ev_seq, los, his):
+        starts, ends, _ = _event_bounds(ev_seq, float, lambda t: False)
+        return _count_events(ev_seq, starts, ends, los, his, los, his)
+
+    def test_count_overlapping__edges(self):
+        # Events: [3, 5] and the points 5 and 9
+        ev_seq = _Sequence([
+            _Event(_Interval(3, 5), ('dx', 1)),
+            _Event(5, ('dx', 2)),
+            _Event(_Interval(9, 9), ('dx', 3)),
+        ])
+        los = [0, 5, 6, 9, 0, 3, 10]
+        his = [2, 5, 8, 9, 3, 20, 12]
+        expected = [0, 2, 0, 1, 1, 3, 0]
+        self.assertEqual(expected, self.count(ev_seq, los, his))
+        self.assertEqual([], ev_seq.queries)
+        self.assertEqual(expected, [len(ev_seq.events_overlapping(lo, hi))
+                                    for (lo, hi) in zip(los, his)])
+
+    def test_count_overlapping__random(self):
+        global np
+        rng = random.Random(0)
+        numpy = np
+        try:
+            for use_numpy in (True, False):
+                np = numpy if use_numpy else None
+                for _ in range(100):
+                    events = []
+                    for _ in range(rng.randrange(20)):
+                        lo = rng.randrange(50)
+                        hi = lo + rng.choice((0, 0, 1, 5, 30))
+                        events.append(_Event(
+                            rng.choice((lo, _Interval(lo, hi))),
+                            ('dx', 1)))
+                    ev_seq = _Sequence(events)
+                    los = sorted(rng.randrange(60) for _ in range(10))
+                    his = [lo + rng.randrange(10) for lo in los]
+                    expected = [len(ev_seq.events_overlapping(lo, hi))
+                                for (lo, hi) in zip(los, his)]
+                    ev_seq.queries = []
+                    self.assertEqual(
+                        expected, self.count(ev_seq, los, his))
+                    self.assertEqual([], ev_seq.queries)
+        finally:
+            np = numpy
+
+    def test_count_events__fallback(self):
+        events = [_Event(_Interval(1, 4), ('dx', 1))]
+        # Events that are not closed intervals
+        for when in (_Interval(2, 6, is_hi_open=True),
+                     _Interval(2, 6, is_lo_open=True),
+                     _Interval(None, 6), _Interval(2, None)):
+            ev_seq = _Sequence(events + [_Event(when, ('dx', 2))])
+            starts, _, _ = _event_bounds(ev_seq, float, lambda t: False)
+            self.assertIsNone(starts)
+            self.assertEqual([2, 1], self.count(ev_seq, [3, 5], [4, 7]))
+            self.assertEqual([(3, 4), (5, 7)], ev_seq.queries)
+        # Intervals that end before they start
+        ev_seq = _Sequence(events)
+        self.assertEqual([1, 0], self.count(ev_seq, [1, 5], [2, 4]))
+        self.assertEqual([(1, 2), (5, 4)], ev_seq.queries)
+
+
+class LabelingTest(unittest.TestCase):
+
+    def test_label_intervals(self):
+        los = [10, 20, 30, 40]
+        his = [19, 29, 39, 49]
+        # Outcomes exactly at the bounds
+        self.assertEqual([True, False, False, False],
+                         label_intervals([10], los, his))
+        self.assertEqual([True, False, False, False],
+                         label_intervals([19], los, his))
+        # Outcomes within the horizon after the interval
+        self.assertEqual([True, True, False, False],
+                         label_intervals([22], los, his, horizon=3))
+        self.assertEqual([False, True, False, False],
+                         label_intervals([23], los, his, horizon=3))
+        # Outcomes before the first interval do not count
+        self.assertEqual([False, False, True, False],
+                         label_intervals([1, 9, 35], los, his))
+        self.assertEqual([False] * 4, label_intervals([9], los, his, 5))
+        # Several outcomes in one interval
+        self.assertEqual([False, True, False, True],
+                         label_intervals([20, 25, 29, 45], los, his))
+        # No outcomes and no intervals
+        self.assertEqual([False] * 4, label_intervals([], los, his))
+        self.assertEqual([], label_intervals([1, 2], [], []))
+
+    def test_event_bounds__outcomes(self):
+        is_outcome = mk_event_type_predicate([('xx', None), ('dx', '8')])
+        ev_seq = _Sequence([
+            _Event(_Interval(5, 9), ('dx', 8)),
+            _Event(3, ('xx', 'death')),
+            _Event(_Interval(1, 2), ('dx', 9)),
+            _Event(_Interval(4, None), ('xx', None)),
+        ])
+        starts, ends, outcome_starts = _event_bounds(
+            ev_seq, float, is_outcome)
+        self.assertIsNone(starts)
+        self.assertEqual([3, 4, 5], outcome_starts)
+
+    def test_mk_event_type_predicate(self):
+        is_event_type = mk_event_type_predicate(
+            [('xx', None), ('dx', '80180'), ('rx', 377)])
+        # A type of `None` matches the whole table
+        self.assertTrue(is_event_type(('xx', None)))
+        self.assertTrue(is_event_type(('xx', 'death')))
+        self.assertTrue(is_event_type(('xx', 3)))
+        # Types are compared as text (e.g. `int` types from an event
+        # store match types read from a file)
+        self.assertTrue(is_event_type(('dx', 80180)))
+        self.assertTrue(is_event_type(('dx', '80180')))
+        self.assertTrue(is_event_type(('rx', '377')))
+        self.assertFalse(is_event_type(('dx', 80181)))
+        self.assertFalse(is_event_type(('rx', None)))
+        self.assertFalse(is_event_type(('px', 80180)))
+
+    def test_read_event_types(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / 'outcomes.txt'
+            path.write_text('# Outcomes\ndx|80180\n\nxx|\nbx\n')
+            self.assertEqual(
+                [('dx', '80180'), ('xx', None), ('bx', None)],
+                read_event_types(path))
+
+
 # Main
 
 
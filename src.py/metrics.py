@@ -0,0 +1,295 @@
+"""Timing and counting of the stages of processing"""
+
+# Copyright (c) 2019 Aubrey Barnard.
+#
+# This is free software released under the MIT License
+# (https://choosealicense.com/licenses/mit/).
+
+
+# A `Metrics` collector records the cumulative time spent in each stage
+# of processing, counts of things (like records dropped by filters), and
+# summaries of observed values (like examples per patient).  Stage
+# times are exclusive: when a stage is entered while another stage is
+# active (as happens with nested iterators), the outer stage is paused
+# until the inner stage is exited.  Thus the stage times add up to (at
+# most) the elapsed time and show where the time goes.
+#
+# Collectors can be dumped as JSON at any time, including periodically
+# from a background thread (see `PeriodicDumper`), and can be merged so
+# that worker processes can report their metrics.
+#
+# Each thread has its own active stages, so stages can be timed in
+# several threads at once (e.g. the stages of a pipeline).  Then the
+# stage times add up to (at most) the elapsed time per thread.  Threads
+# should time stages and count things with their own names so that
+# updates are not lost.
+
+
+import collections
+import contextlib
+import io
+import json
+import os
+import pathlib
+import threading
+import time
+import unittest
+
+
+class Metrics:
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.start_time = clock()
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counts = collections.defaultdict(int)
+        # Name -> [n, sum, min, max]
+        self.observations = {}
+        # Active stages as [name, start time] pairs (per thread)
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name):
+        now = self.clock()
+        # Pause the current stage
+        if self._stack:
+            top = self._stack[-1]
+            self.times[top[0]] += now - top[1]
+        self._stack.append([name, now])
+        self.calls[name] += 1
+
+    def _exit(self):
+        now = self.clock()
+        name, start = self._stack.pop()
+        self.times[name] += now - start
+        # Resume the enclosing stage
+        if self._stack:
+            self._stack[-1][1] = now
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that times the enclosed code as the given stage."""
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed(self, name, iterable):
+        """
+        Yield the items of the given iterable, timing the production of
+        each item as the given stage.
+        """
+        items = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield item
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def observe(self, name, value):
+        obs = self.observations.get(name)
+        if obs is None:
+            self.observations[name] = [1, value, value, value]
+        else:
+            obs[0] += 1
+            obs[1] += value
+            if value < obs[2]:
+                obs[2] = value
+            if value > obs[3]:
+                obs[3] = value
+
+    def as_dict(self):
+        """Return the metrics as a dictionary suitable for JSON."""
+        # Copy the collections first in case they are being updated by
+        # another thread
+        times = dict(self.times)
+        calls = dict(self.calls)
+        observations = {name: list(obs)
+                        for (name, obs) in list(self.observations.items())}
+        return dict(
+            elapsed=self.clock() - self.start_time,
+            stages={name: dict(time=times.get(name, 0.0),
+                               calls=calls.get(name, 0))
+                    for name in sorted(set(times) | set(calls))},
+            counts=dict(sorted(dict(self.counts).items())),
+            observations={
+                name: dict(n=n, sum=sum_, mean=(sum_ / n), min=min_,
+                           max=max_)
+                for (name, (n, sum_, min_, max_))
+                in sorted(observations.items())},
+        )
+
+    def update(self, metrics):
+        """
+        Add the given metrics (as returned by `as_dict`) to these
+        metrics.  The elapsed time is ignored.
+        """
+        for name, stage in metrics['stages'].items():
+            self.times[name] += stage['time']
+            self.calls[name] += stage['calls']
+        for name, count in metrics['counts'].items():
+            self.counts[name] += count
+        for name, obs in metrics['observations'].items():
+            mine = self.observations.get(name)
+            if mine is None:
+                self.observations[name] = [
+                    obs['n'], obs['sum'], obs['min'], obs['max']]
+            else:
+                mine[0] += obs['n']
+                mine[1] += obs['sum']
+                mine[2] = min(mine[2], obs['min'])
+                mine[3] = max(mine[3], obs['max'])
+
+    def clear(self):
+        """Forget everything except active stages."""
+        self.times.clear()
+        self.calls.clear()
+        self.counts.clear()
+        self.observations.clear()
+
+    def dump(self, file):
+        """
+        Write the metrics as JSON to the given file.  Files given by
+        name are replaced atomically.
+        """
+        if isinstance(file, io.IOBase):
+            json.dump(self.as_dict(), file, indent=2)
+            return
+        path = pathlib.Path(file)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wt') as tmp_file:
+            json.dump(self.as_dict(), tmp_file, indent=2)
+        os.replace(tmp_path, path)
+
+
+class PeriodicDumper:
+    """
+    Dumps the given metrics to the given file every `interval` seconds
+    in a background thread until stopped.
+    """
+
+    def __init__(self, metrics, file, interval):
+        self.metrics = metrics
+        self.file = file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.metrics.dump(self.file)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def stage(collector, name):
+    """
+    Return a context manager that times the enclosed code as the given
+    stage if the given collector is not `None`.
+    """
+    if collector is None:
+        return contextlib.nullcontext()
+    return collector.stage(name)
+
+
+def timed(collector, name, iterable):
+    """
+    Return the given iterable with the production of its items timed as
+    the given stage if the given collector is not `None`.
+    """
+    if collector is None:
+        return iterable
+    return collector.timed(name, iterable)
+
+
+# Tests
+
+
+class MetricsTest(unittest.TestCase):
+
+    class Clock:
+
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    def test_stages_are_exclusive(self):
+        clock = self.Clock()
+        metrics = Metrics(clock)
+        def items():
+            for item in range(3):
+                clock.now += 1 # Time producing an item
+                yield item
+        for item in metrics.timed('produce', items()):
+            with metrics.stage('consume'):
+                clock.now += 10
+                with metrics.stage('inner'):
+                    clock.now += 100
+        clock.now += 1000 # Time in no stage
+        actual = metrics.as_dict()
+        self.assertEqual(1333, actual['elapsed'])
+        self.assertEqual(dict(
+            consume=dict(time=30, calls=3),
+            inner=dict(time=300, calls=3),
+            produce=dict(time=3, calls=4),
+        ), actual['stages'])
+
+    def test_counts_observations_update(self):
+        metrics = Metrics()
+        metrics.count('a')
+        metrics.count('a', 2)
+        for value in (3, 1, 2):
+            metrics.observe('x', value)
+        self.assertEqual({'a': 3}, metrics.as_dict()['counts'])
+        self.assertEqual(dict(n=3, sum=6, mean=2, min=1, max=3),
+                         metrics.as_dict()['observations']['x'])
+        other = Metrics()
+        other.count('a')
+        other.count('b')
+        other.observe('x', 7)
+        with other.stage('s'):
+            pass
+        metrics.update(other.as_dict())
+        actual = metrics.as_dict()
+        self.assertEqual({'a': 4, 'b': 1}, actual['counts'])
+        self.assertEqual(dict(n=4, sum=13, mean=3.25, min=1, max=7),
+                         actual['observations']['x'])
+        self.assertEqual(1, actual['stages']['s']['calls'])
+        metrics.clear()
+        self.assertEqual({}, metrics.as_dict()['counts'])
+
+    def test_dump(self):
+        metrics = Metrics()
+        metrics.count('a')
+        file = io.StringIO()
+        metrics.dump(file)
+        self.assertEqual({'a': 1}, json.loads(file.getvalue())['counts'])
@@ -3,7 +3,7 @@
 # Copyright (c) 2018 Aubrey Barnard.  This is free, open software
 # released under the MIT License.  (See `LICENSE.txt` for details.)
 
-# Run like: /usr/bin/time -v xzcat ev.csv.xz | /usr/bin/time -v python3 mk_data.py exp_ids.csv out_ids.csv 1>data.csv 2>data.csv.$(date +'%Y%m%d-%H%M%S').log
+# Run like: /usr/bin/time -v xzcat ev.csv.xz | /usr/bin/time -v python3 mk_data.py exp_ids.csv out_ids.csv [n-jobs] 1>data.csv 2>data.csv.$(date +'%Y%m%d-%H%M%S').log
 
 
 import datetime
@@ -16,6 +16,7 @@ from barnapy import logging
 this_dir = pathlib.Path(__file__).absolute().parent
 sys.path.append(str(this_dir))
 
+import event_data
 import survival_data
 
 
@@ -31,6 +32,10 @@ initial_age = 30
 # part of a single era
 era_max_gap = datetime.timedelta(days=360)
 
+# Number of processes to use for generating examples (optional third
+# command line argument)
+jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
 
 # Data processing
 
@@ -39,7 +44,7 @@ logging.log_runtime_environment(logging.getLogger(__name__))
 
 survival_data.main_api(
     # Read exposures and outcomes from command line
-    *sys.argv[1:],
+    *sys.argv[1:3],
 
     # Data filtering
 
@@ -50,6 +55,10 @@ survival_data.main_api(
 
     # Data interpretation and transformation
 
+    # Parse records according to the types of fields in each table
+    record_parser=event_data.parse_record_fast,
+    # Only decode the JSON attributes that are used
+    json_constructor=event_data.lazy_json,
     # Infer drug intervals based on refills, etc.
     record_transformer=survival_data.transform_record,
     # Define exposure / outcome eras
@@ -57,6 +66,11 @@ survival_data.main_api(
     # Start tracking survival at the given age
     study_period_definer=lambda s: (
         survival_data.limit_to_ages(s, min_age=initial_age)),
+    # Drop events after the first outcome before making eras (the study
+    # period starts at the initial age)
+    truncate_at_outcome=True,
+    study_start_definer=lambda s: (
+        survival_data.date_at_age(s, initial_age)),
 
     # Covariates
 
@@ -65,4 +79,8 @@ survival_data.main_api(
         survival_data.age_at_first_event,
         survival_data.mk_fact_feature(('bx', 'gndr')),
     ),
+
+    # Processing
+
+    jobs=jobs,
 )
@@ -0,0 +1,267 @@
+"""Stages of processing that run concurrently in background threads"""
+
+# Copyright (c) 2019 Aubrey Barnard.  This is free software released
+# under the MIT License (https://choosealicense.com/licenses/mit/).
+
+# A pipeline runs each of its stages in a background thread.  A stage
+# iterates over its input (often the previous stage) and puts the
+# resulting items into a bounded queue, from which they are taken by
+# the next stage or by the caller.  When a queue is full its producer
+# waits (backpressure), so no stage gets far ahead of the others, and
+# the memory used is bounded by the sizes of the queues.
+#
+# Each stage keeps statistics about its queue so that the bottleneck can
+# be found.  A queue that is usually full means its consumer is slow,
+# and one that is usually empty means its producer is slow.  The
+# statistics are logged when the pipeline is closed and are also
+# recorded in the given metrics collector (if any) as the observation
+# `queue_depth.<stage>` and the stages `wait_items.<stage>` (time the
+# consumer waited for items) and `wait_space.<stage>` (time the
+# producer waited for space).
+#
+# Because of the GIL, stages overlap best when some of them do I/O,
+# decompression, or waiting on other processes.
+
+
+import pathlib
+import queue
+import sys
+import threading
+import time
+import unittest
+
+from barnapy import logging
+
+# "Install" related modules by updating import path
+this_dir = pathlib.Path(__file__).absolute().parent
+sys.path.append(str(this_dir))
+
+import metrics
+
+
+class _End:
+    # Marker for the end of the items of a stage
+    pass
+
+
+class _Error:
+    # Wrapper for an exception raised while producing the items of a
+    # stage
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class Stage:
+    """
+    Iterator over the items produced by iterating over the given items in
+    a background thread.  Create with `Pipeline.stage`.
+
+    The thread is started by the first call to `next` so that nothing
+    happens in the background until the items are needed.
+    """
+
+    def __init__(self, pipeline, name, items, max_size=64):
+        self.pipeline = pipeline
+        self.name = name
+        self.max_size = max_size
+        self._items = items
+        self._queue = queue.Queue(max_size)
+        self._thread = None
+        self._done = False
+        # Statistics
+        self.n_items = 0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.wait_items_time = 0.0
+        self.wait_space_time = 0.0
+
+    def _put(self, item):
+        # Put the item in the queue unless the pipeline is stopped
+        start = time.perf_counter()
+        try:
+            with metrics.stage(self.pipeline.collector,
+                               'wait_space.' + self.name):
+                while not self.pipeline.stopped():
+                    try:
+                        self._queue.put(
+                            item, timeout=self.pipeline.poll_time)
+                        return True
+                    except queue.Full:
+                        pass
+                return False
+        finally:
+            self.wait_space_time += time.perf_counter() - start
+
+    def _get(self):
+        # Get an item from the queue unless the pipeline is stopped
+        collector = self.pipeline.collector
+        depth = self._queue.qsize()
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+        if collector is not None:
+            collector.observe('queue_depth.' + self.name, depth)
+        start = time.perf_counter()
+        try:
+            with metrics.stage(collector, 'wait_items.' + self.name):
+                while not self.pipeline.stopped():
+                    try:
+                        return self._queue.get(
+                            timeout=self.pipeline.poll_time)
+                    except queue.Empty:
+                        pass
+                return _End
+        finally:
+            self.wait_items_time += time.perf_counter() - start
+
+    def _run(self):
+        items = iter(self._items)
+        try:
+            for item in items:
+                if not self._put(item):
+                    break
+        except Exception as exc:
+            self._put(_Error(exc))
+        finally:
+            # Release the resources of the items (e.g. a generator that
+            # stopped early) in the thread that was using them
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+            self._put(_End)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='pipeline-' + self.name,
+                daemon=True)
+            self._thread.start()
+        return self
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        self.start()
+        item = self._get()
+        if item is _End:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, _Error):
+            self._done = True
+            raise item.exc
+        self.n_items += 1
+        return item
+
+    def stats(self):
+        """Return the statistics of this stage as a dictionary."""
+        n_gets = self.n_items + (1 if self._done else 0)
+        return dict(
+            items=self.n_items,
+            max_size=self.max_size,
+            mean_depth=(self.depth_sum / n_gets if n_gets else 0.0),
+            max_depth=self.depth_max,
+            wait_items_time=self.wait_items_time,
+            wait_space_time=self.wait_space_time,
+        )
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues.  Closing the pipeline stops all
+    its stages, waits for their threads to finish, and logs their
+    statistics.
+    """
+
+    def __init__(self, collector=None, poll_time=0.1):
+        self.collector = collector
+        self.poll_time = poll_time
+        self.stages = []
+        self._stop = threading.Event()
+
+    def stage(self, name, items, max_size=64):
+        """
+        Return a stage that iterates over the given items in a
+        background thread and has a queue of at most `max_size` items.
+        """
+        stage = Stage(self, name, items, max_size)
+        self.stages.append(stage)
+        return stage
+
+    def stopped(self):
+        return self._stop.is_set()
+
+    def stats(self):
+        """Return the statistics of the stages by name."""
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def close(self):
+        self._stop.set()
+        for stage in self.stages:
+            stage.join()
+        logger = logging.getLogger(__name__)
+        for (name, stats) in self.stats().items():
+            logger.info('Pipeline stage {}: {} items; queue depth: mean '
+                        '{:.1f}, max {} of {}; waited {:.1f} s for items '
+                        'and {:.1f} s for space', name, stats['items'],
+                        stats['mean_depth'], stats['max_depth'],
+                        stats['max_size'], stats['wait_items_time'],
+                        stats['wait_space_time'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Tests
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_stages(self):
+        with Pipeline(poll_time=0.01) as pipeline:
+            squares = pipeline.stage(
+                'squares', (x * x for x in range(100)), max_size=4)
+            strs = pipeline.stage('strs', map(str, squares), max_size=2)
+            self.assertEqual([str(x * x) for x in range(100)], list(strs))
+            self.assertEqual([], list(strs))
+        stats = pipeline.stats()
+        self.assertEqual(100, stats['squares']['items'])
+        self.assertEqual(100, stats['strs']['items'])
+        self.assertLessEqual(stats['squares']['max_depth'], 4)
+        self.assertLessEqual(stats['strs']['max_depth'], 2)
+
+    def test_error(self):
+        def items():
+            yield 1
+            raise KeyError('oops')
+        with Pipeline(poll_time=0.01) as pipeline:
+            stage = pipeline.stage('items', items())
+            self.assertEqual(1, next(stage))
+            with self.assertRaises(KeyError):
+                next(stage)
+
+    def test_close_early(self):
+        closed = threading.Event()
+        def items():
+            try:
+                n = 0
+                while True:
+                    yield n
+                    n += 1
+            finally:
+                closed.set()
+        pipeline = Pipeline(poll_time=0.01)
+        stage = pipeline.stage(
+            'numbers', pipeline.stage('items', items(), max_size=2),
+            max_size=2)
+        self.assertEqual([0, 1, 2], [next(stage) for _ in range(3)])
+        pipeline.close()
+        self.assertTrue(closed.is_set())
@@ -6,22 +6,43 @@
 # (https://choosealicense.com/licenses/mit/).
 
 
+import bisect
+import collections
+import collections.abc
 import datetime
 import io
+import itertools as itools
+import json
+import math
+import multiprocessing
+import os
 import pathlib
 import pprint
+import random
 import sys
+import tempfile
 import unittest
 
 from barnapy import general
 from barnapy import logging
 import esal
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # "Install" related modules by updating import path
 this_dir = pathlib.Path(__file__).absolute().parent
 sys.path.append(str(this_dir))
 
+import compact_events
+import covariates
 import event_data
+import event_store
+import example_store
+import metrics
+import pipeline
 
 
 # Suggested (but optional) functionality
@@ -44,7 +65,7 @@ def include_record(record):
     # Ignore medication mentions (drug type concept ID 38000178)
     elif tbl == 'rx':
         jsn = record[event_data.field_name2idx['jsn']]
-        attrs = jsn if isinstance(jsn, dict) else {}
+        attrs = jsn if isinstance(jsn, collections.abc.Mapping) else {}
         if json_get(attrs, 'drug_type_concept_id') == 38000178:
             return False
     return True
@@ -103,7 +124,10 @@ def set_drug_interval(
     hi = record[hi_idx]
     jsn = record[jsn_idx]
     # Extra attributes must be a dictionary
-    attrs = jsn if isinstance(jsn, dict) else {}
+    attrs = jsn if isinstance(jsn, collections.abc.Mapping) else {}
+    # Decode only the needed attributes of lazy JSON in a single pass
+    if isinstance(attrs, event_data.LazyJsonObject):
+        attrs.fetch(days_supply_key, refills_key, quantity_key)
     # Guess at the days supply based on the extra attributes
     days = infer_drug_days_supply(
         days_supply=json_get(attrs, days_supply_key),
@@ -135,6 +159,153 @@ def transform_record(record):
         return record
 
 
+# Batch inference of drug intervals.  Computing intervals for blocks of
+# drug records at once with NumPy (if available) avoids most of the
+# per-record arithmetic and date construction.  The rules are the same
+# as those of `set_drug_interval` with `infer_drug_days_supply`.  Values
+# that are not plain numbers (e.g. text or booleans), huge values, and
+# float refills (which are not incremented) are rare, so records with
+# them are handled by `set_drug_interval` itself.
+
+# Largest attribute value computed in batch (so that products are exact
+# as floats)
+_max_batch_value = 10 ** 6
+
+_max_date_ordinal = datetime.date.max.toordinal()
+
+
+def _batch_number(value, is_refills=False):
+    # Return the given value as a number for batch computation, `None`
+    # if missing, or `False` if the record must be handled individually
+    if value is None:
+        return None
+    typ = type(value)
+    if (typ is int or (typ is float and not is_refills and
+                       math.isfinite(value))):
+        if -_max_batch_value <= value <= _max_batch_value:
+            return value
+    return False
+
+
+def set_drug_intervals(
+        records,
+        min_days=30,
+        washout=0,
+        days_supply_key='days_supply',
+        refills_key='refills',
+        quantity_key='quantity',
+):
+    """
+    Set the intervals of the given drug records like
+    `set_drug_interval` but for all the records at once.
+
+    Updates the records in place and returns them.
+    """
+    if np is None:
+        for record in records:
+            set_drug_interval(
+                record, min_days, washout,
+                days_supply_key=days_supply_key, refills_key=refills_key,
+                quantity_key=quantity_key)
+        return records
+    lo_idx = event_data.field_name2idx['lo']
+    hi_idx = event_data.field_name2idx['hi']
+    jsn_idx = event_data.field_name2idx['jsn']
+    # Gather the fields of the records that can be computed in batch
+    batch = []
+    los = []
+    his = []
+    attr_values = []
+    for record in records:
+        jsn = record[jsn_idx]
+        attrs = jsn if isinstance(jsn, collections.abc.Mapping) else {}
+        if isinstance(attrs, event_data.LazyJsonObject):
+            attrs.fetch(days_supply_key, refills_key, quantity_key)
+        days_supply = _batch_number(json_get(attrs, days_supply_key))
+        refills = _batch_number(json_get(attrs, refills_key), True)
+        quantity = _batch_number(json_get(attrs, quantity_key))
+        lo = record[lo_idx]
+        hi = record[hi_idx]
+        if (days_supply is False or refills is False or
+                quantity is False or
+                type(min_days) is not int or type(washout) is not int or
+                (lo and type(lo) is not datetime.date) or
+                (hi and type(hi) is not datetime.date)):
+            set_drug_interval(
+                record, min_days, washout,
+                days_supply_key=days_supply_key, refills_key=refills_key,
+                quantity_key=quantity_key)
+            continue
+        # Records without start dates are not changed
+        if not lo:
+            continue
+        batch.append(record)
+        los.append(lo.toordinal())
+        his.append(hi.toordinal() if hi else 0)
+        attr_values.append((
+            days_supply if days_supply is not None else np.nan,
+            refills if refills is not None else np.nan,
+            quantity if quantity is not None else np.nan,
+        ))
+    if not batch:
+        return records
+    los = np.array(los, dtype=np.int64)
+    his = np.array(his, dtype=np.int64)
+    attr_values = np.array(attr_values, dtype=np.float64)
+    days_supply = attr_values[:, 0]
+    refills = attr_values[:, 1]
+    quantity = attr_values[:, 2]
+    # The total number of fills is `refills + 1`.  Multiply by the
+    # number of fills only if it is nonzero (and not missing).
+    fills = refills + 1
+    has_fills = ~np.isnan(fills) & (fills != 0)
+    days = np.where(
+        ~np.isnan(days_supply), days_supply,
+        np.where(~np.isnan(quantity), quantity, float(min_days)))
+    days = np.where(has_fills, days * fills, days)
+    days = np.maximum(days, min_days) + washout
+    # Like adding a `timedelta` to a date, ignore fractional days
+    days = np.floor(days).astype(np.int64)
+    # Only increase the interval
+    new_his = np.where(
+        his != 0, los + np.maximum(his - los, days), los + days)
+    # Convert back to dates.  There are not many distinct dates, so
+    # remember them.
+    ord2date = {}
+    for record, hi, ok in zip(
+            batch, new_his.tolist(),
+            ((new_his >= 1) & (new_his <= _max_date_ordinal)).tolist()):
+        if not ok:
+            # Let `set_drug_interval` handle (raise) out of range dates
+            set_drug_interval(
+                record, min_days, washout,
+                days_supply_key=days_supply_key, refills_key=refills_key,
+                quantity_key=quantity_key)
+            continue
+        date = ord2date.get(hi)
+        if date is None:
+            date = datetime.date.fromordinal(hi)
+            ord2date[hi] = date
+        record[hi_idx] = date
+    return records
+
+
+def transform_records(records, block_size=10000):
+    """
+    Transform the given records like `transform_record` but setting the
+    intervals of blocks of drug records at once (see
+    `set_drug_intervals`).  Yield the records in the same order.
+    """
+    tbl_idx = event_data.field_name2idx['tbl']
+    records = iter(records)
+    while True:
+        block = list(itools.islice(records, block_size))
+        if not block:
+            break
+        set_drug_intervals([r for r in block if r[tbl_idx] == 'rx'])
+        yield from block
+
+
 def limit_to_ages(ev_seq, min_age=None, max_age=None):
     # Exit early if there is nothing to do
     if min_age is None and max_age is None:
@@ -155,6 +326,8 @@ def limit_to_ages(ev_seq, min_age=None, max_age=None):
         dob + datetime.timedelta(days=(max_age * 365))
         if max_age is not None
         else None)
+    if isinstance(ev_seq, compact_events.CompactEventSequence):
+        return ev_seq.limit_to_dates(min_date, max_date)
     bounds = esal.Interval(
         min_date if min_date is not None else datetime.date.min,
         max_date if max_date is not None else datetime.date.max,
@@ -178,6 +351,22 @@ def limit_to_ages(ev_seq, min_age=None, max_age=None):
     return ev_seq.copy(events=evs)
 
 
+def date_at_age(ev_seq, age):
+    """
+    Return the date at which the patient reaches the given age as
+    calculated by `limit_to_ages`, or `None` if there is no DOB.
+
+    Use this to define the start of the study period for
+    `survivalize` when truncating at the first outcome.
+    """
+    dob = ev_seq.fact(('bx', 'dob'))
+    if dob is None:
+        return None
+    dob, jsn = dob
+    dob = event_data.parse_date(dob)
+    return dob + datetime.timedelta(days=(age * 365))
+
+
 # Feature vectors
 
 
@@ -253,7 +442,13 @@ def build_exposure_outcome_event_type_map(
         outcome_types,
         exposure_event_type='exp',
         outcome_event_type='out',
+        event_type_interner=None,
 ):
+    # Map the codes of the event types if the event types are interned
+    # (see `event_data.EventTypeInterner`)
+    if event_type_interner is not None:
+        exposure_types = map(event_type_interner.encode, exposure_types)
+        outcome_types = map(event_type_interner.encode, outcome_types)
     event_type2type = {t: exposure_event_type for t in exposure_types}
     event_type2type.update(
         (t, outcome_event_type) for t in outcome_types)
@@ -273,27 +468,159 @@ def map_event_types(events, type2type, replace=False):
             yield ev
 
 
-def make_eras(event_sequence, event_types, max_gap=0):
+def _bounds(when):
+    if isinstance(when, esal.Interval):
+        return when.lo, when.hi
+    return when, when
+
+
+def make_eras_generic(event_sequence, event_types, max_gap=0):
+    """
+    Make eras with the generic event aggregation of `esal`.  This is
+    the reference for (and is slower than) `make_eras`.
+    """
     union_aggregator = esal.mk_union_aggregator(
         min_len=datetime.timedelta(0), max_gap=max_gap)
     return event_sequence.aggregate_events(
         union_aggregator, types=event_types)
 
 
+def make_eras(event_sequence, event_types, max_gap=0):
+    """
+    Return a copy of the given event sequence where the events of each
+    of the given types are merged into eras.  Events of the same type
+    are merged if they overlap or if the gap between them is at most
+    `max_gap`.  Events of other types are kept as is.
+    """
+    if isinstance(event_sequence, compact_events.CompactEventSequence):
+        return event_sequence.make_eras(event_types, max_gap)
+    event_types = set(event_types)
+    # Gather the bounds of the events to merge by type
+    others = []
+    type2bounds = {}
+    for event in event_sequence:
+        if event.type in event_types:
+            bounds = type2bounds.get(event.type)
+            if bounds is None:
+                bounds = []
+                type2bounds[event.type] = bounds
+            bounds.append(_bounds(event.when))
+        else:
+            others.append(event)
+    # Sort and sweep, extending the current era while the next event
+    # starts within the max gap of its end
+    eras = []
+    for ev_type, bounds in type2bounds.items():
+        bounds.sort()
+        era_lo, era_hi = bounds[0]
+        for lo, hi in itools.islice(bounds, 1, None):
+            if (lo - era_hi <= max_gap) if max_gap else (lo <= era_hi):
+                if hi > era_hi:
+                    era_hi = hi
+            else:
+                eras.append(esal.Event(esal.Interval(era_lo, era_hi), ev_type))
+                era_lo, era_hi = lo, hi
+        eras.append(esal.Event(esal.Interval(era_lo, era_hi), ev_type))
+    return event_sequence.copy(events=others + eras)
+
+
+def truncate_at_first_outcome(
+        events,
+        outcome_event_type='out',
+        era_event_types=(),
+        era_max_gap=0,
+        study_start=None,
+):
+    """
+    Return a list of the given events without the events that cannot
+    affect any survival example because they start after the first
+    outcome.
+
+    Events of the given era types (exposures and outcomes) are kept if
+    they start within `era_max_gap` after the first outcome because they
+    could merge with earlier events into an era that overlaps the
+    outcome.  `study_start` is the date at which the study period begins
+    (if the study period definer cuts off earlier events).  Nothing is
+    dropped if an outcome starts at or before the start of the sequence
+    (or study), because then the first example has the outcome and its
+    end depends on later events.
+    """
+    events = list(events)
+    if not events:
+        return events
+    # Find the start of the sequence (or study) and the first outcome
+    start = study_start
+    first = None
+    for event in events:
+        lo, _ = _bounds(event.when)
+        if study_start is None and (start is None or lo < start):
+            start = lo
+        if event.type == outcome_event_type and (
+                first is None or lo < first):
+            first = lo
+    if first is None or first <= start:
+        return events
+    era_limit = first + era_max_gap if era_max_gap else first
+    return [event for event in events
+            if (_bounds(event.when)[0] <= first or
+                (event.type in era_event_types and
+                 _bounds(event.when)[0] <= era_limit))]
+
+
 def survivalize(
         ev_seq,
         event_type_map,
         study_period_definer=None,
         replace_mapped_events=False,
         era_max_gap=0,
+        truncate_at_outcome=False,
+        outcome_event_type='out',
+        study_start_definer=None,
+        collector=None,
 ):
-    # Encode exposures and outcomes
-    events = map_event_types(
-        ev_seq.events(), event_type_map, replace_mapped_events)
-    ev_seq = ev_seq.copy(events=events)
+    """
+    Encode exposures and outcomes, make them into eras, and limit the
+    sequence to the study period.  Time making eras in the given
+    metrics collector (if any).
+
+    If `truncate_at_outcome`, drop the events after the first outcome of
+    type `outcome_event_type` before making eras, which saves work but
+    does not change the survival examples.  If there is a study period
+    definer, `study_start_definer` must also be given.  It is a function
+    that returns the date the study period starts (or `None` if the
+    study period starts with the events), for example
+    `lambda s: date_at_age(s, min_age)` for `limit_to_ages`.
+    """
+    # Find the start of the study if truncating at the first outcome
+    if truncate_at_outcome:
+        if study_period_definer is not None and study_start_definer is None:
+            raise ValueError(
+                'Truncating at the first outcome with a study period '
+                'definer requires a study start definer')
+        study_start = (study_start_definer(ev_seq)
+                       if study_start_definer is not None
+                       else None)
+    # Work directly on the arrays of compact sequences
+    if isinstance(ev_seq, compact_events.CompactEventSequence):
+        ev_seq = ev_seq.map_event_types(event_type_map, replace_mapped_events)
+        if truncate_at_outcome:
+            ev_seq = ev_seq.truncate_at_first_outcome(
+                outcome_event_type, set(event_type_map.values()),
+                era_max_gap, study_start)
+    else:
+        # Encode exposures and outcomes
+        events = map_event_types(
+            ev_seq.events(), event_type_map, replace_mapped_events)
+        # Drop events after the first outcome if requested
+        if truncate_at_outcome:
+            events = truncate_at_first_outcome(
+                events, outcome_event_type, set(event_type_map.values()),
+                era_max_gap, study_start)
+        ev_seq = ev_seq.copy(events=events)
     # Make exposures and outcomes into eras
-    ev_seq = make_eras(
-        ev_seq, set(event_type_map.values()), era_max_gap)
+    with metrics.stage(collector, 'make_eras'):
+        ev_seq = make_eras(
+            ev_seq, set(event_type_map.values()), era_max_gap)
     # Limit sequence to study period.  Do this after making eras to
     # avoid missing eras that would otherwise overlap the bounds of the
     # study period.
@@ -302,12 +629,77 @@ def survivalize(
     return ev_seq
 
 
+def read_event_records(
+        in_file,
+        csv_format=event_data.csv_format,
+        comment_char='#',
+        include_tables=event_data.tables,
+        json_constructor=json.loads,
+        record_parser=event_data.parse_record,
+        include_record=include_record,
+        record_transformer=transform_record,
+        sort_by_id=False,
+        sort_memory_budget=2 ** 30,
+        collector=None,
+        records_transformer=None,
+        resume_after_id=None,
+):
+    """
+    Read, parse, and filter event records from the given CSV file or
+    event store (see `event_store`).
+
+    If given, `records_transformer` is applied to the whole stream of
+    records (after `record_transformer` is applied to each record) so
+    that records can be transformed in blocks (e.g. `transform_records`).
+
+    If `sort_by_id`, sort the records of a CSV file by ID using at most
+    about `sort_memory_budget` bytes of memory (spilling to temporary
+    files as needed).  Event stores are sorted when they are compiled.
+    Dropped records are counted in the given metrics collector (if
+    any).  If `resume_after_id` is given, skip the records through the
+    records with that ID without parsing them.
+    """
+    if event_store.is_event_store(in_file):
+        if sort_by_id:
+            raise ValueError('Event stores cannot be sorted when read.  '
+                             'Sort the records when compiling the store.')
+        records = event_store.read_records(
+            in_file,
+            include_tables=set(include_tables),
+            json_constructor=json_constructor,
+            include_record=include_record,
+            record_transformer=record_transformer,
+            collector=collector,
+            resume_after_id=resume_after_id,
+        )
+    else:
+        records = event_data.read_records(
+            in_file,
+            csv_format=csv_format,
+            comment_char=comment_char,
+            include_tables=set(include_tables),
+            json_constructor=json_constructor,
+            record_parser=record_parser,
+            include_record=include_record,
+            record_transformer=record_transformer,
+            sort_by_id=sort_by_id,
+            sort_memory_budget=sort_memory_budget,
+            collector=collector,
+            resume_after_id=resume_after_id,
+        )
+    if records_transformer is not None:
+        records = records_transformer(records)
+    return records
+
+
 def events_to_sequences(
         in_file,
         event_type_map,
         csv_format=event_data.csv_format,
         comment_char='#',
         include_tables=event_data.tables,
+        json_constructor=json.loads,
+        record_parser=event_data.parse_record,
         include_record=include_record,
         record_transformer=transform_record,
         fact_constructor=event_data.fact_from_record,
@@ -315,20 +707,33 @@ def events_to_sequences(
         study_period_definer=None,
         replace_mapped_events=False,
         era_max_gap=0,
+        truncate_at_outcome=False,
+        outcome_event_type='out',
+        study_start_definer=None,
+        sort_by_id=False,
+        sort_memory_budget=2 ** 30,
+        records_transformer=None,
+        check_sorted=True,
 ):
     # Read, parse, and filter event records.  This includes
     # interpreting drug records.
-    records = event_data.read_records(
+    records = read_event_records(
         in_file,
         csv_format=csv_format,
         comment_char=comment_char,
-        include_tables=set(include_tables),
+        include_tables=include_tables,
+        json_constructor=json_constructor,
+        record_parser=record_parser,
         include_record=include_record,
         record_transformer=record_transformer,
+        sort_by_id=sort_by_id,
+        sort_memory_budget=sort_memory_budget,
+        records_transformer=records_transformer,
     )
     # Gather event records into event sequences
     ev_seqs = event_data.event_sequences_from_records(
-        records, fact_constructor, event_constructor)
+        records, fact_constructor, event_constructor,
+        check_sorted=check_sorted)
     # Make event sequences suitable for survival analysis
     for ev_seq in ev_seqs:
         yield survivalize(
@@ -337,6 +742,9 @@ def events_to_sequences(
             study_period_definer,
             replace_mapped_events,
             era_max_gap,
+            truncate_at_outcome,
+            outcome_event_type,
+            study_start_definer,
         )
 
 
@@ -358,6 +766,59 @@ fields = (
 field_name2idx = {f: i for (i, f) in enumerate(fields)}
 
 
+class EventIntervalIndex:
+    """
+    Index of the events in an event sequence for quickly finding the
+    events that overlap a given interval.
+
+    The events of a sequence are sorted by their starts, so the events
+    that start no later than the end of a query are a prefix of the
+    sequence.  Augmenting the starts with the running maximum of the
+    ends makes the events that might end no earlier than the start of a
+    query a suffix.  Thus both ends of the range of candidate events can
+    be found by binary search.  Each candidate is then checked exactly.
+    """
+
+    def __init__(self, event_sequence):
+        self.event_sequence = event_sequence
+        self._los = []
+        self._max_his = []
+        max_hi = None
+        for event in event_sequence:
+            when = event.when
+            # Only intervals are supported
+            if not isinstance(when, esal.Interval):
+                self._los = None
+                break
+            lo = when.lo
+            hi = when.hi
+            # Only sorted sequences are supported
+            if self._los and lo < self._los[-1]:
+                self._los = None
+                break
+            if max_hi is None or hi > max_hi:
+                max_hi = hi
+            self._los.append(lo)
+            self._max_his.append(max_hi)
+
+    def events_overlapping(self, lo, hi, is_lo_open, is_hi_open):
+        """
+        Return the indices of the events that overlap the given interval
+        like `esal.EventSequence.events_overlapping`.
+        """
+        # Fall back to searching the whole sequence if the sequence is
+        # not supported
+        if self._los is None:
+            return self.event_sequence.events_overlapping(
+                lo, hi, is_lo_open, is_hi_open)
+        idx_lo = bisect.bisect_left(self._max_his, lo)
+        idx_hi = bisect.bisect_right(self._los, hi)
+        itvl = esal.Interval(lo, hi, is_lo_open, is_hi_open)
+        evs = self.event_sequence
+        return [idx for idx in range(idx_lo, idx_hi)
+                if evs[idx].when.intersects(itvl)]
+
+
 def build_example(
         event_sequence,
         ref_lo,
@@ -367,16 +828,25 @@ def build_example(
         outcome_event_type,
         state,
         feature_vector_function=None,
+        interval_index=None,
+        covariate_sweep=None,
 ):
     # Build a feature vector of covariates if such a feature vector
     # function is specified
     itvl = esal.Interval(when_lo, when_hi)
-    subseq = event_sequence.subsequence(
-        event_sequence.events_overlapping(
-            itvl.lo, itvl.hi, itvl.is_lo_open, itvl.is_hi_open))
-    fv = (feature_vector_function(subseq)
-          if feature_vector_function is not None
-          else None)
+    if feature_vector_function is not None:
+        if interval_index is None:
+            interval_index = event_sequence
+        subseq = event_sequence.subsequence(
+            interval_index.events_overlapping(
+                itvl.lo, itvl.hi, itvl.is_lo_open, itvl.is_hi_open))
+        fv = feature_vector_function(subseq)
+    else:
+        fv = None
+    # Append any incrementally-computed covariates
+    if covariate_sweep is not None:
+        fv = (list(fv) if fv is not None else []) + (
+            covariate_sweep.covariates(itvl))
     return [
         event_sequence.id,
         esal.Interval(when_lo, when_hi),
@@ -394,12 +864,16 @@ def examples_from_transitions(
         exposure_event_type='exp',
         outcome_event_type='out',
         feature_vector_function=None,
+        covariate_specs=None,
 ):
     # Exit early if empty sequence
     if len(event_sequence) == 0:
         return
     # Find the time bounds of the event sequence
-    if isinstance(event_sequence[0].when, esal.Interval):
+    compact = isinstance(event_sequence, compact_events.CompactEventSequence)
+    if compact:
+        es_lo, es_hi = event_sequence.date_bounds()
+    elif isinstance(event_sequence[0].when, esal.Interval):
         es_lo = event_sequence[0].when.lo
         es_hi = max(e.when.hi for e in event_sequence)
     else:
@@ -412,6 +886,18 @@ def examples_from_transitions(
     # events.  This means all the state changes can be tracked by
     # iterating over when events start and end.
 
+    # Index the events for finding those in the interval of each
+    # example, but only if they are needed.  Compact sequences are
+    # their own indices.
+    itvl_idx = None
+    if feature_vector_function is not None:
+        itvl_idx = (event_sequence if compact
+                    else EventIntervalIndex(event_sequence))
+    # Compute declarative covariates in a single sweep over the events
+    cov_sweep = (covariates.CovariateSweep(event_sequence, covariate_specs)
+                 if covariate_specs
+                 else None)
+
     # Iterate through exposure and outcome states to generate examples
     before = es_lo
     state = {exposure_event_type: 0, outcome_event_type: 0}
@@ -423,7 +909,7 @@ def examples_from_transitions(
             yield build_example(
                 event_sequence, es_lo, before, now,
                 exposure_event_type, outcome_event_type,
-                state, feature_vector_function)
+                state, feature_vector_function, itvl_idx, cov_sweep)
 
         # Update the state with this transition
 
@@ -439,7 +925,7 @@ def examples_from_transitions(
             yield build_example(
                 event_sequence, es_lo, now, now,
                 exposure_event_type, outcome_event_type,
-                state, feature_vector_function)
+                state, feature_vector_function, itvl_idx, cov_sweep)
             # Treat point events as ending now
             for event in points:
                 state[event.type] = 0
@@ -452,7 +938,7 @@ def examples_from_transitions(
         yield build_example(
             event_sequence, es_lo, before, es_hi,
             exposure_event_type, outcome_event_type,
-            state, feature_vector_function)
+            state, feature_vector_function, itvl_idx, cov_sweep)
 
 
 def examples_to_survival_examples(
@@ -489,33 +975,46 @@ def event_sequence_to_survival_data_examples(
         outcome_event_type='out',
         feature_vector_function=None,
         field_name2idx=field_name2idx,
+        covariate_specs=None,
+        collector=None,
 ):
     # Generate general examples from each transition
-    exs = examples_from_transitions(
-        event_sequence,
-        exposure_event_type, outcome_event_type,
-        feature_vector_function)
+    exs = metrics.timed(
+        collector, 'examples_from_transitions',
+        examples_from_transitions(
+            event_sequence,
+            exposure_event_type, outcome_event_type,
+            feature_vector_function, covariate_specs))
     # Turn the general examples into survival examples
     exs = examples_to_survival_examples(exs)
     return exs
 
 
-def print_survival_example(
+def flatten_survival_example(
         example,
-        delimiter='|',
-        file=sys.stdout,
         id_idx=field_name2idx['id'],
         dates_idx=field_name2idx['dates'],
         fv_idx=field_name2idx['fv'],
 ):
-    # Unpack / Flatten
-    ex = [
+    return [
         example[id_idx],
         example[dates_idx].lo,
         example[dates_idx].hi,
         *example[(dates_idx + 1):fv_idx],
         *(example[fv_idx] if example[fv_idx] else ()),
     ]
+
+
+def print_survival_example(
+        example,
+        delimiter='|',
+        file=sys.stdout,
+        id_idx=field_name2idx['id'],
+        dates_idx=field_name2idx['dates'],
+        fv_idx=field_name2idx['fv'],
+):
+    # Unpack / Flatten
+    ex = flatten_survival_example(example, id_idx, dates_idx, fv_idx)
     # Convert `None` to ''
     for idx, field in enumerate(ex):
         if field is None:
@@ -523,6 +1022,500 @@ def print_survival_example(
     print(*ex, sep=delimiter, file=file)
 
 
+# Parallel processing
+
+# Configuration of the worker processes.  This is set by the pool
+# initializer.  The pool uses the "fork" start method so that the
+# configuration (which often contains lambdas and closures) is inherited
+# rather than pickled.
+_worker_config = None
+
+
+def _init_worker(config):
+    global _worker_config
+    _worker_config = config
+    # Start the metrics of this worker (if any) from scratch rather than
+    # from those inherited from the main process
+    for cfg in config:
+        if cfg['collector'] is not None:
+            cfg['collector'].clear()
+
+
+def survival_examples_text(ev_seq, config):
+    """
+    Return the text of the survival examples for the given survivalized
+    event sequence as they would be printed by `print_survival_example`.
+
+    If the configuration has the columnar output format, return a list
+    of flattened survival examples instead (for
+    `example_store.ExampleStoreWriter`).
+    """
+    exs = event_sequence_to_survival_data_examples(
+        ev_seq,
+        config['exposure_event_type'],
+        config['outcome_event_type'],
+        config['feature_vector_function'],
+        config['field_name2idx'],
+        config['covariate_specs'],
+        config['collector'],
+    )
+    with metrics.stage(config['collector'], 'print_survival_example'):
+        if config['output_format'] == 'columnar':
+            name2idx = config['field_name2idx']
+            output = [flatten_survival_example(
+                          ex, name2idx['id'], name2idx['dates'],
+                          name2idx['fv'])
+                      for ex in exs]
+            n_exs = len(output)
+        else:
+            text = io.StringIO()
+            n_exs = 0
+            for ex in exs:
+                print_survival_example(
+                    ex,
+                    delimiter=config['output_delimiter'],
+                    file=text,
+                    id_idx=config['field_name2idx']['id'],
+                    dates_idx=config['field_name2idx']['dates'],
+                    fv_idx=config['field_name2idx']['fv'],
+                )
+                n_exs += 1
+            output = text.getvalue()
+    if config['collector'] is not None:
+        config['collector'].observe('examples_per_patient', n_exs)
+    return output
+
+
+def survivalize_with_config(ev_seq, config):
+    """Call `survivalize` with the settings in the given configuration."""
+    with metrics.stage(config['collector'], 'survivalize'):
+        return survivalize(
+            ev_seq,
+            config['event_type_map'],
+            config['study_period_definer'],
+            config['replace_mapped_events'],
+            config['era_max_gap'],
+            config['truncate_at_outcome'],
+            config['outcome_event_type'],
+            config['study_start_definer'],
+            config['collector'],
+        )
+
+
+def sequences_to_texts(ev_seqs, configs):
+    """
+    Generate survival examples text for each of the given
+    (unsurvivalized) event sequences and each of the given
+    configurations.
+
+    Yield `(id, texts)` pairs where `texts` has one text per
+    configuration.
+    """
+    for ev_seq in ev_seqs:
+        yield ev_seq.id, [
+            survival_examples_text(
+                survivalize_with_config(ev_seq, config), config)
+            for config in configs]
+
+
+def _sequences_from_groups(groups, config):
+    # Assemble groups of records into (unsurvivalized) event sequences.
+    # Facts and events are constructed the same for all configurations.
+    if config['compact_sequences']:
+        return metrics.timed(
+            config['collector'], 'event_sequences_from_records',
+            (compact_events.from_records(
+                rec_id, recs, config['fact_constructor'],
+                config['event_type_interner'])
+             for rec_id, recs in groups))
+    return metrics.timed(
+        config['collector'], 'event_sequences_from_records',
+        (event_data.event_sequence_from_records(
+            rec_id, recs,
+            config['fact_constructor'], config['event_constructor'])
+         for rec_id, recs in groups))
+
+
+def _record_groups_to_texts(groups):
+    configs = _worker_config
+    texts = list(sequences_to_texts(
+        _sequences_from_groups(groups, configs[0]), configs))
+    # Report this batch's metrics (if any) to the main process
+    collector = configs[0]['collector']
+    if collector is None:
+        return texts, None
+    batch_metrics = collector.as_dict()
+    collector.clear()
+    return texts, batch_metrics
+
+
+def mk_worker_pool(configs, jobs):
+    """
+    Return a pool of `jobs` processes for generating survival examples
+    with the given configurations.
+
+    The processes are forked, so create the pool before starting any
+    threads (such as those that read input, dump metrics, or run
+    pipeline stages).  Forking while another thread holds a lock (e.g.
+    of logging or a queue) can deadlock the workers.
+    """
+    context = multiprocessing.get_context('fork')
+    return context.Pool(jobs, _init_worker, (configs,))
+
+
+def parallel_survival_examples_texts(
+        record_groups, configs, jobs, batch_size=64, max_pending=None,
+        pool=None):
+    """
+    Process groups of patient records into survival examples text using
+    a pool of `jobs` processes.
+
+    Yield `(id, texts)` pairs in the same order as the given groups,
+    where `texts` has one text per configuration.  Metrics from the
+    workers are added to the metrics collector of the first
+    configuration (if any).  Groups are submitted
+    in batches of `batch_size` and at most `max_pending` batches
+    (default `4 * jobs`) are in flight at any time so that the input is
+    not read faster than it can be processed.
+
+    Use the given pool (see `mk_worker_pool`) or else create one when
+    the first item is requested.
+    """
+    if pool is None:
+        with mk_worker_pool(configs, jobs) as pool:
+            yield from parallel_survival_examples_texts(
+                record_groups, configs, jobs, batch_size, max_pending,
+                pool)
+        return
+    if max_pending is None:
+        max_pending = 4 * jobs
+    collector = configs[0]['collector']
+    pending = collections.deque()
+    record_groups = iter(record_groups)
+    while True:
+        batch = list(itools.islice(record_groups, batch_size))
+        if batch:
+            pending.append(pool.apply_async(
+                _record_groups_to_texts, (batch,)))
+        # Wait for the oldest batch if there are too many in flight or
+        # if there are no more batches to submit
+        if pending and (len(pending) >= max_pending or not batch):
+            with metrics.stage(collector, 'parallel_wait'):
+                texts, batch_metrics = pending.popleft().get()
+            # Collect the metrics of the workers
+            if batch_metrics is not None:
+                collector.update(batch_metrics)
+            yield from texts
+        elif not batch:
+            break
+
+
+def _intern_event_types(event_constructor, covariate_specs):
+    # Return an interner, an event constructor that uses it, and the
+    # covariate specifications in terms of its codes
+    if event_constructor is not event_data.event_from_record:
+        raise ValueError('Interning event types requires the default '
+                         'event constructor')
+    interner = event_data.EventTypeInterner()
+    covariate_specs = [
+        (kind, key if kind == 'fact' else interner.encode(key))
+        for (kind, key) in covariate_specs]
+    return interner, interner.event_from_record, covariate_specs
+
+
+def _mk_cohort_config(
+        exposure_types_filename,
+        outcome_types_filename,
+        comment_char,
+        event_type_parser,
+        exposure_event_type,
+        outcome_event_type,
+        event_type_interner=None,
+        **settings,
+):
+    logger = logging.getLogger(__name__)
+    # Read exposure and outcome IDs
+    exposure_types = list(read_event_types(
+        exposure_types_filename, comment_char, event_type_parser))
+    outcome_types = list(read_event_types(
+        outcome_types_filename, comment_char, event_type_parser))
+    # Log exposures and outcomes
+    logger.info('Using {} exposures:\n{}', len(exposure_types),
+                '\n'.join(str(x) for x in exposure_types))
+    logger.info('Using {} outcomes:\n{}', len(outcome_types),
+                '\n'.join(str(x) for x in outcome_types))
+    # Map event types to encode exposures and outcomes
+    event_type2type = build_exposure_outcome_event_type_map(
+        exposure_types, outcome_types, exposure_event_type,
+        outcome_event_type, event_type_interner)
+    # Configuration for generating examples from sequences
+    return dict(
+        event_type_map=event_type2type,
+        exposure_event_type=exposure_event_type,
+        outcome_event_type=outcome_event_type,
+        event_type_interner=event_type_interner,
+        **settings,
+    )
+
+
+# Output formats: pipe-delimited text and an example store (see
+# `example_store`)
+output_formats = ('csv', 'columnar')
+
+
+def _open_output(
+        out_file,
+        output_format,
+        feature_vector_header,
+        output_delimiter,
+        field_name2idx,
+        resume_offset=None,
+):
+    # Return the output and whether it needs to be closed
+    if output_format == 'columnar':
+        # The output is the directory of the store
+        return (example_store.ExampleStoreWriter(
+                    out_file, feature_vector_header),
+                True)
+    elif output_format != 'csv':
+        raise ValueError(
+            'Unknown output format: {!r}.  Must be one of: {}'.format(
+                output_format, ', '.join(output_formats)))
+    # Resume writing after the last checkpointed patient.  Discard
+    # anything written after the checkpoint.
+    if resume_offset is not None:
+        os.truncate(out_file, resume_offset)
+        return open(out_file, 'at'), True
+    # Open the file if it is a filename
+    to_close = not isinstance(out_file, io.IOBase)
+    if to_close:
+        out_file = open(out_file, 'wt')
+    # Print data header
+    id_idx = field_name2idx['id']
+    dates_idx = field_name2idx['dates']
+    fv_idx = field_name2idx['fv']
+    print(fields[id_idx], 'date_lo', 'date_hi',
+          *fields[(dates_idx + 1):fv_idx],
+          *feature_vector_header,
+          sep=output_delimiter, file=out_file)
+    return out_file, to_close
+
+
+def _close_outputs(outputs, succeeded):
+    # Close the outputs that need to be closed.  Only complete example
+    # stores if there was no error, and otherwise close and delete their
+    # column files.
+    for output, to_close in outputs:
+        if not to_close:
+            continue
+        if (isinstance(output, example_store.ExampleStoreWriter) and
+                not succeeded):
+            output.abort()
+            continue
+        output.close()
+
+
+# Checkpoints.  A checkpoint records how many patients (event
+# sequences) have been completely written, the ID of the last one, and
+# the sizes of the output files at that point.  Resuming skips the
+# input through that ID and truncates the outputs to those sizes, so no
+# partial patients are left in the outputs.
+
+
+def read_checkpoint(path):
+    with open(path, 'rt') as file:
+        return json.load(file)
+
+
+def write_checkpoint(path, checkpoint):
+    """Write the given checkpoint to the given file atomically."""
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wt') as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def _checkpoint(path, out_files, n_sequences, last_id, done=False):
+    # Make sure everything written so far is on disk before recording
+    # the sizes of the outputs
+    out_offsets = []
+    for out_file in out_files:
+        out_file.flush()
+        os.fsync(out_file.fileno())
+        out_offsets.append(os.fstat(out_file.fileno()).st_size)
+    write_checkpoint(path, dict(
+        n_sequences=n_sequences,
+        last_id=last_id,
+        out_offsets=out_offsets,
+        done=done,
+    ))
+
+
+def _prepare_checkpointing(
+        checkpoint_file, resume, out_files, output_format):
+    # Check the checkpointing arguments and return the checkpoint to
+    # resume from (if any)
+    if checkpoint_file is None:
+        if resume:
+            raise ValueError('Resuming requires a checkpoint file')
+        return None
+    if output_format != 'csv' or any(
+            isinstance(f, io.IOBase) for f in out_files):
+        raise ValueError('Checkpointing requires CSV output to files '
+                         'given by filename')
+    if not (resume and pathlib.Path(checkpoint_file).exists()):
+        return None
+    checkpoint = read_checkpoint(checkpoint_file)
+    if len(checkpoint['out_offsets']) != len(out_files):
+        raise ValueError(
+            'Checkpoint has {} outputs but there are {}'.format(
+                len(checkpoint['out_offsets']), len(out_files)))
+    logging.getLogger(__name__).info(
+        'Resuming after {} event sequences (last ID: {})',
+        checkpoint['n_sequences'], checkpoint['last_id'])
+    return checkpoint
+
+
+def _write_cohorts(
+        configs,
+        out_files,
+        in_file,
+        read_args,
+        jobs,
+        jobs_batch_size,
+        checkpoint_file=None,
+        checkpoint_every=1000,
+        resume_from=None,
+        metrics_file=None,
+        metrics_every=None,
+        max_patient_records=None,
+        oversize_policy='skip',
+        pipelined=False,
+        check_sorted=True,
+):
+    logger = logging.getLogger(__name__)
+    # Spilled patients are only valid while they are being processed, so
+    # they cannot be handed to other processes or threads
+    if ((jobs > 1 or pipelined) and max_patient_records is not None and
+            oversize_policy == 'spill'):
+        raise ValueError('Spilling oversize patients to disk requires '
+                         '`jobs=1` and `pipelined=False`')
+    # Regular event sequences read all the spilled records back into
+    # memory, which defeats the purpose of spilling.  Compact sequences
+    # stream them instead.
+    if (max_patient_records is not None and oversize_policy == 'spill'
+            and not configs[0]['compact_sequences']):
+        raise ValueError('Spilling oversize patients to disk requires '
+                         '`compact_sequences=True`')
+    # Logger for tracking reading records
+    def tracker(count):
+        logger.info('Event sequences: {}', count)
+    collector = configs[0]['collector']
+    # Start the worker processes (if any) before any threads (see
+    # `mk_worker_pool`)
+    pool = mk_worker_pool(configs, jobs) if jobs > 1 else None
+    pipe = None
+    dumper = None
+    try:
+        # Read, parse, and filter event records.  This includes
+        # interpreting drug records.  If resuming, skip the input
+        # through the last patient that was written before parsing it.
+        n_sequences = 0
+        resume_after_id = None
+        if resume_from is not None:
+            n_sequences = resume_from['n_sequences']
+            resume_after_id = resume_from['last_id']
+        records = metrics.timed(
+            collector, 'read_records',
+            read_event_records(
+                in_file, resume_after_id=resume_after_id, **read_args))
+        groups = metrics.timed(
+            collector, 'record_groups', event_data.record_groups(
+                records, max_records=max_patient_records,
+                oversize_policy=oversize_policy, collector=collector,
+                check_sorted=check_sorted))
+        # If pipelined, read, parse, and group records in one thread,
+        # assemble them into sequences in another (unless that is done by
+        # the worker processes), generate examples in another, and write
+        # them in this one.  Each stage only gets a bounded number of
+        # patients ahead of the next.  The worker pool (if any) was
+        # created above, before these threads.
+        if pipelined:
+            pipe = pipeline.Pipeline(collector)
+            groups = pipe.stage('groups', groups)
+        if pool is not None:
+            # Hand each patient's records to a pool of processes that
+            # assemble them into sequences and generate examples
+            logger.info('Reading event records and generating survival '
+                        'data examples with {} processes', jobs)
+            texts = parallel_survival_examples_texts(
+                groups, configs, jobs, jobs_batch_size, pool=pool)
+        else:
+            # Assemble records into sequences and generate survival
+            # examples from sequences
+            logger.info('Reading event records and generating survival '
+                        'data examples from event sequences')
+            ev_seqs = _sequences_from_groups(groups, configs[0])
+            if pipe is not None:
+                ev_seqs = pipe.stage('sequences', ev_seqs)
+            texts = sequences_to_texts(ev_seqs, configs)
+        if pipe is not None:
+            texts = pipe.stage('texts', texts)
+        # Dump metrics periodically if requested
+        if collector is not None and metrics_every:
+            dumper = metrics.PeriodicDumper(
+                collector, metrics_file, metrics_every).start()
+        # Print examples
+        seq_id = None if resume_from is None else resume_from['last_id']
+        for seq_id, seq_texts in general.track_iterator(
+                texts,
+                tracker, track_every=1000,
+                track_init=True, track_end=True):
+            # Write text (or flattened examples for columnar output)
+            for cohort_idx, (text, out_file) in enumerate(
+                    zip(seq_texts, out_files)):
+                if not text:
+                    if len(out_files) == 1:
+                        logger.info('Discarding event sequence {}: '
+                                    'No events in study period', seq_id)
+                    else:
+                        logger.info('Discarding event sequence {} from '
+                                    'cohort {}: No events in study period',
+                                    seq_id, cohort_idx)
+                    if collector is not None:
+                        collector.count('sequences_discarded')
+                with metrics.stage(collector, 'write'):
+                    out_file.write(text)
+            if collector is not None:
+                collector.count('sequences')
+            # Checkpoint after completely writing a patient
+            n_sequences += 1
+            if (checkpoint_file is not None and
+                    n_sequences % checkpoint_every == 0):
+                with metrics.stage(collector, 'checkpoint'):
+                    _checkpoint(
+                        checkpoint_file, out_files, n_sequences, seq_id)
+    finally:
+        if pipe is not None:
+            pipe.close()
+        if dumper is not None:
+            dumper.stop()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if checkpoint_file is not None:
+        _checkpoint(
+            checkpoint_file, out_files, n_sequences, seq_id, done=True)
+    # Dump and log the metrics
+    if collector is not None:
+        collector.dump(metrics_file)
+        logger.info('Metrics:\n{}',
+                    json.dumps(collector.as_dict(), indent=2))
+
+
 def main_api( # TODO redo everything in terms of `cdmdata`
         exposure_types_filename,
         outcome_types_filename,
@@ -536,90 +1529,321 @@ def main_api( # TODO redo everything in terms of `cdmdata`
         outcome_event_type=('out',),
         csv_format=event_data.csv_format,
         include_tables=event_data.tables,
+        json_constructor=json.loads,
+        record_parser=event_data.parse_record,
         include_record=None,
         record_transformer=None,
+        records_transformer=None,
+        sort_by_id=False,
+        sort_memory_budget=2 ** 30,
+        check_sorted=True,
         fact_constructor=event_data.fact_from_record,
         event_constructor=event_data.event_from_record,
+        intern_event_types=False,
+        compact_sequences=False,
         study_period_definer=None,
         replace_mapped_events=False,
         era_max_gap=datetime.timedelta(0),
+        truncate_at_outcome=False,
+        study_start_definer=None,
         feature_vector_header=(),
         feature_vector_function=None,
+        covariate_specs=(),
+        output_format='csv',
         output_delimiter='|',
         field_name2idx=field_name2idx,
+        jobs=1,
+        jobs_batch_size=64,
+        max_patient_records=None,
+        oversize_policy='skip',
+        pipelined=False,
+        checkpoint_file=None,
+        checkpoint_every=1000,
+        resume=False,
+        metrics_file=None,
+        metrics_every=None,
 ):
+    """
+    Make survival data for the given exposures and outcomes from the
+    event records in `in_file` (a CSV file or an event store) and write
+    it to `out_file` (see `README.md`).
+
+    The records are read, filtered, and transformed (see
+    `read_event_records`), grouped by patient (see
+    `event_data.record_groups`), assembled into event sequences, and
+    made into survival examples (see `survivalize` and
+    `survival_examples_text`) in the given `output_format`.  The
+    remaining arguments control speed and memory use (e.g. `jobs`,
+    `pipelined`, `compact_sequences`, and `max_patient_records`) and
+    checkpointing, resuming, and metrics.
+    """
     # Log start
     logger = logging.getLogger(__name__)
     logger.info('Starting `main_api` with arguments:\n{}',
                 pprint.pformat(locals()))
-    # Read exposure and outcome IDs
-    exposure_types = list(read_event_types(
-        exposure_types_filename, comment_char, event_type_parser))
-    outcome_types = list(read_event_types(
-        outcome_types_filename, comment_char, event_type_parser))
-    # Log exposures and outcomes
-    logger.info('Using {} exposures:\n{}', len(exposure_types),
-                '\n'.join(str(x) for x in exposure_types))
-    logger.info('Using {} outcomes:\n{}', len(outcome_types),
-                '\n'.join(str(x) for x in outcome_types))
-    # Map event types to encode exposures and outcomes
-    event_type2type = build_exposure_outcome_event_type_map(
-        exposure_types, outcome_types, exposure_event_type, outcome_event_type)
-    # Read records from input, process into events, assemble into
-    # sequences
-    logger.info('Reading event records and assembling into sequences')
-    seqs = events_to_sequences(
-        in_file,
-        event_type2type,
-        csv_format=csv_format,
-        comment_char=comment_char,
-        include_tables=include_tables,
-        include_record=include_record,
-        record_transformer=record_transformer,
+    # Collect metrics if requested
+    collector = metrics.Metrics() if metrics_file is not None else None
+    # Use integer event types if requested
+    covariate_specs = covariates.check_specs(covariate_specs)
+    if (compact_sequences and
+            event_constructor is not event_data.event_from_record):
+        raise ValueError('Compact sequences require the default event '
+                         'constructor')
+    event_type_interner = None
+    if intern_event_types:
+        event_type_interner, event_constructor, covariate_specs = (
+            _intern_event_types(event_constructor, covariate_specs))
+    # Read exposure and outcome IDs and build the configuration for
+    # generating examples from sequences
+    config = _mk_cohort_config(
+        exposure_types_filename,
+        outcome_types_filename,
+        comment_char,
+        event_type_parser,
+        exposure_event_type,
+        outcome_event_type,
+        event_type_interner,
         fact_constructor=fact_constructor,
         event_constructor=event_constructor,
+        compact_sequences=compact_sequences,
         study_period_definer=study_period_definer,
         replace_mapped_events=replace_mapped_events,
         era_max_gap=era_max_gap,
+        truncate_at_outcome=truncate_at_outcome,
+        study_start_definer=study_start_definer,
+        feature_vector_function=feature_vector_function,
+        covariate_specs=covariate_specs,
+        output_format=output_format,
+        output_delimiter=output_delimiter,
+        field_name2idx=field_name2idx,
+        collector=collector,
     )
-    # Print data header
-    id_idx = field_name2idx['id']
-    dates_idx = field_name2idx['dates']
-    fv_idx = field_name2idx['fv']
-    print(fields[id_idx], 'date_lo', 'date_hi',
-          *fields[(dates_idx + 1):fv_idx],
-          *feature_vector_header,
-          sep=output_delimiter, file=out_file)
-    # Logger for tracking reading records
-    def tracker(count):
-        logger.info('Event sequences: {}', count)
-    # Generate survival examples from sequences
-    logger.info('Generating survival data examples from event sequences')
-    for ev_seq in general.track_iterator(
-            seqs,
-            tracker, track_every=1000,
-            track_init=True, track_end=True):
-        #ev_seq.pprint(file=sys.stderr)
-        exs = list(event_sequence_to_survival_data_examples(
-            ev_seq,
-            exposure_event_type, outcome_event_type,
-            feature_vector_function, field_name2idx))
-        if len(exs) == 0:
-            logger.info('Discarding event sequence {}: '
-                        'No events in study period', ev_seq.id)
-        # Print examples
-        for ex in exs:
-            print_survival_example(
-                ex,
-                delimiter=output_delimiter,
-                file=out_file,
-                id_idx=id_idx,
-                dates_idx=dates_idx,
-                fv_idx=fv_idx,
-            )
+    # Check checkpointing and find where to resume (if anywhere)
+    resume_from = _prepare_checkpointing(
+        checkpoint_file, resume, [out_file], output_format)
+    # Open the output and print the data header (if any)
+    output = _open_output(
+        out_file, output_format, feature_vector_header, output_delimiter,
+        field_name2idx,
+        resume_from['out_offsets'][0] if resume_from is not None else None)
+    # Read records from input, process into events, assemble into
+    # sequences, and generate examples
+    succeeded = False
+    try:
+        _write_cohorts(
+            [config], [output[0]], in_file,
+            dict(
+                csv_format=csv_format,
+                comment_char=comment_char,
+                include_tables=include_tables,
+                json_constructor=json_constructor,
+                record_parser=record_parser,
+                include_record=include_record,
+                record_transformer=record_transformer,
+                records_transformer=records_transformer,
+                sort_by_id=sort_by_id,
+                sort_memory_budget=sort_memory_budget,
+                collector=collector,
+            ),
+            jobs, jobs_batch_size,
+            checkpoint_file, checkpoint_every, resume_from,
+            metrics_file, metrics_every,
+            max_patient_records, oversize_policy, pipelined,
+            check_sorted)
+        succeeded = True
+    finally:
+        _close_outputs([output], succeeded)
     logger.info('Done `main_api`')
 
 
+# Multiple cohorts
+
+# A manifest lists cohorts (exposure / outcome definitions) to make data
+# for in a single pass over the events.  It has one cohort per line.
+# Each line has the form:
+#
+#     exposure_types_filename|outcome_types_filename|output_filename[|era_max_gap]
+#
+# where the optional era max gap is in days.  Blank lines and comments
+# are ignored.
+
+
+def read_manifest(file, comment_char='#', delimiter='|'):
+    """
+    Read the cohorts in the given manifest and yield them as
+    dictionaries of `main_api_cohorts` settings.
+    """
+    # Try to open the file unless it is already a stream
+    if not isinstance(file, io.IOBase):
+        file = open(file, 'rt')
+    with file as lines:
+        for (line_num, line) in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith(comment_char):
+                continue
+            flds = [fld.strip() for fld in line.split(delimiter)]
+            if len(flds) not in (3, 4) or not all(flds[:3]):
+                raise ValueError(
+                    'Bad manifest line {}: {!r}.  Expected: '
+                    'exposures{}outcomes{}output[{}era_max_gap]'.format(
+                        line_num, line, delimiter, delimiter, delimiter))
+            cohort = dict(
+                exposure_types_filename=flds[0],
+                outcome_types_filename=flds[1],
+                out_file=flds[2],
+            )
+            if len(flds) == 4 and flds[3]:
+                cohort['era_max_gap'] = datetime.timedelta(
+                    days=float(flds[3]))
+            yield cohort
+
+
+def main_api_cohorts(
+        cohorts,
+        *, # Prevent any additional positional arguments, like from the
+           # command line
+        in_file=sys.stdin,
+        comment_char='#',
+        event_type_parser=parse_event_type,
+        exposure_event_type=('exp',),
+        outcome_event_type=('out',),
+        csv_format=event_data.csv_format,
+        include_tables=event_data.tables,
+        json_constructor=json.loads,
+        record_parser=event_data.parse_record,
+        include_record=None,
+        record_transformer=None,
+        records_transformer=None,
+        sort_by_id=False,
+        sort_memory_budget=2 ** 30,
+        check_sorted=True,
+        fact_constructor=event_data.fact_from_record,
+        event_constructor=event_data.event_from_record,
+        intern_event_types=False,
+        compact_sequences=False,
+        study_period_definer=None,
+        replace_mapped_events=False,
+        era_max_gap=datetime.timedelta(0),
+        truncate_at_outcome=False,
+        study_start_definer=None,
+        feature_vector_header=(),
+        feature_vector_function=None,
+        covariate_specs=(),
+        output_format='csv',
+        output_delimiter='|',
+        field_name2idx=field_name2idx,
+        jobs=1,
+        jobs_batch_size=64,
+        max_patient_records=None,
+        oversize_policy='skip',
+        pipelined=False,
+        checkpoint_file=None,
+        checkpoint_every=1000,
+        resume=False,
+        metrics_file=None,
+        metrics_every=None,
+):
+    """
+    Like `main_api` but make data for several cohorts while reading and
+    parsing the events only once.
+
+    `cohorts` is a manifest (filename or stream, see `read_manifest`) or
+    a list of dictionaries with keys `exposure_types_filename`,
+    `outcome_types_filename`, and `out_file` (a filename or stream, or a
+    directory for columnar output), and
+    optionally `era_max_gap`.  All other settings are shared by the
+    cohorts.  Checkpoints cover all the cohorts.
+    """
+    # Log start
+    logger = logging.getLogger(__name__)
+    logger.info('Starting `main_api_cohorts` with arguments:\n{}',
+                pprint.pformat(locals()))
+    # Read the manifest
+    if isinstance(cohorts, (str, pathlib.PurePath, io.IOBase)):
+        cohorts = read_manifest(cohorts, comment_char)
+    cohorts = list(cohorts)
+    # Collect metrics if requested
+    collector = metrics.Metrics() if metrics_file is not None else None
+    # Use integer event types if requested.  All cohorts share the codes.
+    covariate_specs = covariates.check_specs(covariate_specs)
+    if (compact_sequences and
+            event_constructor is not event_data.event_from_record):
+        raise ValueError('Compact sequences require the default event '
+                         'constructor')
+    event_type_interner = None
+    if intern_event_types:
+        event_type_interner, event_constructor, covariate_specs = (
+            _intern_event_types(event_constructor, covariate_specs))
+    # Build a configuration for each cohort
+    configs = []
+    for (cohort_idx, cohort) in enumerate(cohorts):
+        logger.info('Cohort {}: {}', cohort_idx, cohort)
+        configs.append(_mk_cohort_config(
+            cohort['exposure_types_filename'],
+            cohort['outcome_types_filename'],
+            comment_char,
+            event_type_parser,
+            exposure_event_type,
+            outcome_event_type,
+            event_type_interner,
+            fact_constructor=fact_constructor,
+            event_constructor=event_constructor,
+            compact_sequences=compact_sequences,
+            study_period_definer=study_period_definer,
+            replace_mapped_events=replace_mapped_events,
+            era_max_gap=cohort.get('era_max_gap', era_max_gap),
+            truncate_at_outcome=truncate_at_outcome,
+            study_start_definer=study_start_definer,
+            feature_vector_function=feature_vector_function,
+            covariate_specs=covariate_specs,
+            output_format=output_format,
+            output_delimiter=output_delimiter,
+            field_name2idx=field_name2idx,
+            collector=collector,
+        ))
+    # Check checkpointing and find where to resume (if anywhere)
+    resume_from = _prepare_checkpointing(
+        checkpoint_file, resume, [c['out_file'] for c in cohorts],
+        output_format)
+    # Open the outputs and print their headers (if any)
+    outputs = []
+    succeeded = False
+    try:
+        for (cohort_idx, cohort) in enumerate(cohorts):
+            outputs.append(_open_output(
+                cohort['out_file'], output_format, feature_vector_header,
+                output_delimiter, field_name2idx,
+                (resume_from['out_offsets'][cohort_idx]
+                 if resume_from is not None
+                 else None)))
+        # Read records from input, process into events, assemble into
+        # sequences, and generate examples for every cohort
+        _write_cohorts(
+            configs, [output for (output, _) in outputs], in_file,
+            dict(
+                csv_format=csv_format,
+                comment_char=comment_char,
+                include_tables=include_tables,
+                json_constructor=json_constructor,
+                record_parser=record_parser,
+                include_record=include_record,
+                record_transformer=record_transformer,
+                records_transformer=records_transformer,
+                sort_by_id=sort_by_id,
+                sort_memory_budget=sort_memory_budget,
+                collector=collector,
+            ),
+            jobs, jobs_batch_size,
+            checkpoint_file, checkpoint_every, resume_from,
+            metrics_file, metrics_every,
+            max_patient_records, oversize_policy, pipelined,
+            check_sorted)
+        succeeded = True
+    finally:
+        _close_outputs(outputs, succeeded)
+    logger.info('Done `main_api_cohorts`')
+
+
 # Tests
 
 
@@ -775,6 +1999,55 @@ class SurvivalDataTest(unittest.TestCase):
         actual = set_drug_interval(record, washout=14)
         self.assertEqual(expected, actual)
 
+    def test_set_drug_intervals(self):
+        # Compare with `set_drug_interval` on many combinations of values
+        rng = random.Random(16)
+        choices = [None, '', 0, -1, 1, 3, 7, 30, 90, 2.5, 45.9, 'x', True,
+                   10 ** 7]
+        lo = datetime.date(2000, 1, 1)
+        records = []
+        for _ in range(2000):
+            attrs = {key: rng.choice(choices)
+                     for key in ('days_supply', 'refills', 'quantity')
+                     if rng.random() < 0.8}
+            rec_lo = rng.choice([lo, lo, lo, None])
+            rec_hi = rng.choice(
+                [None, lo, lo + datetime.timedelta(rng.randint(-5, 400))])
+            records.append([1, rec_lo, rec_hi, 'rx', 1234, None, attrs])
+        for min_days, washout in ((30, 0), (10, 5), (0, -3)):
+            expected = []
+            for record in records:
+                try:
+                    expected.append(set_drug_interval(
+                        list(record), min_days, washout))
+                except Exception as e:
+                    expected.append(type(e))
+            actual = []
+            for record in records:
+                try:
+                    actual.extend(set_drug_intervals(
+                        [list(record)], min_days, washout))
+                except Exception as e:
+                    actual.append(type(e))
+            self.assertEqual(expected, actual)
+            # All at once
+            good = [list(r) for (r, e) in zip(records, expected)
+                    if not isinstance(e, type)]
+            self.assertEqual([e for e in expected if not isinstance(e, type)],
+                             set_drug_intervals(good, min_days, washout))
+
+    def test_transform_records(self):
+        records = [
+            [1, datetime.date(2000, 1, 1), None, 'rx', 1, None,
+             {'days_supply': 10}],
+            [1, datetime.date(2000, 1, 1), None, 'dx', 2, None, {}],
+            [1, datetime.date(2000, 1, 2), None, 'rx', 3, None, {}],
+        ]
+        expected = [transform_record(list(r)) for r in records]
+        actual = list(transform_records(
+            (list(r) for r in records), block_size=2))
+        self.assertEqual(expected, actual)
+
     def test_limit_to_ages(self):
         mk_ev = SurvivalDataTest.mk_ev
         dob = datetime.date(2000, 1, 1)
@@ -845,6 +2118,52 @@ class SurvivalDataTest(unittest.TestCase):
             self.assertEqual(ev1.type, ev2.type)
             self.assertEqual(ev1.when, ev2.when)
 
+    def test_make_eras__generic(self):
+        # Compare with the generic aggregation on random sequences
+        rng = random.Random(17)
+        start = datetime.date(2000, 1, 1)
+        for max_gap in (datetime.timedelta(0), datetime.timedelta(30)):
+            for _ in range(100):
+                evs = []
+                for _ in range(rng.randint(0, 30)):
+                    lo = start + datetime.timedelta(rng.randint(0, 1000))
+                    hi = lo + datetime.timedelta(rng.choice(
+                        [0, 0, rng.randint(1, 100)]))
+                    evs.append(esal.Event(
+                        esal.Interval(lo, hi), rng.choice('eeooa')))
+                es = esal.EventSequence(evs)
+                expected = sorted((e.when.lo, e.when.hi, e.type) for e in
+                                  make_eras_generic(es, ('e', 'o'), max_gap))
+                actual = sorted((e.when.lo, e.when.hi, e.type) for e in
+                                make_eras(es, ('e', 'o'), max_gap))
+                self.assertEqual(expected, actual)
+
+    def test_truncate_at_first_outcome(self):
+        d = datetime.date
+        evs = [
+            esal.Event(esal.Interval(d(2010, 1, 1), d(2010, 3, 1)), 'e'),
+            esal.Event(esal.Interval(d(2010, 2, 1)), 'a'),
+            esal.Event(esal.Interval(d(2010, 5, 1)), 'o'),
+            esal.Event(esal.Interval(d(2010, 5, 1)), 'b'),
+            esal.Event(esal.Interval(d(2010, 5, 20), d(2010, 7, 1)), 'e'),
+            esal.Event(esal.Interval(d(2010, 6, 1)), 'o'),
+            esal.Event(esal.Interval(d(2010, 6, 2)), 'a'),
+        ]
+        gap = datetime.timedelta(30)
+        # Keep events up to the outcome and eras within the gap
+        self.assertEqual(
+            evs[:5], truncate_at_first_outcome(evs, 'o', ('e', 'o'), gap))
+        self.assertEqual(
+            evs[:4], truncate_at_first_outcome(
+                evs, 'o', ('e', 'o'), datetime.timedelta(0)))
+        # Keep everything if there is no outcome or if the outcome is
+        # at the start of the study
+        self.assertEqual(
+            evs, truncate_at_first_outcome(evs, 'x', ('e', 'o'), gap))
+        self.assertEqual(
+            evs, truncate_at_first_outcome(
+                evs, 'o', ('e', 'o'), gap, study_start=d(2010, 5, 1)))
+
     def test_examples_from_transitions(self):
         evs = [(esal.Event(e.when, 'e')
                 if e.type == 'era'
@@ -855,6 +2174,64 @@ class SurvivalDataTest(unittest.TestCase):
         exs_act = list(examples_from_transitions(es, 'e', 'o'))
         self.assertEqual(self.examples, exs_act)
 
+    def test_event_interval_index(self):
+        es = esal.EventSequence(self.evs, id_=0)
+        idx = EventIntervalIndex(es)
+        dates = sorted(set(d for e in self.evs
+                           for d in (e.when.lo, e.when.hi)))
+        dates = ([dates[0] - datetime.timedelta(1)] + dates +
+                 [dates[-1] + datetime.timedelta(1)])
+        for lo in dates:
+            for hi in dates:
+                if hi < lo:
+                    continue
+                itvl = esal.Interval(lo, hi)
+                args = (itvl.lo, itvl.hi, itvl.is_lo_open, itvl.is_hi_open)
+                self.assertEqual(es.events_overlapping(*args),
+                                 idx.events_overlapping(*args))
+
+    def test_examples_from_transitions__feature_vector(self):
+        evs = [(esal.Event(e.when, 'e')
+                if e.type == 'era'
+                else e)
+               for e in self.evs
+               if e.type not in ('e1', 'e2')]
+        es = esal.EventSequence(evs, id_=0)
+        fvf = mk_feature_vector_function(
+            mk_event_count_feature('a'),
+            mk_event_count_feature('b'),
+        )
+        # Feature vectors are the same as those from searching the
+        # whole sequence
+        exs_exp = []
+        for ex in self.examples:
+            ex = list(ex)
+            itvl = ex[field_name2idx['dates']]
+            ex[field_name2idx['fv']] = fvf(es.subsequence(
+                es.events_overlapping(
+                    itvl.lo, itvl.hi, itvl.is_lo_open, itvl.is_hi_open)))
+            exs_exp.append(ex)
+        exs_act = list(examples_from_transitions(
+            es, 'e', 'o', feature_vector_function=fvf))
+        self.assertEqual(exs_exp, exs_act)
+
+    def test_examples_from_transitions__covariates(self):
+        evs = [(esal.Event(e.when, 'e')
+                if e.type == 'era'
+                else e)
+               for e in self.evs
+               if e.type not in ('e1', 'e2')]
+        es = esal.EventSequence(evs, id_=0)
+        fvf = mk_feature_vector_function(
+            mk_event_count_feature('a'),
+            mk_has_event_feature('b'),
+        )
+        exs_exp = list(examples_from_transitions(
+            es, 'e', 'o', feature_vector_function=fvf))
+        exs_act = list(examples_from_transitions(
+            es, 'e', 'o', covariate_specs=[('count', 'a'), ('has', 'b')]))
+        self.assertEqual(exs_exp, exs_act)
+
     def test_examples_to_survival_examples(self):
         exs_exp = self.examples[:6]
         # Update a copy of the example to keep the original list intact
@@ -1038,3 +2415,588 @@ id|date_lo|date_hi|lo|hi|len|exp|out|age|sex|snp-rs6311|snp-rs6313
         )
         self.maxDiff = None
         self.assertEqual(examples_csv_text, exs_file.getvalue())
+
+    def test_main__jobs(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        # Several patients with the same records but different IDs
+        events_csv_text = ''.join(
+            self.events_csv_text.replace('746|', f'{id}|')
+            for id in range(746, 751))
+        outputs = []
+        for jobs in (1, 3):
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(events_csv_text), out_file=exs_file,
+                include_record=include_record,
+                record_transformer=transform_record,
+                jobs=jobs,
+                jobs_batch_size=2,
+            )
+            outputs.append(exs_file.getvalue())
+        self.maxDiff = None
+        self.assertEqual(1 + 5 * 5, len(outputs[0].splitlines()))
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main__records_transformer(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        outputs = []
+        for transformers in ((transform_record, None),
+                             (None, transform_records)):
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(self.events_csv_text), out_file=exs_file,
+                record_transformer=transformers[0],
+                records_transformer=transformers[1],
+            )
+            outputs.append(exs_file.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main__intern_event_types(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        events_csv_text = ''.join(
+            self.events_csv_text.replace('746|', f'{id}|')
+            for id in range(746, 749))
+        outputs = []
+        for (intern, jobs) in ((False, 1), (True, 1), (True, 2)):
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(events_csv_text), out_file=exs_file,
+                record_transformer=transform_record,
+                intern_event_types=intern,
+                feature_vector_header=('n_733', 'has_dx'),
+                covariate_specs=[('count', ('rx', 733)),
+                                 ('has', ('dx', 80180))],
+                jobs=jobs,
+            )
+            outputs.append(exs_file.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+        with self.assertRaises(ValueError):
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(events_csv_text), out_file=io.StringIO(),
+                event_constructor=lambda r: None,
+                intern_event_types=True,
+            )
+
+    def test_main__compact_sequences(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+dx|80180
+xx|
+'''
+        events_csv_text = ''.join(
+            self.events_csv_text.replace('746|', f'{id}|')
+            for id in range(746, 749))
+        settings = [
+            dict(),
+            dict(era_max_gap=datetime.timedelta(90),
+                 feature_vector_header=('age', 'sex', 'n_733', 'has_dx'),
+                 feature_vector_function=mk_feature_vector_function(
+                     age_at_first_event,
+                     mk_fact_feature(('bx', 'gndr'))),
+                 covariate_specs=[('count', ('rx', 733)),
+                                  ('has', ('dx', 80180))]),
+            dict(study_period_definer=lambda s: limit_to_ages(s, 30, 60),
+                 study_start_definer=lambda s: date_at_age(s, 30),
+                 truncate_at_outcome=True,
+                 replace_mapped_events=True),
+            dict(intern_event_types=True, jobs=2),
+        ]
+        for kwargs in settings:
+            outputs = []
+            for compact in (False, True):
+                exs_file = io.StringIO()
+                main_api(
+                    io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                    in_file=io.StringIO(events_csv_text), out_file=exs_file,
+                    record_transformer=transform_record,
+                    compact_sequences=compact,
+                    **kwargs)
+                outputs.append(exs_file.getvalue())
+            self.assertGreater(len(outputs[0].splitlines()), 3)
+            self.assertEqual(outputs[0], outputs[1], kwargs)
+
+    def test_main__pipelined(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+dx|80180
+xx|
+'''
+        events_csv_text = ''.join(
+            self.events_csv_text.replace('746|', f'{id}|')
+            for id in range(746, 846))
+        settings = [
+            dict(),
+            dict(era_max_gap=datetime.timedelta(90),
+                 compact_sequences=True),
+            dict(jobs=2, jobs_batch_size=7),
+        ]
+        for kwargs in settings:
+            outputs = []
+            for pipelined in (False, True):
+                exs_file = io.StringIO()
+                metrics_file = io.StringIO()
+                main_api(
+                    io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                    in_file=io.StringIO(events_csv_text), out_file=exs_file,
+                    record_transformer=transform_record,
+                    pipelined=pipelined, metrics_file=metrics_file,
+                    **kwargs)
+                outputs.append(exs_file.getvalue())
+            self.assertGreater(len(outputs[0].splitlines()), 100)
+            self.assertEqual(outputs[0], outputs[1], kwargs)
+            # The queue depths are recorded
+            observations = json.loads(
+                metrics_file.getvalue())['observations']
+            names = ['groups', 'texts']
+            if kwargs.get('jobs', 1) == 1:
+                names.append('sequences')
+            else:
+                self.assertNotIn('queue_depth.sequences', observations)
+            for name in names:
+                depth = observations['queue_depth.' + name]
+                self.assertEqual(101, depth['n'])
+                self.assertLessEqual(depth['max'], 64)
+
+    def test_main__max_patient_records(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+dx|80180
+xx|
+'''
+        n_records = sum(1 for line in self.events_csv_text.splitlines()
+                        if line.startswith('746|'))
+        # Patient 747 has twice as many records as the others
+        texts = {id: self.events_csv_text.replace('746|', f'{id}|')
+                 for id in range(746, 749)}
+        events_csv_text = texts[746] + texts[747] * 2 + texts[748]
+        def run(text=events_csv_text, **kwargs):
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(text), out_file=exs_file,
+                record_transformer=transform_record,
+                era_max_gap=datetime.timedelta(90),
+                **kwargs)
+            return exs_file.getvalue()
+        expected = run()
+        self.assertIn('747|', expected)
+        # Spilling gives the same output
+        self.assertEqual(expected, run(
+            max_patient_records=n_records, oversize_policy='spill',
+            compact_sequences=True))
+        # A large enough maximum does not change anything
+        self.assertEqual(expected, run(
+            max_patient_records=2 * n_records, oversize_policy='skip'))
+        # Skipping drops the oversize patient
+        self.assertEqual(run(texts[746] + texts[748]), run(
+            max_patient_records=n_records, oversize_policy='skip'))
+        # Truncating keeps the earliest records of the oversize patient
+        truncated = run(max_patient_records=n_records,
+                        oversize_policy='truncate')
+        self.assertEqual(
+            [l for l in expected.splitlines() if not l.startswith('747|')],
+            [l for l in truncated.splitlines()
+             if not l.startswith('747|')])
+        self.assertIn('747|', truncated)
+        # Spilling requires compact sequences and one process
+        with self.assertRaises(ValueError):
+            run(max_patient_records=n_records, oversize_policy='spill')
+        with self.assertRaises(ValueError):
+            run(max_patient_records=n_records, oversize_policy='spill',
+                compact_sequences=True, jobs=2)
+
+    def test_main__event_store(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        outputs = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_dir = pathlib.Path(tmp_dir) / 'evs'
+            event_store.compile_store(
+                io.StringIO(self.events_csv_text), store_dir)
+            for in_file in (io.StringIO(self.events_csv_text), store_dir):
+                exs_file = io.StringIO()
+                main_api(
+                    io.StringIO(exposures_text),
+                    io.StringIO(outcomes_text),
+                    in_file=in_file, out_file=exs_file,
+                    include_record=include_record,
+                    record_transformer=transform_record,
+                )
+                outputs.append(exs_file.getvalue())
+        self.maxDiff = None
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main__lazy_json(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        outputs = []
+        for json_constructor in (json.loads, event_data.lazy_json):
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(self.events_csv_text),
+                out_file=exs_file,
+                json_constructor=json_constructor,
+                include_record=include_record,
+                record_transformer=transform_record,
+            )
+            outputs.append(exs_file.getvalue())
+        self.maxDiff = None
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main__truncate_at_outcome(self):
+        # Truncating at the first outcome does not change the examples
+        configs = (
+            ('rx|377\nrx|733\nrx|976\n', 'xx|\n', {}),
+            ('rx|976\n', 'dx|2818\n', {}),
+            ('qx|111\n', 'xx|\n', dict(
+                study_period_definer=(
+                    lambda s: limit_to_ages(s, min_age=50)),
+                study_start_definer=lambda s: date_at_age(s, 50),
+            )),
+            ('rx|377\nrx|733\n', 'rx|976\n', dict(
+                era_max_gap=datetime.timedelta(400))),
+        )
+        self.maxDiff = None
+        for exposures_text, outcomes_text, kwargs in configs:
+            outputs = []
+            for truncate_at_outcome in (False, True):
+                exs_file = io.StringIO()
+                main_api(
+                    io.StringIO(exposures_text),
+                    io.StringIO(outcomes_text),
+                    in_file=io.StringIO(self.events_csv_text),
+                    out_file=exs_file,
+                    include_record=include_record,
+                    record_transformer=transform_record,
+                    truncate_at_outcome=truncate_at_outcome,
+                    **kwargs)
+                outputs.append(exs_file.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_survivalize__truncate_needs_study_start(self):
+        es = esal.EventSequence(self.evs, id_=0)
+        with self.assertRaises(ValueError):
+            survivalize(es, {'o': 'o'},
+                        study_period_definer=lambda s: s,
+                        truncate_at_outcome=True, outcome_event_type='o')
+
+    def test_main_cohorts(self):
+        cohorts_args = (
+            ('rx|377\nrx|733\nrx|976\n', 'xx|\n', {}),
+            ('rx|976\n', 'dx|2818\n', {}),
+            ('rx|377\nrx|733\n', 'rx|976\n',
+             dict(era_max_gap=datetime.timedelta(400))),
+        )
+        # Expected: one call of `main_api` per cohort
+        expected = []
+        for exposures_text, outcomes_text, kwargs in cohorts_args:
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(self.events_csv_text),
+                out_file=exs_file,
+                include_record=include_record,
+                record_transformer=transform_record,
+                **kwargs)
+            expected.append(exs_file.getvalue())
+        self.maxDiff = None
+        for jobs in (1, 2):
+            # Actual: all cohorts in one pass
+            cohorts = [
+                dict(exposure_types_filename=io.StringIO(exposures_text),
+                     outcome_types_filename=io.StringIO(outcomes_text),
+                     out_file=io.StringIO(),
+                     **kwargs)
+                for exposures_text, outcomes_text, kwargs in cohorts_args]
+            main_api_cohorts(
+                cohorts,
+                in_file=io.StringIO(self.events_csv_text),
+                include_record=include_record,
+                record_transformer=transform_record,
+                jobs=jobs,
+            )
+            self.assertEqual(
+                expected, [c['out_file'].getvalue() for c in cohorts])
+
+    def test_read_manifest(self):
+        manifest_text = '''
+# Statins and metformin
+exp_ids.statins.csv|out_ids.mi.csv|data.statins-mi.csv
+exp_ids.metformin.csv | out_ids.mi.csv | data.metformin-mi.csv | 360
+'''
+        cohorts = list(read_manifest(io.StringIO(manifest_text)))
+        self.assertEqual([
+            dict(exposure_types_filename='exp_ids.statins.csv',
+                 outcome_types_filename='out_ids.mi.csv',
+                 out_file='data.statins-mi.csv'),
+            dict(exposure_types_filename='exp_ids.metformin.csv',
+                 outcome_types_filename='out_ids.mi.csv',
+                 out_file='data.metformin-mi.csv',
+                 era_max_gap=datetime.timedelta(360)),
+        ], cohorts)
+        with self.assertRaises(ValueError):
+            list(read_manifest(io.StringIO('exp.csv|out.csv\n')))
+
+    def test_main__columnar(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        feature_vector_function = mk_feature_vector_function(
+            age_at_first_event,
+            mk_fact_feature(('bx', 'gndr')),
+        )
+        exs_file = io.StringIO()
+        main_api(
+            io.StringIO(exposures_text), io.StringIO(outcomes_text),
+            in_file=io.StringIO(self.events_csv_text), out_file=exs_file,
+            include_record=include_record,
+            record_transformer=transform_record,
+            feature_vector_header=('age', 'sex'),
+            feature_vector_function=feature_vector_function,
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_dir = pathlib.Path(tmp_dir) / 'exs'
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(self.events_csv_text),
+                out_file=store_dir,
+                include_record=include_record,
+                record_transformer=transform_record,
+                feature_vector_header=('age', 'sex'),
+                feature_vector_function=feature_vector_function,
+                output_format='columnar',
+            )
+            meta, _ = example_store.read_columns(store_dir)
+            exs = example_store.read_examples(store_dir)
+        # Compare as text
+        lines = exs_file.getvalue().splitlines()
+        self.assertEqual(lines[0].split('|'),
+                         [c['name'] for c in meta['columns']])
+        self.assertEqual(
+            lines[1:],
+            ['|'.join(str(v) if v is not None else '' for v in ex)
+             for ex in exs])
+        with self.assertRaises(ValueError):
+            main_api(io.StringIO(exposures_text),
+                     io.StringIO(outcomes_text),
+                     in_file=io.StringIO(self.events_csv_text),
+                     output_format='parquet')
+
+    def test_main__sort_by_id(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        # Several patients with their records interleaved (in reverse
+        # order of ID)
+        lines = [line for line in self.events_csv_text.splitlines()
+                 if line.startswith('746|')]
+        sorted_text = ''.join(
+            line.replace('746|', f'{id}|') + '\n'
+            for id in range(746, 749) for line in lines)
+        unsorted_text = ''.join(
+            line.replace('746|', f'{id}|') + '\n'
+            for line in lines for id in range(748, 745, -1))
+        def run(events_csv_text, **kwargs):
+            exs_file = io.StringIO()
+            main_api(
+                io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                in_file=io.StringIO(events_csv_text), out_file=exs_file,
+                include_record=include_record,
+                record_transformer=transform_record,
+                **kwargs)
+            return exs_file.getvalue()
+        expected = run(sorted_text)
+        self.maxDiff = None
+        self.assertEqual(expected, run(unsorted_text, sort_by_id=True))
+        self.assertEqual(expected, run(
+            unsorted_text, sort_by_id=True, sort_memory_budget=2000))
+        # Unsorted records are detected unless the check is turned off
+        with self.assertRaises(ValueError):
+            run(unsorted_text)
+        with self.assertRaises(ValueError):
+            list(events_to_sequences(
+                io.StringIO(unsorted_text), {},
+                include_record=include_record))
+        # Records that are grouped but not sorted are accepted without
+        # the check
+        grouped_text = ''.join(
+            line.replace('746|', f'{id}|') + '\n'
+            for id in range(748, 745, -1) for line in lines)
+        self.assertEqual(
+            sorted(expected.splitlines()),
+            sorted(run(grouped_text, check_sorted=False).splitlines()))
+
+    def test_main__checkpoint_resume(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        def events_text(ids):
+            return ''.join(self.events_csv_text.replace('746|', f'{id}|')
+                           for id in ids)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = pathlib.Path(tmp_dir)
+            out_path = tmp_dir / 'exs.csv'
+            ckpt_path = tmp_dir / 'exs.ckpt'
+            def run(ids, **kwargs):
+                if ids is not None:
+                    kwargs['in_file'] = io.StringIO(events_text(ids))
+                main_api(
+                    io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                    out_file=str(out_path),
+                    include_record=include_record,
+                    record_transformer=transform_record,
+                    checkpoint_file=ckpt_path,
+                    checkpoint_every=2,
+                    **kwargs)
+            # Expected: an uninterrupted run
+            run(range(746, 751))
+            expected = out_path.read_text()
+            self.assertEqual(
+                dict(n_sequences=5, last_id=750,
+                     out_offsets=[len(expected)], done=True),
+                read_checkpoint(ckpt_path))
+            # Actual: a run that was interrupted after 3 patients while
+            # writing the next one
+            run(range(746, 749))
+            with open(out_path, 'at') as file:
+                file.write('749|2000-01-01|')
+            run(range(746, 751), resume=True)
+            self.maxDiff = None
+            self.assertEqual(expected, out_path.read_text())
+            # Resuming from an event store works the same
+            store_dir = tmp_dir / 'evs'
+            event_store.compile_store(
+                io.StringIO(events_text(range(746, 751))), store_dir)
+            run(range(746, 749))
+            run(None, in_file=store_dir, resume=True)
+            self.assertEqual(expected, out_path.read_text())
+            # The input must match the checkpoint
+            with self.assertRaises(ValueError):
+                run(range(800, 805), resume=True)
+            # Checkpointing requires an output file
+            with self.assertRaises(ValueError):
+                main_api(
+                    io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                    in_file=io.StringIO(events_text([746])),
+                    out_file=io.StringIO(),
+                    checkpoint_file=ckpt_path)
+
+    def test_main__metrics(self):
+        exposures_text = '''
+rx|377
+rx|733
+rx|976
+'''
+        outcomes_text = '''
+xx|
+'''
+        events_csv_text = ''.join(
+            self.events_csv_text.replace('746|', f'{id}|')
+            for id in range(746, 751))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics_path = pathlib.Path(tmp_dir) / 'metrics.json'
+            store_dir = pathlib.Path(tmp_dir) / 'evs'
+            event_store.compile_store(
+                io.StringIO(events_csv_text), store_dir)
+            n_dropped = []
+            for (jobs, in_file) in ((1, None), (2, None), (1, store_dir)):
+                main_api(
+                    io.StringIO(exposures_text), io.StringIO(outcomes_text),
+                    in_file=(io.StringIO(events_csv_text)
+                             if in_file is None
+                             else in_file),
+                    out_file=io.StringIO(),
+                    include_record=include_record,
+                    record_transformer=transform_record,
+                    jobs=jobs,
+                    jobs_batch_size=2,
+                    metrics_file=metrics_path,
+                    metrics_every=0.01,
+                )
+                with open(metrics_path) as file:
+                    actual = json.load(file)
+                stages = actual['stages']
+                for stage in ('read_records', 'record_groups',
+                              'event_sequences_from_records',
+                              'make_eras', 'examples_from_transitions',
+                              'print_survival_example', 'write'):
+                    self.assertIn(stage, stages)
+                self.assertEqual(5, stages['survivalize']['calls'])
+                self.assertEqual(5, actual['counts']['sequences'])
+                # Person records and medication mentions are dropped
+                self.assertGreater(
+                    actual['counts']['records_dropped_by_include_record'],
+                    0)
+                n_dropped.append(
+                    actual['counts']['records_dropped_by_include_record'])
+                self.assertEqual(
+                    dict(n=5, sum=25, mean=5, min=5, max=5),
+                    actual['observations']['examples_per_patient'])
+            # Reading from an event store drops the same records
+            self.assertEqual([n_dropped[0]] * 3, n_dropped)